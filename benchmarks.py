@@ -0,0 +1,526 @@
+"""Benchmarks of the routing and loading functions.
+
+Run it with `python3 benchmarks.py`. The graphs are loaded (or built) as in
+demo.py, so the first run may take a while.
+"""
+
+import functools
+import itertools
+import http.server
+import os
+import pickle
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import requests
+
+import billboard
+import cache
+import city
+import profiling
+import render
+
+from billboard import CINEMAS_LOCATION
+from buses import BusesGraph, Coord, get_buses_graph
+from city import (ALGORITHMS, CityGraph, OsmnxGraph, build_city_graph,
+                  find_path, find_paths_batch, get_osmnx_graph,
+                  nearest_crosswalks, relaxed_edges)
+from compact import find_path_compact, to_compact
+from hierarchy import find_path_hierarchy, get_hierarchy
+from shared import RoutingPool, get_shared_file
+
+SEED = 42
+ORIGINS = 20
+
+# directory with the pages of sensacine (page1, page2...): a small fixture
+# set is committed, record_pages replaces it with the current pages
+PAGES_DIR = os.path.join("fixtures", "pages")
+
+
+def random_origins(g: CityGraph, n: int = ORIGINS,
+                   seed: int = SEED) -> list[Coord]:
+    """Returns the coordinates of n random crosswalks of g."""
+
+    rng = random.Random(seed)
+    cruilles = [attr["coord"] for _, attr in g.nodes(data=True)
+                if attr["type"] == "Cruilla"]
+    return rng.sample(cruilles, n)
+
+
+def bench_buses() -> None:
+    """Prints the time and the peak of memory of get_buses_graph when the
+    lines are downloaded (empty cache) and when they are in the cache."""
+
+    cache_dir = cache.CACHE_DIR
+    cache.set_cache_dir(tempfile.mkdtemp())
+    try:
+        results = []
+        for _ in range(2):
+            tracemalloc.start()
+            start = time.perf_counter()
+            get_buses_graph()
+            elapsed = time.perf_counter() - start
+            results.append((elapsed, tracemalloc.get_traced_memory()[1]))
+            tracemalloc.stop()
+    finally:
+        cache.set_cache_dir(cache_dir)
+
+    for name, (elapsed, peak) in zip(("download", "cache"), results):
+        print(f"get_buses_graph ({name}): {elapsed:.2f} s, "
+              f"peak {peak / 2**20:.1f} MiB")
+
+
+def bench_build(g1: OsmnxGraph, g2: BusesGraph) -> None:
+    """Prints the time of a full build of the city graph (with an empty
+    cache, so it is not loaded)."""
+
+    cache_dir = cache.CACHE_DIR
+    cache.set_cache_dir(tempfile.mkdtemp())
+    try:
+        start = time.perf_counter()
+        build_city_graph(g1, g2)
+        elapsed = time.perf_counter() - start
+    finally:
+        cache.set_cache_dir(cache_dir)
+
+    print(f"build_city_graph: full build {elapsed:.1f} s")
+
+
+def bench_load(g1: OsmnxGraph, g2: BusesGraph) -> None:
+    """Prints the time to load the OSMnx graph and the city graph from the
+    cache (they are built first if they are not in it)."""
+
+    build_city_graph(g1, g2)
+    params = city.city_params(g1, g2)
+    for name, load in (("get_osmnx_graph", get_osmnx_graph),
+                       ("load_city_graph",
+                        lambda: city.load_city_graph(params))):
+        start = time.perf_counter()
+        load()
+        print(f"{name} (cache): {time.perf_counter() - start:.2f} s")
+
+
+def bench_find_path(g: CityGraph, origins: list[Coord]) -> None:
+    """Prints, for each algorithm of find_path, the mean time and the mean
+    number of edges relaxed from the origins to every cinema."""
+
+    cinemas = list(CINEMAS_LOCATION.values())
+    pairs = [(src, dst) for src in origins for dst in cinemas]
+    snapped = [tuple(nearest_crosswalks(g, [src, dst])) for src, dst in pairs]
+
+    print(f"find_path: {len(pairs)} origin-cinema queries")
+    for algorithm in ALGORITHMS:
+        start = time.perf_counter()
+        for src, dst in pairs:
+            find_path(None, g, src, dst, algorithm)
+        elapsed = time.perf_counter() - start
+
+        relaxed = sum(relaxed_edges(g, a, b, algorithm) for a, b in snapped)
+        print(f"  {algorithm:<14} {elapsed / len(pairs) * 1000:8.2f} ms/query"
+              f" {relaxed / len(pairs):10.0f} edges relaxed/query")
+
+
+def bench_reachable(g: CityGraph, origins: list[Coord],
+                    board: billboard.Billboard,
+                    leaving_time: tuple[int, int] = (18, 0)) -> None:
+    """Prints the mean time to find the projections that can be reached
+    from each origin leaving at leaving_time, with a search for each
+    projection and with reachable_projections (a single search)."""
+
+    projections = board.search_projection_by_time(leaving_time)
+
+    start = time.perf_counter()
+    for src in origins:
+        for projection in projections:
+            find_path(None, g, src,
+                      CINEMAS_LOCATION[projection.cinema.name])
+    each = (time.perf_counter() - start) / len(origins)
+
+    start = time.perf_counter()
+    for src in origins:
+        city.reachable_projections(g, board, src, leaving_time)
+    single = (time.perf_counter() - start) / len(origins)
+
+    print(f"reachable projections ({len(projections)}): "
+          f"a search each {each * 1000:.1f} ms, "
+          f"single search {single * 1000:.1f} ms")
+
+
+def bench_closest(g: CityGraph, origins: list[Coord],
+                  board: billboard.Billboard,
+                  leaving_time: tuple[int, int] = (18, 0)) -> None:
+    """Prints, for some k, the mean time of closest_projections from each
+    origin to the films of the billboard, and the nodes it settles."""
+
+    films = [film.title for film in board.films]
+    for k in (1, 3, len(CINEMAS_LOCATION)):
+        was_enabled = profiling.enabled()
+        profiling.enable()
+        profiling.reset()
+        start = time.perf_counter()
+        for src, film in zip(origins, itertools.cycle(films)):
+            city.closest_projections(g, board, src, leaving_time, k,
+                                     word=film.lower())
+        elapsed = time.perf_counter() - start
+        settled = profiling.report()["counters"].get(
+            "city.dijkstra_from.settled", 0)
+        if not was_enabled:
+            profiling.disable()
+
+        print(f"closest_projections k={k}: "
+              f"{elapsed / len(origins) * 1000:.1f} ms/query, "
+              f"{settled / len(origins) / g.number_of_nodes():.0%} "
+              f"of the nodes settled")
+
+
+def bench_render(g: CityGraph, origins: list[Coord]) -> None:
+    """Prints the mean time of plot_path drawing the paths from the origins
+    to a cinema the first time (tiles in the cache, image not) and again
+    (image in the cache)."""
+
+    render.seed_tiles()
+    cinema = next(iter(CINEMAS_LOCATION.values()))
+    paths = [find_path(None, g, src, cinema) for src in origins]
+    shutil.rmtree(cache.cache_path(render.ROUTES_DIR), ignore_errors=True)
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "path.png")
+        for label in ("first", "cached"):
+            start = time.perf_counter()
+            for p in paths:
+                city.plot_path(g, p, filename)
+            elapsed = time.perf_counter() - start
+            print(f"plot_path ({label}): "
+                  f"{elapsed / len(paths) * 1000:.1f} ms/path")
+
+
+def bench_show(g: CityGraph) -> None:
+    """Prints the time of show_city until the figure is drawn (without
+    window, so it can run anywhere)."""
+
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    show = plt.show
+    plt.show = lambda: plt.gcf().canvas.draw()
+    try:
+        start = time.perf_counter()
+        city.show_city(g)
+        print(f"show_city: {time.perf_counter() - start:.2f} s")
+    finally:
+        plt.show = show
+        plt.close("all")
+
+
+def bench_pareto(g: CityGraph, origins: list[Coord]) -> None:
+    """Prints, for some caps of labels, the mean time of find_pareto_paths
+    from the origins to every cinema and the mean number of routes."""
+
+    cinemas = list(CINEMAS_LOCATION.values())
+    pairs = [(src, dst) for src in origins for dst in cinemas]
+
+    print(f"find_pareto_paths: {len(pairs)} origin-cinema queries")
+    for max_labels in (1, 2, city.PARETO_MAX_LABELS, 16):
+        start = time.perf_counter()
+        routes = sum(len(city.find_pareto_paths(None, g, src, dst,
+                                                max_labels=max_labels))
+                     for src, dst in pairs)
+        elapsed = time.perf_counter() - start
+        print(f"  {max_labels:>2} labels/node "
+              f"{elapsed / len(pairs) * 1000:8.2f} ms/query "
+              f"{routes / len(pairs):6.1f} routes/query")
+
+
+def bench_compact(g: CityGraph, origins: list[Coord]) -> None:
+    """Prints the memory per edge of the city graph and of its compact
+    version, and the mean time of find_path on each from the origins to
+    every cinema."""
+
+    cg = to_compact(g)
+    edges = g.number_of_edges()
+    for label, graph in (("networkx", g), ("compact", cg)):
+        data = pickle.dumps(graph, pickle.HIGHEST_PROTOCOL)
+        tracemalloc.start()
+        copy = pickle.loads(data)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del copy
+        print(f"{label}: {size / edges:.0f} bytes/edge")
+
+    pairs = [(src, dst) for src in origins
+             for dst in CINEMAS_LOCATION.values()]
+    cg.spatial_index()  # built before timing, as it is loaded with g
+    for label, search in (
+        ("networkx dijkstra",
+         lambda src, dst: find_path(None, g, src, dst, "dijkstra")),
+        ("compact dijkstra",
+         lambda src, dst: find_path_compact(cg, src, dst, "dijkstra")),
+        ("compact astar",
+         lambda src, dst: find_path_compact(cg, src, dst, "astar")),
+    ):
+        start = time.perf_counter()
+        for src, dst in pairs:
+            search(src, dst)
+        elapsed = time.perf_counter() - start
+        print(f"  {label:<18} {elapsed / len(pairs) * 1000:8.2f} ms/query")
+
+
+def mapped_memory(pid: int, filename: str) -> tuple[int, int]:
+    """Returns the resident memory of the mappings of the file filename in
+    the process pid and its proportional share (the pages shared with other
+    processes are divided among them), in bytes. Only on Linux."""
+
+    path = os.path.realpath(filename)
+    memory = {"Rss": 0, "Pss": 0}
+    mapped = False
+    with open(f"/proc/{pid}/smaps") as file:
+        for line in file:
+            fields = line.split()
+            if "-" in fields[0] and not fields[0].endswith(":"):
+                # header of a mapping: address, perms, ..., path
+                mapped = fields[-1] == path
+            elif mapped and fields[0][:-1] in memory:
+                memory[fields[0][:-1]] += int(fields[1]) * 1024
+    return memory["Rss"], memory["Pss"]
+
+
+def bench_shared(g: CityGraph, origins: list[Coord]) -> None:
+    """Prints, for RoutingPools of 1, 2 and 4 processes, the memory of the
+    shared graph after answering the queries from the origins to every
+    cinema: resident in each process and proportional in all of them (it
+    stays flat if the processes share the pages)."""
+
+    filename = get_shared_file(g)
+    queries = [(src, dst) for src in origins
+               for dst in CINEMAS_LOCATION.values()]
+
+    print(f"shared graph: {os.path.getsize(filename) / 2**20:.1f} MiB")
+    for processes in (1, 2, 4):
+        with RoutingPool(filename, processes) as pool:
+            pool.find_paths(queries)
+            memory = [mapped_memory(worker.pid, filename)
+                      for worker in pool.pool._pool]
+        rss = max(m[0] for m in memory)
+        pss = sum(m[1] for m in memory)
+        print(f"  {processes} processes: {rss / 2**20:.1f} MiB resident/"
+              f"process, {pss / 2**20:.1f} MiB proportional in total")
+
+
+def bench_batch(g: CityGraph, origins: list[Coord]) -> None:
+    """Prints the time to find the paths from the origins to every cinema
+    with a find_path for each pair and with find_paths_batch (in this
+    process and in a pool of 4 processes, which is started each time)."""
+
+    cinemas = list(CINEMAS_LOCATION.values())
+
+    start = time.perf_counter()
+    for src in origins:
+        for dst in cinemas:
+            find_path(None, g, src, dst)
+    times = [time.perf_counter() - start]
+
+    for processes in (1, 4):
+        start = time.perf_counter()
+        find_paths_batch(g, origins, cinemas, processes)
+        times.append(time.perf_counter() - start)
+
+    print(f"paths: {len(origins)} origins x {len(cinemas)} cinemas, "
+          f"find_path {times[0]:.2f} s, find_paths_batch {times[1]:.2f} s, "
+          f"pooled (4 processes) {times[2]:.2f} s")
+
+
+def bench_transfers(g1: OsmnxGraph, g2: BusesGraph,
+                    origins: list[Coord]) -> None:
+    """Prints the number of edges of type "Transbord" and the mean time of
+    find_path from the origins to every cinema, joining every pair of lines
+    of a stop and joining them through hubs (see add_weights_buses)."""
+
+    pairs = [(src, dst) for src in origins
+             for dst in CINEMAS_LOCATION.values()]
+
+    hub_min_lines = city.HUB_MIN_LINES
+    cache_dir = cache.CACHE_DIR
+    cache.set_cache_dir(tempfile.mkdtemp())
+    try:
+        for model, value in (("pairs", sys.maxsize), ("hubs", hub_min_lines)):
+            city.HUB_MIN_LINES = value
+            g = build_city_graph(g1, g2)
+            transfers = sum(1 for _, _, tipus in g.edges(data="type")
+                            if tipus == "Transbord")
+
+            start = time.perf_counter()
+            for src, dst in pairs:
+                find_path(None, g, src, dst)
+            elapsed = time.perf_counter() - start
+
+            print(f"transfers ({model}): {transfers} edges, "
+                  f"{g.number_of_edges()} in total, "
+                  f"{elapsed / len(pairs) * 1000:.2f} ms/query")
+    finally:
+        city.HUB_MIN_LINES = hub_min_lines
+        cache.set_cache_dir(cache_dir)
+
+
+def bench_hierarchy(g: CityGraph, origins: list[Coord]) -> None:
+    """Prints the preprocessing time and size of the contraction hierarchy
+    and its speedup over find_path from the origins to every cinema."""
+
+    ch = get_hierarchy(g)
+    print(f"hierarchy: preprocessing {ch.preprocessing_time:.1f} s, "
+          f"{ch.shortcuts()} shortcuts, {ch.nbytes() / 2**20:.1f} MiB")
+
+    pairs = [(src, dst) for src in origins
+             for dst in CINEMAS_LOCATION.values()]
+
+    start = time.perf_counter()
+    for src, dst in pairs:
+        find_path(None, g, src, dst)
+    plain = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for src, dst in pairs:
+        find_path_hierarchy(g, ch, src, dst)
+    contracted = time.perf_counter() - start
+
+    print(f"  find_path      {plain / len(pairs) * 1000:8.2f} ms/query")
+    print(f"  hierarchy      {contracted / len(pairs) * 1000:8.2f} ms/query"
+          f" (x{plain / contracted:.1f})")
+
+
+def record_pages(directory: str = PAGES_DIR) -> None:
+    """Downloads the pages of sensacine in directory (page1, page2...)."""
+
+    os.makedirs(directory, exist_ok=True)
+    for idx_page in range(1, billboard.PAGES + 1):
+        page = requests.get(billboard.BASE_URL + str(idx_page),
+                            timeout=billboard.TIMEOUT)
+        with open(os.path.join(directory, f"page{idx_page}"), "wb") as file:
+            file.write(page.content)
+
+
+def serve_pages(directory: str) -> tuple[http.server.HTTPServer, str]:
+    """Serves the files of directory in a local server (it answers
+    conditional requests with 304). Returns the server and the base url of
+    the pages."""
+
+    class Handler(http.server.SimpleHTTPRequestHandler):
+        def log_message(self, *args) -> None:
+            pass
+
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(Handler, directory=directory)
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/page"
+
+
+def bench_parse(directory: str = PAGES_DIR, repeat: int = 5) -> None:
+    """Prints the mean time to parse each page of directory, parsing the
+    whole page and only the divs with the data of the billboard."""
+
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), "rb") as file:
+            content = file.read()
+
+        times = []
+        for parse_only in (None, billboard.PARSE_ONLY):
+            start = time.perf_counter()
+            for _ in range(repeat):
+                billboard.parse_page(content, parse_only)
+            times.append((time.perf_counter() - start) / repeat)
+
+        print(f"parse_page {filename}: whole {times[0] * 1000:.1f} ms, "
+              f"targeted {times[1] * 1000:.1f} ms "
+              f"(x{times[0] / times[1]:.1f})")
+
+
+def bench_billboard(directory: str = PAGES_DIR) -> None:
+    """Prints the time of read_billboard from the pages of directory served
+    locally: cold (empty cache), warm (pages not modified, already parsed)
+    and warm in a new process (pages not modified, parsed again)."""
+
+    server, base_url = serve_pages(directory)
+    cache_dir = cache.CACHE_DIR
+    cache.set_cache_dir(tempfile.mkdtemp())
+    try:
+        times = []
+        for clear in (True, False, True):
+            if clear:
+                billboard._parsed_pages.clear()
+            start = time.perf_counter()
+            billboard.read_billboard(base_url)
+            times.append(time.perf_counter() - start)
+    finally:
+        cache.set_cache_dir(cache_dir)
+        server.shutdown()
+
+    print(f"read_billboard: cold {times[0] * 1000:.1f} ms, "
+          f"warm {times[1] * 1000:.1f} ms, "
+          f"warm (new process) {times[2] * 1000:.1f} ms")
+
+
+def read_pages(directory: str = PAGES_DIR) -> billboard.Billboard:
+    """Returns the billboard of the pages of directory."""
+
+    pages = []
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), "rb") as file:
+            pages.append(billboard.parse_page(file.read()))
+    return billboard.merge_pages(pages)
+
+
+def bench_memory(directory: str = PAGES_DIR) -> None:
+    """Prints the memory used by the billboard of the pages of directory
+    (projections, films, cinemas and indexes) per projection."""
+
+    snapshot = billboard.billboard_to_snapshot(read_pages(directory))
+
+    tracemalloc.start()
+    board = billboard.snapshot_to_billboard(snapshot)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    n = max(len(board.projections), 1)
+    print(f"billboard: {len(board.projections)} projections, "
+          f"{size / n:.0f} bytes/projection")
+
+
+def main() -> None:
+    """Loads the graphs and runs every benchmark."""
+
+    bench_buses()
+
+    osmx_g: OsmnxGraph = get_osmnx_graph()
+    buses_g: BusesGraph = get_buses_graph()
+    bench_build(osmx_g, buses_g)
+    bench_load(osmx_g, buses_g)
+
+    city_g: CityGraph = build_city_graph(osmx_g, buses_g)
+    origins = random_origins(city_g)
+
+    bench_find_path(city_g, origins)
+    bench_compact(city_g, origins)
+    bench_shared(city_g, origins)
+    bench_batch(city_g, origins)
+    bench_transfers(osmx_g, buses_g, origins)
+    bench_pareto(city_g, origins)
+    bench_hierarchy(city_g, origins)
+    bench_render(city_g, origins)
+    bench_show(city_g)
+
+    bench_parse()
+    board = read_pages()
+    bench_reachable(city_g, origins, board)
+    bench_closest(city_g, origins, board)
+    bench_memory()
+    bench_billboard()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,36 @@
+import hashlib
 import json
-from dataclasses import dataclass
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 
 import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import cache
+import profiling
+
+BASE_URL = "https://www.sensacine.com/cines/cines-en-72480/?page="
+PAGES = 3
+
+TIMEOUT = 10  # seconds
+RETRIES = 3
+
+# ETag and Last-Modified of the pages stored in the cache
+FILE_PAGES_NAME = "pages.json"
+
+# last billboard scraped, it is scraped again when it is older than
+# SNAPSHOT_TTL
+FILE_SNAPSHOT_NAME = "BILLBOARD.json"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_TTL = 6 * 60 * 60  # seconds
 
 # when running the code, finding the cinemas location was time consuming
 # and some cinemas shown by the provider were outside Barcelona
@@ -50,7 +78,7 @@ def calculate_time(starting_time: tuple[int, int],
     return end_minutes - start_minutes
 
 
-@dataclass
+@dataclass(slots=True)
 class Film:
     title: str
     genre: list[str]
@@ -69,12 +97,25 @@ class Film:
         self.genre = data_film["genre"]
         self.directors = data_film["directors"]
         self.actors = data_film["actors"]
-        self.language = data_theater_movie_div.find(
+        self.language = sys.intern(data_theater_movie_div.find(
                                                 "span", {"class": "bold"}
-                                                    ).text
+                                                    ).text)
 
+    @classmethod
+    def from_data(cls, title: str, genre: list[str], directors: list[str],
+                  actors: list[str], language: str) -> "Film":
+        """Returns the film with the given data (not in html format)."""
 
-@dataclass
+        film = cls.__new__(cls)
+        film.title = title
+        film.genre = genre
+        film.directors = directors
+        film.actors = actors
+        film.language = sys.intern(language)
+        return film
+
+
+@dataclass(slots=True)
 class Cinema:
     name: str
     address: str
@@ -83,12 +124,12 @@ class Cinema:
     def __init__(self, name, adress: str, coord: tuple[float, float]) -> None:
         """Initializes Cinema class given its parameters"""
 
-        self.name = name
+        self.name = sys.intern(name)
         self.address = adress
         self.coord = coord
 
 
-@dataclass
+@dataclass(slots=True)
 class Projection:
     film: Film
     cinema: Cinema
@@ -100,26 +141,76 @@ class Projection:
         """Initializes Projection dataclass given its data in html format,
         the film that projects and its corresponding cinema."""
 
-        session_time_str: str = session_data_html["data-times"][1:-1]
+        self.film = film
+        self.cinema = cinema
+        self.time, self.duration = session_times(
+            session_data_html["data-times"]
+        )
+        self.language = self.film.language
 
-        starting_time_str: str = session_time_str.split(",")[0][1:-1]
-        ending_time_str: str = session_time_str.split(",")[-1][1:-1]
+    @classmethod
+    def from_data(cls, film: Film, cinema: Cinema, time: tuple[int, int],
+                  duration: int) -> "Projection":
+        """Returns the projection with the given data (not in html
+        format)."""
 
-        starting_time: tuple[int, int] = (
-            int(starting_time_str.split(":")[0]),
-            int(starting_time_str.split(":")[1]),
-        )
+        projection = cls.__new__(cls)
+        projection.film = film
+        projection.cinema = cinema
+        projection.time = hour_minute(*time)
+        projection.duration = duration
+        projection.language = film.language
+        return projection
 
-        ending_time: tuple[int, int] = (
-            int(ending_time_str.split(":")[0]),
-            int(ending_time_str.split(":")[1]),
-        )
 
-        self.film = film
-        self.cinema = cinema
-        self.time = starting_time
-        self.duration = calculate_time(starting_time, ending_time)
-        self.language = self.film.language
+@lru_cache(maxsize=None)
+def hour_minute(hour: int, minute: int) -> tuple[int, int]:
+    """Returns the tuple (hour, minute). There is only one tuple for each
+    time, shared by all the projections that start then."""
+
+    return (hour, minute)
+
+
+@lru_cache(maxsize=None)
+def session_times(data_times: str) -> tuple[tuple[int, int], int]:
+    """Returns the starting time and the duration of a session given its
+    attribute data-times. Many sessions have the same times, so each
+    different data-times is only processed once."""
+
+    session_time_str: str = data_times[1:-1]
+
+    starting_time_str: str = session_time_str.split(",")[0][1:-1]
+    ending_time_str: str = session_time_str.split(",")[-1][1:-1]
+
+    starting_time: tuple[int, int] = hour_minute(
+        int(starting_time_str.split(":")[0]),
+        int(starting_time_str.split(":")[1]),
+    )
+
+    ending_time: tuple[int, int] = (
+        int(ending_time_str.split(":")[0]),
+        int(ending_time_str.split(":")[1]),
+    )
+
+    return starting_time, calculate_time(starting_time, ending_time)
+
+
+# the keys of the sorted indexes of Billboard are value << POSITION_BITS |
+# position, so they are sorted by value and then by position
+POSITION_BITS = 32
+POSITION_MASK = (1 << POSITION_BITS) - 1
+
+
+def _key(value: int, position: int) -> int:
+    """Returns the key of the projection in position for a sorted index."""
+
+    return value << POSITION_BITS | position
+
+
+def trigrams(text: str) -> set[str]:
+    """Returns the set of substrings of length 3 of text."""
+
+    return {text[i:i + 3] for i in range(len(text) - 2)}
 
 
 @dataclass
@@ -128,6 +219,26 @@ class Billboard:
     cinemas: list[Cinema]
     projections: list[Projection]
     films_titles: set[str]
+    scraped_at: float = 0.0  # time.time() when it was scraped
+
+    # indexes of the projections (positions in projections), updated in
+    # add_projection. The sorted lists are sorted when they are searched,
+    # and their keys are packed in an int (see _key) to save memory.
+    _titles: dict[str, list[int]] = field(default_factory=dict, repr=False)
+    _trigrams: dict[str, set[str]] = field(default_factory=dict, repr=False)
+    _by_time: list[int] = field(default_factory=list, repr=False)
+    _by_duration: list[int] = field(default_factory=list, repr=False)
+    _by_cinema: dict[str, list[int]] = field(default_factory=dict,
+                                             repr=False)
+    _by_language: dict[str, list[int]] = field(default_factory=dict,
+                                               repr=False)
+    _sorted: bool = field(default=True, repr=False)
+
+    def __post_init__(self) -> None:
+        """Indexes the projections given."""
+
+        for i, projection in enumerate(self.projections):
+            self._index_projection(i, projection)
 
     def add_film(self, film: Film) -> None:
         """Adds a film in the list that tracks films avoiding repetitions."""
@@ -147,36 +258,130 @@ class Billboard:
         """Adds a new projections to the list that tracks projections."""
 
         self.projections.append(projection)
+        self._index_projection(len(self.projections) - 1, projection)
+
+    def _index_projection(self, i: int, projection: Projection) -> None:
+        """Adds the projection in position i to the indexes."""
+
+        title = projection.film.title.lower()
+        if title not in self._titles:
+            self._titles[title] = []
+            for trigram in trigrams(title):
+                self._trigrams.setdefault(trigram, set()).add(title)
+        self._titles[title].append(i)
+
+        self._by_time.append(_key(projection.time[0] * 60
+                                  + projection.time[1], i))
+        self._by_duration.append(_key(projection.duration, i))
+        self._by_cinema.setdefault(projection.cinema.name, []).append(i)
+        self._by_language.setdefault(projection.language, []).append(i)
+        self._sorted = False
+
+    def _sort(self) -> None:
+        """Sorts the indexes by time and duration if needed."""
+
+        if not self._sorted:
+            self._by_time.sort()
+            self._by_duration.sort()
+            self._sorted = True
+
+    def _positions_by_word(self, word: str) -> set[int]:
+        """Positions of the projections whose title contains word."""
+
+        word = word.lower()
+        if len(word) >= 3:
+            # only the titles with all the trigrams of word can contain it
+            titles: set[str] = set.intersection(*[
+                self._trigrams.get(trigram, set())
+                for trigram in trigrams(word)
+            ])
+        else:
+            titles = set(self._titles.keys())
+
+        return {i for title in titles if word in title
+                for i in self._titles[title]}
+
+    def _positions_by_time(self, starting_time: tuple[int, int],
+                           ending_time: tuple[int, int] | None = None
+                           ) -> set[int]:
+        """Positions of the projections that start between starting_time
+        and ending_time (both included)."""
+
+        self._sort()
+        a = bisect_left(self._by_time,
+                        _key(starting_time[0] * 60 + starting_time[1], 0))
+        b = len(self._by_time) if ending_time is None else \
+            bisect_right(self._by_time,
+                         _key(ending_time[0] * 60 + ending_time[1],
+                              POSITION_MASK))
+        return {key & POSITION_MASK for key in self._by_time[a:b]}
+
+    def _positions_by_duration(self, duration: int) -> set[int]:
+        """Positions of the projections that last at most duration."""
+
+        self._sort()
+        b = bisect_right(self._by_duration, _key(duration, POSITION_MASK))
+        return {key & POSITION_MASK for key in self._by_duration[:b]}
+
+    def _projections(self, positions: set[int]) -> list[Projection]:
+        """Returns the projections of positions in the order they were
+        added."""
+
+        return [self.projections[i] for i in sorted(positions)]
 
     def search_projection_by_word(self, word: str) -> list[Projection]:
         """Returns a list of projections whose film title contains the given
         word."""
 
-        return [
-            projection
-            for projection in self.projections
-            if word.lower() in projection.film.title.lower()
-        ]
+        return self._projections(self._positions_by_word(word))
 
     def search_projection_by_time(
         self, starting_time: tuple[int, int]
     ) -> list[Projection]:
         """Returs a list of projections that start later than a given time."""
 
-        return [
-            projection
-            for projection in self.projections
-            if starting_time <= projection.time
-        ]
+        return self._projections(self._positions_by_time(starting_time))
 
     def search_projection_by_duration(self, duration: int) -> list[Projection]:
         """Returns the list of projections that their film duration is less or
         equal than the given projection."""
-        return [
-            projection
-            for projection in self.projections
-            if duration >= projection.duration
-        ]
+
+        return self._projections(self._positions_by_duration(duration))
+
+    def search_projections(
+        self, word: str | None = None,
+        starting_time: tuple[int, int] | None = None,
+        ending_time: tuple[int, int] | None = None,
+        duration: int | None = None, cinema: str | None = None,
+        language: str | None = None
+    ) -> list[Projection]:
+        """Returns the projections that fulfill all the constraints given:
+        - word: the film title contains it
+        - starting_time, ending_time: they start between them (included)
+        - duration: they last at most duration minutes
+        - cinema, language: they are projected in them
+        """
+
+        candidates: list[set[int]] = []
+        if word is not None:
+            candidates.append(self._positions_by_word(word))
+        if starting_time is not None or ending_time is not None:
+            candidates.append(self._positions_by_time(
+                starting_time or (0, 0), ending_time
+            ))
+        if duration is not None:
+            candidates.append(self._positions_by_duration(duration))
+        if cinema is not None:
+            candidates.append(set(self._by_cinema.get(cinema, [])))
+        if language is not None:
+            candidates.append(set(self._by_language.get(language, [])))
+
+        if not candidates:
+            return list(self.projections)
+
+        # the smallest sets are intersected first
+        candidates.sort(key=len)
+        return self._projections(set.intersection(*candidates))
 
 
 def process_cinema(
@@ -206,74 +411,420 @@ def process_cinema(
     cinema_name_adress[name] = (address, CINEMAS_LOCATION[name])
 
 
-def read_billboard() -> Billboard:
-    """Scrapes the data from sensacine.com web of
-    the movies and theaters of Barcelona"""
+@dataclass
+class Page:
+    """Data of a page of sensacine, before it is merged in a Billboard."""
 
-    billboard: Billboard = Billboard(list(), list(), list(), set())
+    cinema_name_adress: dict[str, tuple[str, tuple[float, float]]]
+    # film, name of the cinema and data-times of each session
+    movies: list[tuple[Film, str, list[dict[str, str]]]]
 
-    base_url: str = "https://www.sensacine.com/cines/cines-en-72480/?page="
 
-    cinema_name_adress: dict[str, tuple[str, tuple[float, float]]] = dict()
+def relevant_div(name: str, attrs: dict[str, str]) -> bool:
+    """Returns whether a tag is one of the divs with the data of the cinemas
+    and the films (the rest of the page is not needed)."""
 
-    for idx_page in range(1, 4):
-        # download page content
+    classes = attrs.get("class", "")
+    return name == "div" and ("j_entity_container" in classes
+                              or "tabs_box_pan" in classes)
 
-        url = base_url + str(idx_page)
 
-        page = requests.get(url)
+# only the relevant divs (and what they contain) are parsed
+PARSE_ONLY = SoupStrainer(relevant_div)
 
-        soup = BeautifulSoup(page.content, "html.parser")
 
-        # Process cinamas location
+@profiling.timed("billboard.parse_page")
+def parse_page(content: bytes,
+               parse_only: SoupStrainer | None = PARSE_ONLY) -> Page:
+    """Returns the data of the cinemas, films and sessions of a page.
 
-        cinemas_div = soup.find_all("div", {"class": "tabs_box_pan item-0"})
+    With parse_only=None the whole page is parsed.
+    """
 
-        cinema_name_adress_html = soup.find_all(
-            "div", {"class": "margin_10b j_entity_container"}
-        )
+    soup = BeautifulSoup(content, "html.parser", parse_only=parse_only)
+
+    page: Page = Page(dict(), list())
+
+    # the same film (data-movie and language) appears in many cinemas and
+    # the same cinema (data-theater) in many films, their data is only
+    # decoded once
+    films: dict[tuple[str, str], Film] = dict()
+    theaters: dict[str, str] = dict()
+
+    # Process cinamas location
 
-        for cine in cinema_name_adress_html:
-            process_cinema(cine, cinema_name_adress)
+    cinemas_div = soup.find_all("div", {"class": "tabs_box_pan item-0"})
 
-        # Process all the films and their projections
+    cinema_name_adress_html = soup.find_all(
+        "div", {"class": "margin_10b j_entity_container"}
+    )
 
-        for cinema_div in cinemas_div:
-            movies = cinema_div.find_all("div", {"class": "item_resa"})
+    for cine in cinema_name_adress_html:
+        process_cinema(cine, page.cinema_name_adress)
 
-            for movie in movies:
-                data_theater_movie_div = movie.find("div", {"class": "j_w"})
+    # Process all the films and their sessions
 
-                # We obtain and process the movie data
+    for cinema_div in cinemas_div:
+        movies = cinema_div.find_all("div", {"class": "item_resa"})
 
-                film: Film = Film(data_theater_movie_div)
-                billboard.add_film(film)
+        for movie in movies:
+            data_theater_movie_div = movie.find("div", {"class": "j_w"})
 
-                # We obtain and process the theater data
-                # (the information that it's not the adress)
+            key = (data_theater_movie_div["data-movie"],
+                   data_theater_movie_div.find("span", {"class": "bold"}).text)
+            if key not in films:
+                films[key] = Film(data_theater_movie_div)
+            film: Film = films[key]
 
-                data_cinema_str = data_theater_movie_div["data-theater"]
+            data_cinema_str = data_theater_movie_div["data-theater"]
+            if data_cinema_str not in theaters:
                 data_cinema = json.loads(data_cinema_str)
-                name = data_cinema["name"].strip()
-                if name not in cinema_name_adress.keys():
-                    continue
-                cinema: Cinema = Cinema(
-                    name, cinema_name_adress[name][0],
-                    cinema_name_adress[name][1]
-                )
-                billboard.add_cinema(cinema)
+                theaters[data_cinema_str] = data_cinema["name"].strip()
+            name = theaters[data_cinema_str]
+
+            list_film_sessions_str = movie.find("ul",
+                                                {"class": "list_hours"})
+
+            sessions_str = list_film_sessions_str.find_all("em")
+
+            page.movies.append(
+                (film, name, [{"data-times": session["data-times"]}
+                              for session in sessions_str])
+            )
+
+    return page
+
+
+@profiling.timed("billboard.merge_pages")
+def merge_pages(pages: list[Page]) -> Billboard:
+    """Returns the billboard with the data of the pages, in their order.
+
+    The films of a page can only be projected in the cinemas whose adress
+    is in that page or in a previous one.
+    """
+
+    billboard: Billboard = Billboard(list(), list(), list(), set())
+
+    cinema_name_adress: dict[str, tuple[str, tuple[float, float]]] = dict()
+
+    for page in pages:
+        cinema_name_adress.update(page.cinema_name_adress)
+
+        for film, name, sessions in page.movies:
+            billboard.add_film(film)
+
+            if name not in cinema_name_adress.keys():
+                continue
+            cinema: Cinema = Cinema(
+                name, cinema_name_adress[name][0],
+                cinema_name_adress[name][1]
+            )
+            billboard.add_cinema(cinema)
+
+            for session in sessions:
+                projection: Projection = Projection(session, film, cinema)
+
+                billboard.add_projection(projection)
+
+    return billboard
+
+
+def page_file(url: str) -> str:
+    """Returns the name of the file of the cache with the content of url."""
+
+    return "page-" + hashlib.sha1(url.encode()).hexdigest() + ".html"
+
+
+def read_validators() -> dict[str, dict[str, str]]:
+    """Returns the ETag and Last-Modified of each page in the cache."""
+
+    path = cache.cache_path(FILE_PAGES_NAME)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        return json.load(file)
+
+
+def new_session() -> requests.Session:
+    """Returns a session that reuses connections and retries the requests
+    that fail because of the server."""
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_maxsize=PAGES,
+        max_retries=Retry(total=RETRIES, backoff_factor=0.5,
+                          status_forcelist=(500, 502, 503, 504)),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def fetch_page(session: requests.Session, url: str,
+               validators: dict[str, str]) -> tuple[bytes, dict[str, str]]:
+    """Returns the content of url and its validators (ETag and
+    Last-Modified).
+
+    If the page has not changed since it was stored in the cache (the server
+    answers 304 Not Modified) the content of the cache is returned.
+    """
+
+    path = cache.cache_path(page_file(url))
+    headers: dict[str, str] = {}
+    if os.path.exists(path):
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+    response = session.get(url, headers=headers, timeout=TIMEOUT)
+
+    if headers:
+        profiling.cache_hit("billboard.not_modified",
+                            response.status_code == 304)
+
+    if response.status_code == 304:
+        with open(path, "rb") as file:
+            return file.read(), validators
+
+    response.raise_for_status()
+    cache.atomic_write(path, lambda file: file.write(response.content))
+
+    validators = {}
+    if "ETag" in response.headers:
+        validators["etag"] = response.headers["ETag"]
+    if "Last-Modified" in response.headers:
+        validators["last_modified"] = response.headers["Last-Modified"]
+    return response.content, validators
+
+
+@profiling.timed("billboard.fetch_pages")
+def fetch_pages(urls: list[str]) -> list[bytes]:
+    """Returns the content of the urls (in the same order), downloaded at
+    the same time with a session that reuses the connections."""
+
+    validators = read_validators()
+
+    with new_session() as session, \
+            ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        results = list(executor.map(
+            lambda url: fetch_page(session, url, validators.get(url, {})),
+            urls
+        ))
+
+    for url, (_, page_validators) in zip(urls, results):
+        validators[url] = page_validators
+    content = json.dumps(validators).encode()
+    cache.atomic_write(cache.cache_path(FILE_PAGES_NAME),
+                       lambda file: file.write(content))
+
+    return [content for content, _ in results]
+
+
+# pages parsed by the last read_billboard of this process, by the hash of
+# their content (the older ones are dropped, so it never grows)
+_parsed_pages: dict[str, Page] = {}
+
+
+@profiling.timed("billboard.read_billboard")
+def read_billboard(base_url: str = BASE_URL) -> Billboard:
+    """Scrapes the data from sensacine.com web of
+    the movies and theaters of Barcelona
+
+    The pages are downloaded at the same time, and a page is only downloaded
+    and parsed again if it has changed.
+    """
+
+    global _parsed_pages
+
+    contents = fetch_pages([base_url + str(idx_page)
+                            for idx_page in range(1, PAGES + 1)])
+
+    pages: list[Page] = []
+    parsed: dict[str, Page] = {}
+    for content in contents:
+        key = hashlib.sha256(content).hexdigest()
+        profiling.cache_hit("billboard.parsed_pages", key in _parsed_pages)
+        if key not in parsed:
+            parsed[key] = _parsed_pages.get(key) or parse_page(content)
+        pages.append(parsed[key])
+
+    # only the current pages are kept (the dict is replaced, not modified,
+    # as the billboard may be read from several threads)
+    _parsed_pages = parsed
+
+    billboard = merge_pages(pages)
+    billboard.scraped_at = time.time()
+    return billboard
+
+
+"""
+SNAPSHOTS
+
+A snapshot is a billboard written in JSON with tables instead of nested
+objects: the films and the cinemas are stored once, and the projections (and
+the lists films and cinemas of the billboard) refer to them by their
+position in the tables.
+
+- films: [title, genre, directors, actors, language]
+- cinemas: [name, address, lat, lon]
+- projections: [film, cinema, hour, minute, duration]
+"""
+
+
+def _table_position(table: list[list], positions: dict[str, int],
+                    row: list) -> int:
+    """Returns the position of row in table, adding it if needed."""
+
+    key = json.dumps(row)
+    if key not in positions:
+        positions[key] = len(table)
+        table.append(row)
+    return positions[key]
+
+
+def billboard_to_snapshot(billboard: Billboard) -> dict:
+    """Returns the snapshot of billboard."""
+
+    films: list[list] = []
+    cinemas: list[list] = []
+    film_positions: dict[str, int] = {}
+    cinema_positions: dict[str, int] = {}
+
+    def film_position(film: Film) -> int:
+        return _table_position(films, film_positions, [
+            film.title, film.genre, film.directors, film.actors,
+            film.language
+        ])
+
+    def cinema_position(cinema: Cinema) -> int:
+        return _table_position(cinemas, cinema_positions, [
+            cinema.name, cinema.address, *cinema.coord
+        ])
+
+    return {
+        "version": SNAPSHOT_VERSION,
+        "scraped_at": billboard.scraped_at,
+        "projections": [
+            [film_position(p.film), cinema_position(p.cinema), *p.time,
+             p.duration] for p in billboard.projections
+        ],
+        "billboard_films": [film_position(film) for film in billboard.films],
+        "billboard_cinemas": [cinema_position(cinema)
+                              for cinema in billboard.cinemas],
+        "films_titles": sorted(billboard.films_titles),
+        "films": films,
+        "cinemas": cinemas,
+    }
+
+
+def snapshot_to_billboard(snapshot: dict) -> Billboard:
+    """Returns the billboard of snapshot."""
+
+    films = [Film.from_data(*row) for row in snapshot["films"]]
+    cinemas = [Cinema(name, address, (lat, lon))
+               for name, address, lat, lon in snapshot["cinemas"]]
+
+    return Billboard(
+        [films[i] for i in snapshot["billboard_films"]],
+        [cinemas[i] for i in snapshot["billboard_cinemas"]],
+        [Projection.from_data(films[film], cinemas[cinema], (hour, minute),
+                              duration)
+         for film, cinema, hour, minute, duration in snapshot["projections"]],
+        set(snapshot["films_titles"]),
+        snapshot["scraped_at"],
+    )
+
+
+def save_snapshot(billboard: Billboard) -> None:
+    """Writes the snapshot of billboard in FILE_SNAPSHOT_NAME."""
+
+    data = json.dumps(billboard_to_snapshot(billboard),
+                      separators=(",", ":")).encode()
+    cache.atomic_write(cache.cache_path(FILE_SNAPSHOT_NAME),
+                       lambda file: file.write(data))
+
+
+@profiling.timed("billboard.load_snapshot")
+def load_snapshot() -> Billboard | None:
+    """Returns the billboard of FILE_SNAPSHOT_NAME (None if there is no
+    snapshot or it was written by another version)."""
+
+    path = cache.cache_path(FILE_SNAPSHOT_NAME)
+    if not os.path.exists(path):
+        return None
+
+    with open(path, "rb") as file:
+        try:
+            snapshot = json.load(file)
+        except json.JSONDecodeError:
+            return None
+
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return snapshot_to_billboard(snapshot)
+
+
+# billboard scraped by the background refresh, once it has finished
+_refreshed: dict[str, Billboard] = {}
+_refresh_lock = threading.Lock()
+_refresh_thread: threading.Thread | None = None
+
+
+def _refresh(base_url: str) -> None:
+    """Scrapes the billboard and saves its snapshot. If it fails (there is no
+    connection, the pages have changed their format, the snapshot can not be
+    written...) the old snapshot is kept."""
+
+    try:
+        billboard = read_billboard(base_url)
+        save_snapshot(billboard)
+    except (requests.RequestException, OSError, ValueError, KeyError,
+            AttributeError, TypeError):
+        return
+
+    with _refresh_lock:
+        _refreshed["billboard"] = billboard
+
+
+def refresh_in_background(base_url: str = BASE_URL) -> threading.Thread:
+    """Starts scraping the billboard in another thread (unless it is already
+    being scraped). When it finishes, refreshed_billboard returns it."""
+
+    global _refresh_thread
+    if _refresh_thread is None or not _refresh_thread.is_alive():
+        _refresh_thread = threading.Thread(target=_refresh, args=(base_url,),
+                                           daemon=True)
+        _refresh_thread.start()
+    return _refresh_thread
+
+
+def refreshed_billboard() -> Billboard | None:
+    """Returns the billboard scraped by the background refresh if it has
+    finished since the last call, otherwise None."""
 
-                # We obtain and process the sessions hours data
+    with _refresh_lock:
+        return _refreshed.pop("billboard", None)
 
-                list_film_sessions_str = movie.find("ul",
-                                                    {"class": "list_hours"})
 
-                sessions_str = list_film_sessions_str.find_all("em")
+@profiling.timed("billboard.get_billboard")
+def get_billboard(ttl: float = SNAPSHOT_TTL,
+                  base_url: str = BASE_URL) -> Billboard:
+    """Returns the billboard of the last snapshot.
 
-                for session in sessions_str:
-                    projection: Projection = Projection(session, film, cinema)
+    If there is no snapshot, the billboard is scraped (and saved). If the
+    snapshot is older than ttl seconds, it is returned anyway and the
+    billboard is scraped again in the background (see refreshed_billboard).
+    """
 
-                    billboard.add_projection(projection)
+    billboard = load_snapshot()
+    profiling.cache_hit("billboard.snapshot", billboard is not None)
+    if billboard is None:
+        billboard = read_billboard(base_url)
+        save_snapshot(billboard)
+    elif time.time() - billboard.scraped_at > ttl:
+        refresh_in_background(base_url)
 
     return billboard
 
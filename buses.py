@@ -1,10 +1,17 @@
+import json
+import time
 from dataclasses import dataclass
-from typing import TypeAlias, TypeVar
+from typing import BinaryIO, Iterator, TypeAlias, TypeVar
 
-import matplotlib.pyplot as plt
+import ijson
 import networkx as nx
 import requests
-from staticmap import CircleMarker, Line, StaticMap
+from staticmap import CircleMarker, StaticMap
+
+import cache
+import profiling
+from render import (BBox, CachedStaticMap, add_polylines, graph_points,
+                    graph_segments, show_graph)
 
 Coord: TypeAlias = tuple[float, float]  # (latitude, longitude)
 BusesGraph: TypeAlias = nx.Graph
@@ -12,27 +19,153 @@ BusesGraph: TypeAlias = nx.Graph
 T = TypeVar('T')
 
 URL = "https://www.ambmobilitat.cat/OpenData/ObtenirDadesAMB.json"
+TIMEOUT = 60  # seconds
+
+# lines of Barcelona stored in the cache, they are downloaded again when they
+# are older than LINES_TTL
+FILE_LINES_NAME = "BUS_LINES.json"
+LINES_TTL = 7 * 24 * 60 * 60  # seconds
+
+"""
+LINES
+
+The data of the AMB is a JSON document of all the lines of the area, but
+only the stops of Barcelona are used. It is read as it is downloaded (one
+line at a time) and each line is reduced to:
+
+{"Nom": name of the line,
+ "Parades": [[CodAMB, Nom, UTM_X, UTM_Y] or None, ...]}
+
+where None stands for one or more consecutive stops out of Barcelona (they
+are only needed to know that the stops around them are not consecutive).
+Lines without stops in Barcelona are discarded.
+"""
+
+
+def linies_prefix(head: bytes) -> str | None:
+    """Returns the prefix (as in ijson) of the list of lines of the AMB data,
+    given the first bytes of the document, or None if they are not enough
+    to know it.
+
+    The list of lines is data[key0][key1][key2], where key0 is the first key
+    of the document, key1 is the second key of data[key0] and key2 is the
+    first key of data[key0][key1].
+    """
+
+    path: list[str] = []  # key0, key1 and key2 once they are found
+    keys: dict[str, int] = {}  # number of keys read of the maps of path
+    try:
+        for prefix, event, value in ijson.parse(head):
+            if event == "map_key" and prefix == ".".join(path):
+                position = keys.get(prefix, 0)
+                keys[prefix] = position + 1
+                if position == (1 if len(path) == 1 else 0):
+                    path.append(value)
+                    if len(path) == 3:
+                        return ".".join(path)
+    except ijson.IncompleteJSONError:
+        pass
+    return None
+
+
+class _Prefixed:
+    """File that reads head and then the rest of file."""
+
+    def __init__(self, head: bytes, file: BinaryIO) -> None:
+        self.head = head
+        self.file = file
+
+    def read(self, size: int = -1) -> bytes:
+        if self.head and size != 0:
+            data, self.head = self.head, b""
+            return data
+        return self.file.read(size)
+
+
+def stream_linies(file: BinaryIO,
+                  chunk_size: int = 1 << 16) -> Iterator[dict[str, 'T']]:
+    """Yields the bus lines of the AMB data of file one by one, as they are
+    read.
+
+    The beginning of the document is read until the prefix of the lines is
+    known (see linies_prefix), then the lines are decoded by ijson.
+    """
+
+    head = b""
+    prefix = None
+    while prefix is None:
+        chunk = file.read(chunk_size)
+        assert chunk, "Error: the lines of the AMB data were not found"
+        head += chunk
+        prefix = linies_prefix(head)
 
+    yield from ijson.items(_Prefixed(head, file), prefix + ".item",
+                           use_float=True)
 
-def get_data_from_url() -> dict[str, dict[str, 'T']]:
-    """Returns a dictionary of the buses data from the URL.
-    The URL is a constant."""
 
-    response = requests.get(URL)
-    assert response, "Error with URL"
-    return response.json()
+def reduce_linia(linia: dict[str, 'T']) -> dict[str, 'T'] | None:
+    """Returns the line with only the data of its stops of Barcelona (see
+    the format above), or None if it has none."""
 
+    parades: list[list['T'] | None] = []
+    for parada in linia["Parades"]["Parada"]:
+        if parada["Municipi"] == "Barcelona":
+            parades.append([parada["CodAMB"], parada["Nom"],
+                            parada["UTM_X"], parada["UTM_Y"]])
+        elif parades and parades[-1] is not None:
+            parades.append(None)
 
+    if parades and parades[-1] is None:
+        parades.pop()
+    if not parades:
+        return None
+
+    return {"Nom": linia["Nom"], "Parades": parades}
+
+
+@profiling.timed("buses.download_linies")
+def download_linies() -> list[dict[str, 'T']]:
+    """Downloads the data of the AMB and returns its lines with only their
+    stops of Barcelona. The document is never kept whole in memory."""
+
+    with requests.get(URL, stream=True, timeout=TIMEOUT) as response:
+        assert response, "Error with URL"
+        response.raw.decode_content = True
+        return [linia for linia in map(reduce_linia,
+                                       stream_linies(response.raw))
+                if linia is not None]
+
+
+@profiling.timed("buses.get_linies")
 def get_linies() -> list[dict[str, 'T']]:
-    """Returns a list of bus lines"""
+    """Returns a list of bus lines (see the format above).
 
-    data: dict[str, dict[str, 'T']] = get_data_from_url()
-    data = data[list(data.keys())[0]]
+    They are read from the cache unless they are older than LINES_TTL. If
+    they can not be downloaded again, the old ones are used.
+    """
 
-    linies = data[list(data.keys())[1]]
-    return linies[list(linies.keys())[0]]  # llista de diccionaris
+    path = cache.lookup(FILE_LINES_NAME, {"URL": URL})
+    if path is not None:
+        with open(path) as file:
+            data = json.load(file)
+        if time.time() - data["downloaded_at"] <= LINES_TTL:
+            return data["linies"]
 
+    try:
+        linies = download_linies()
+    except requests.RequestException:
+        if path is None:
+            raise
+        return data["linies"]
 
+    data = {"downloaded_at": time.time(), "linies": linies}
+    cache.store(FILE_LINES_NAME, {"URL": URL},
+                lambda file: file.write(json.dumps(
+                    data, separators=(",", ":")).encode()))
+    return linies
+
+
+@profiling.timed("buses.get_buses_graph")
 def get_buses_graph() -> BusesGraph:
     """Downloads the data of the AMB and returns an undirected graph of buses.
     There is a different node for each line in each stop.
@@ -49,44 +182,53 @@ def get_buses_graph() -> BusesGraph:
 
     linies: list[dict[str, 'T']] = get_linies()  # llista de diccionaris
 
+    nodes: list[tuple[str, dict[str, 'T']]] = []
+    edges: list[tuple[str, str, dict[str, 'T']]] = []
+
     for linia in linies:
-        parades_linia: list[dict[str, 'T']] = linia["Parades"]["Parada"]
+        # stops of Barcelona (None are stops out of it)
+        parades_linia: list[list['T'] | None] = linia["Parades"]
 
-        for i, parada in enumerate(parades_linia):
-            if parada["Municipi"] == "Barcelona":
-                buses.add_node(
-                    parada["CodAMB"] + "-" + linia["Nom"],
-                    nom=parada["Nom"],
-                    coord=(parada["UTM_X"], parada["UTM_Y"]),
-                    linia=linia["Nom"],
-                )
+        # the id of each stop is built once
+        ids: list[str | None] = [
+            None if parada is None else parada[0] + "-" + linia["Nom"]
+            for parada in parades_linia
+        ]
 
-                prev_parada = parades_linia[i - 1]
+        for i, parada in enumerate(parades_linia):
+            if parada is not None:
+                _, nom, x, y = parada
+                nodes.append((ids[i], {
+                    "nom": nom,
+                    "coord": (x, y),
+                    "linia": linia["Nom"],
+                }))
 
                 if (
                     i != 0
-                    and prev_parada["Municipi"] == "Barcelona"
-                    and parada["CodAMB"] + "-" + linia["Nom"]
-                    != prev_parada["CodAMB"] + "-" + linia["Nom"]
+                    and parades_linia[i - 1] is not None
+                    and ids[i] != ids[i - 1]
                 ):
-                    buses.add_edge(
-                        parada["CodAMB"] + "-" + linia["Nom"],
-                        prev_parada["CodAMB"] + "-" + linia["Nom"],
-                        linia=linia["Nom"],
-                    )
+                    edges.append((ids[i], ids[i - 1],
+                                  {"linia": linia["Nom"]}))
+
+    # the nodes and edges are added in the same order as they are found
+    buses.add_nodes_from(nodes)
+    buses.add_edges_from(edges)
 
     return buses
 
 
-def show_buses(g: BusesGraph) -> None:
-    """Shows the graph interactively using network.draw
+def show_buses(g: BusesGraph, bbox: BBox | None = None) -> None:
+    """Shows the graph (the part inside bbox, all by default) interactively,
+    with a level of detail that follows the zoom
 
     Note: some nodes are not connected because they belong to lines outside BCN
     """
 
-    positions = nx.get_node_attributes(g, "coord")
-    nx.draw(g, pos=positions, with_labels=False, node_size=10)
-    plt.show()
+    show_graph(graph_segments(g, default="Bus"),
+               graph_points(g, default="Parada"),
+               {"Bus": "blue", "Parada": "green"}, bbox)
 
 
 def plot_buses(g: BusesGraph, nom_fitxer: str) -> None:
@@ -96,17 +238,15 @@ def plot_buses(g: BusesGraph, nom_fitxer: str) -> None:
     Note: coordinates are swapped because staticmap works with lon-lat.
     """
 
-    map = StaticMap(300, 300)
+    map = CachedStaticMap()
 
     # draw nodes
     for pos in nx.get_node_attributes(g, "coord").values():
         map.add_marker(CircleMarker((pos[1], pos[0]), "green", 3))
 
-    # draw edges
-    for edge in g.edges:
-        coord_1 = (g.nodes[edge[0]]["coord"][1], g.nodes[edge[0]]["coord"][0])
-        coord_2 = (g.nodes[edge[1]]["coord"][1], g.nodes[edge[1]]["coord"][0])
-        map.add_line(Line([coord_1, coord_2], "blue", 2))
+    # draw edges, joined in polylines
+    add_polylines(map, {"blue": [(g.nodes[u]["coord"], g.nodes[v]["coord"])
+                                 for u, v in g.edges]})
 
     image = map.render()
     image.save(nom_fitxer)
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Callable
+
+import profiling
+
+"""
+CACHE
+
+The files that take long to build (graphs, indexes...) are stored in
+CACHE_DIR, which can be set with the environment variable CINEBUS_CACHE_DIR.
+
+The manifest (FILE_MANIFEST_NAME) records, for each file, the parameters it
+was built with (constants, hashes of the data it was built from...) and the
+hash of the file. A file is only used if its parameters and CACHE_VERSION are
+the same as the ones requested, so changing any of them rebuilds it.
+
+Files are written to a temporary file and then renamed, so an interrupted
+write never leaves a broken file in the cache.
+"""
+
+CACHE_VERSION = 1
+
+CACHE_DIR = os.environ.get("CINEBUS_CACHE_DIR",
+                           os.path.join(os.getcwd(), "cache"))
+
+FILE_MANIFEST_NAME = "manifest.json"
+
+# the files can be stored from different threads (see demo.py)
+_manifest_lock = threading.RLock()
+
+
+def set_cache_dir(path: str) -> None:
+    """Changes the directory of the cache."""
+
+    global CACHE_DIR
+    CACHE_DIR = path
+
+
+def cache_path(filename: str) -> str:
+    """Returns the path of the file filename in the cache directory."""
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    return os.path.join(CACHE_DIR, filename)
+
+
+def atomic_write(path: str, write: Callable[[BinaryIO], None]) -> None:
+    """Writes the file path with the function write, which receives the file
+    opened in binary mode. The file is replaced only if write finishes."""
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            write(file)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def file_hash(path: str) -> str:
+    """Returns the sha256 of the file path."""
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def data_hash(data: object) -> str:
+    """Returns the sha256 of the representation of data."""
+
+    return hashlib.sha256(repr(data).encode()).hexdigest()
+
+
+def graph_hash(g) -> str:
+    """Returns the sha256 of the nodes and edges of the networkx graph g
+    (with attributes)."""
+
+    digest = hashlib.sha256()
+    for node in g.nodes(data=True):
+        digest.update(repr(node).encode())
+    for edge in g.edges(data=True):
+        digest.update(repr(edge).encode())
+    return digest.hexdigest()
+
+
+def read_manifest() -> dict[str, dict]:
+    """Returns the manifest of the cache (empty if there is none)."""
+
+    path = cache_path(FILE_MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as file:
+        try:
+            return json.load(file)
+        except json.JSONDecodeError:
+            return {}
+
+
+def json_params(params: dict) -> dict:
+    """Returns params as they are recorded in the manifest (tuples become
+    lists...)."""
+
+    return json.loads(json.dumps(params))
+
+
+def lookup(filename: str, params: dict) -> str | None:
+    """Returns the path of the file filename if it is in the cache and it was
+    built with params. Otherwise returns None."""
+
+    entry = read_manifest().get(filename)
+    path = cache_path(filename)
+
+    if (entry is None or not os.path.exists(path)
+            or entry["version"] != CACHE_VERSION
+            or entry["params"] != json_params(params)):
+        profiling.cache_hit(f"cache.{filename}", False)
+        return None
+
+    profiling.cache_hit(f"cache.{filename}", True)
+    return path
+
+
+def entry_hash(filename: str) -> str | None:
+    """Returns the hash of the file filename recorded in the manifest."""
+
+    entry = read_manifest().get(filename)
+    return None if entry is None else entry["hash"]
+
+
+def entry_params(filename: str) -> dict | None:
+    """Returns the parameters of the file filename recorded in the manifest
+    (None if it is not in the cache or it is from another version)."""
+
+    entry = read_manifest().get(filename)
+    if entry is None or entry["version"] != CACHE_VERSION:
+        return None
+    return entry["params"]
+
+
+def store(filename: str, params: dict,
+          write: Callable[[BinaryIO], None]) -> str:
+    """Writes the file filename in the cache with the function write and
+    records it in the manifest with params. Returns the hash of the file."""
+
+    path = cache_path(filename)
+    atomic_write(path, write)
+    digest = file_hash(path)
+
+    with _manifest_lock:
+        manifest = read_manifest()
+        manifest[filename] = {"version": CACHE_VERSION, "params": params,
+                              "hash": digest}
+        atomic_write(cache_path(FILE_MANIFEST_NAME),
+                     lambda file: file.write(json.dumps(manifest,
+                                                        indent=4).encode()))
+    return digest
+
+
+def invalidate(filename: str) -> None:
+    """Removes the file filename from the cache."""
+
+    with _manifest_lock:
+        manifest = read_manifest()
+        if manifest.pop(filename, None) is not None:
+            atomic_write(cache_path(FILE_MANIFEST_NAME),
+                         lambda file: file.write(
+                             json.dumps(manifest, indent=4).encode()
+                         ))
+
+    path = cache_path(filename)
+    if os.path.exists(path):
+        os.remove(path)
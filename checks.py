@@ -0,0 +1,565 @@
+"""Deterministic checks of the fast routines against a brute-force reference.
+
+Run it with `python3 checks.py`. The graphs are small synthetic ones (a grid
+of streets and a few bus lines), so no download is needed and the cache is a
+temporary directory.
+"""
+
+import collections
+import io
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+
+import networkx as nx
+
+import billboard
+import cache
+import city
+import profiling
+
+from benchmarks import PAGES_DIR
+from buses import BusesGraph, reduce_linia, stream_linies
+from city import (ALGORITHMS, PARETO_SLACK, CityGraph, OsmnxGraph,
+                  build_city_graph, dijkstra_from, find_path,
+                  find_pareto_paths, get_weight_buses, nearest_crosswalks,
+                  relaxed_edges, shortest_path, stops_crosswalks,
+                  update_city_graph)
+from compact import _dijkstra, to_compact
+from hierarchy import build_hierarchy
+
+SEED = 42
+PAIRS = 200
+
+# south-west corner of the synthetic graphs and distance between streets
+CORNER = (41.38, 2.15)
+STEP = 0.001
+
+
+def synthetic_osmnx_graph(n: int, seed: int = SEED) -> OsmnxGraph:
+    """Returns a grid of n x n crosswalks with some streets missing, in the
+    format of osmnx (coordinates x, y and edges in both directions)."""
+
+    rng = random.Random(seed)
+    g = OsmnxGraph(crs="epsg:4326")
+    for i in range(n):
+        for j in range(n):
+            g.add_node(i * n + j + 1,
+                       y=CORNER[0] + i * STEP + rng.uniform(-0.2, 0.2) * STEP,
+                       x=CORNER[1] + j * STEP + rng.uniform(-0.2, 0.2) * STEP)
+    for i in range(n):
+        for j in range(n):
+            u = i * n + j + 1
+            if j + 1 < n and rng.random() < 0.9:
+                g.add_edge(u, u + 1, name=f"Carrer {i}")
+                g.add_edge(u + 1, u, name=f"Carrer {i}")
+            if i + 1 < n and rng.random() < 0.9:
+                g.add_edge(u, u + n)
+                g.add_edge(u + n, u)
+    return g
+
+
+def synthetic_buses_graph(n: int, lines: int,
+                          seed: int = SEED) -> BusesGraph:
+    """Returns lines bus lines of 10 stops each over the grid of
+    synthetic_osmnx_graph(n), some of the stops shared by several lines."""
+
+    rng = random.Random(seed)
+    stops = [(f"P{k}", (CORNER[0] + rng.random() * n * STEP,
+                        CORNER[1] + rng.random() * n * STEP))
+             for k in range(4 * lines)]
+    g = BusesGraph()
+    for linia in range(lines):
+        previous = None
+        for nom, coord in rng.sample(stops, 10):
+            node = f"{nom}-L{linia}"
+            g.add_node(node, nom=nom, coord=coord, linia=f"L{linia}")
+            if previous is not None:
+                g.add_edge(node, previous, linia=f"L{linia}")
+            previous = node
+    return g
+
+
+def changed_buses_graph(g: BusesGraph, seed: int = SEED) -> BusesGraph:
+    """Returns a copy of the buses graph g with some stops removed, a stop
+    moved, an edge removed and a new stop of two lines."""
+
+    rng = random.Random(seed)
+    changed = g.copy()
+    nodes = sorted(changed.nodes)
+    changed.remove_nodes_from(rng.sample(nodes, 3))
+
+    moved = rng.choice(sorted(changed.nodes))
+    lat, lon = changed.nodes[moved]["coord"]
+    changed.nodes[moved]["coord"] = (lat + 2 * STEP, lon)
+
+    changed.remove_edge(*rng.choice(sorted(changed.edges)))
+
+    for linia in ("L0", "L1"):
+        changed.add_node(f"P-{linia}", nom="P", coord=CORNER, linia=linia)
+    first = sorted(node for node in changed if node.endswith("-L0"))[0]
+    changed.add_edge("P-L0", first, linia="L0")
+    return changed
+
+
+def reduced_buses_graph(g: BusesGraph, seed: int = SEED) -> BusesGraph:
+    """Returns a copy of the buses graph g with some stops and an edge
+    removed (no stop is added)."""
+
+    rng = random.Random(seed)
+    reduced = g.copy()
+    reduced.remove_nodes_from(rng.sample(sorted(reduced.nodes), 2))
+    reduced.remove_edge(*rng.choice(sorted(reduced.edges)))
+    return reduced
+
+
+def _graph_data(g: CityGraph) -> tuple[dict, dict]:
+    """Returns the type and coordinates of each node and the type and weight
+    of each edge of g (the edges as frozensets of their ends)."""
+
+    nodes = {node: (attr["type"], attr["coord"])
+             for node, attr in g.nodes(data=True)}
+    edges = {frozenset((u, v)): (attr["type"], attr["weight"])
+             for u, v, attr in g.edges(data=True)}
+    return nodes, edges
+
+
+def check_update(g1: OsmnxGraph, g2: BusesGraph) -> None:
+    """Checks that updating the city graph of g1 and g2 to other buses gives
+    the same graph as building it from them (with stops added, moved and
+    removed, and with stops and edges only removed)."""
+
+    for changed in (changed_buses_graph(g2), reduced_buses_graph(g2)):
+        _check_update(g1, g2, changed)
+
+
+def _check_update(g1: OsmnxGraph, g2: BusesGraph,
+                  changed: BusesGraph) -> None:
+    """Checks that updating the city graph of g1 and g2 to changed gives the
+    same graph as building it from g1 and changed."""
+
+    city = build_city_graph(g1, g2)
+    update = update_city_graph(city, changed)
+
+    cache_dir = cache.CACHE_DIR
+    cache.set_cache_dir(tempfile.mkdtemp())
+    try:
+        built = build_city_graph(g1, changed)
+    finally:
+        cache.set_cache_dir(cache_dir)
+
+    (nodes, edges), (expected_nodes, expected_edges) = \
+        _graph_data(city), _graph_data(built)
+    assert nodes == expected_nodes, 'Error: the nodes are not the same'
+    assert edges.keys() == expected_edges.keys(), \
+        'Error: the edges are not the same'
+    for edge, (tipus, weight) in edges.items():
+        expected = expected_edges[edge]
+        assert tipus == expected[0] and math.isclose(weight, expected[1]), \
+            f'Error: edge {set(edge)} is {(tipus, weight)}, not {expected}'
+    print(f"update: {len(update.added_stops)} stops added, "
+          f"{len(update.removed_stops)} removed, as a full build")
+
+
+def synthetic_amb_data(lines: int, seed: int = SEED) -> bytes:
+    """Returns a JSON document with the format of the AMB data: lines of 15
+    stops, some of them out of Barcelona, and other data around them."""
+
+    rng = random.Random(seed)
+    municipis = ["Barcelona", "Barcelona", "Badalona", "L'Hospitalet"]
+    stops = [{"CodAMB": str(1000 + k), "Nom": f"Parada {k}",
+              "Municipi": rng.choice(municipis),
+              "UTM_X": CORNER[0] + rng.random() / 10,
+              "UTM_Y": CORNER[1] + rng.random() / 10}
+             for k in range(10 * lines)]
+    linies = [{"Codi": linia, "Nom": f"V{linia}", "Descripcio": "Línia",
+               "Parades": {"Parada": [dict(stop, Ordre=i) for i, stop
+                                      in enumerate(rng.sample(stops, 15))]}}
+              for linia in range(lines)]
+    data = {"ObtenirDadesAMBResult": {"Dades": {"Versio": 1},
+                                      "Linies": {"Linia": linies},
+                                      "Altres": [1, 2]}}
+    return json.dumps(data).encode()
+
+
+def _reduced_linies(data: bytes) -> list[dict]:
+    """Returns the lines of the AMB data reduced as in buses.reduce_linia,
+    decoding the whole document at once."""
+
+    linies = []
+    for linia in json.loads(data)["ObtenirDadesAMBResult"]["Linies"]["Linia"]:
+        parades = []
+        for barcelona, group in itertools.groupby(
+                linia["Parades"]["Parada"],
+                key=lambda parada: parada["Municipi"] == "Barcelona"):
+            if barcelona:
+                parades += [[parada["CodAMB"], parada["Nom"],
+                             parada["UTM_X"], parada["UTM_Y"]]
+                            for parada in group]
+            else:
+                parades.append(None)
+        while parades and parades[0] is None:
+            parades.pop(0)
+        while parades and parades[-1] is None:
+            parades.pop()
+        if parades:
+            linies.append({"Nom": linia["Nom"], "Parades": parades})
+    return linies
+
+
+def check_stream(lines: int = 20) -> None:
+    """Checks that the lines streamed from the AMB data (read in chunks of
+    different sizes) are the ones of decoding the whole document."""
+
+    data = synthetic_amb_data(lines)
+    expected = _reduced_linies(data)
+    for chunk_size in (1, 7, 100, 1 << 16):
+        streamed = stream_linies(io.BytesIO(data), chunk_size)
+        linies = [linia for linia in map(reduce_linia, streamed)
+                  if linia is not None]
+        assert linies == expected, \
+            f'Error: the lines streamed in chunks of {chunk_size} differ'
+    print(f"stream: {len(expected)} lines as json.loads")
+
+
+def check_algorithms(g: CityGraph, pairs: int = PAIRS) -> None:
+    """Checks that every algorithm of find_path gives the minutes of the
+    Dijkstra of networkx, with a path of the graph that takes them."""
+
+    rng = random.Random(SEED)
+    cruilles = sorted(attr["coord"] for _, attr in g.nodes(data=True)
+                      if attr["type"] == "Cruilla")
+    for _ in range(pairs):
+        src, dst = rng.choice(cruilles), rng.choice(cruilles)
+        source, target = nearest_crosswalks(g, [src, dst])
+        expected = nx.shortest_path_length(g, source, target,
+                                           weight="weight")
+        for algorithm in ALGORITHMS:
+            nodes_path, minutes = find_path(None, g, src, dst, algorithm)
+            length = sum(g.edges[u, v]["weight"]
+                         for u, v in zip(nodes_path, nodes_path[1:]))
+            assert (nodes_path[0], nodes_path[-1]) == (source, target)
+            assert math.isclose(minutes, expected, abs_tol=1e-9) \
+                and math.isclose(length, minutes, abs_tol=1e-9), \
+                f'Error: {algorithm} takes {minutes}, not {expected}'
+    print(f"find_path: {pairs} queries with {len(ALGORITHMS)} algorithms "
+          f"as networkx")
+
+
+def check_bus_weights(g: CityGraph) -> None:
+    """Checks the weights of the edges "Bus" of g against the search of
+    networkx for each edge (between the crosswalks of its stops, as
+    add_weights_buses did before grouping the searches), done on a copy of g
+    with the edges "Bus" unweighted and without the transfers."""
+
+    reference = g.copy()
+    reference.remove_nodes_from([node for node, tipus
+                                 in g.nodes(data="type")
+                                 if tipus == "Intercanvi"])
+    reference.remove_edges_from([(u, v) for u, v, tipus
+                                 in g.edges(data="type")
+                                 if tipus == "Transbord"])
+    bus_edges = [(u, v) for u, v, tipus in reference.edges(data="type")
+                 if tipus == "Bus"]
+    for u, v in bus_edges:
+        reference.edges[u, v]["weight"] = float("inf")
+
+    crosswalks = stops_crosswalks(reference)
+    for u, v in bus_edges:
+        reference.edges[u, v]["weight"] = nx.shortest_path_length(
+            reference, crosswalks[u], crosswalks[v], weight=get_weight_buses
+        )
+        assert math.isclose(g.edges[u, v]["weight"],
+                            reference.edges[u, v]["weight"], abs_tol=1e-9), \
+            f'Error: the weight of {u} - {v} is {g.edges[u, v]["weight"]}, ' \
+            f'not {reference.edges[u, v]["weight"]}'
+    print(f"buses: {len(bus_edges)} edges weighted as a search for each one")
+
+
+def check_hubs(g1: OsmnxGraph, g2: BusesGraph, sources: int = 20) -> None:
+    """Checks that joining the lines of a stop through a hub gives the same
+    minutes between every pair of nodes (other than hubs) as joining each
+    pair of lines, for several values of HUB_MIN_LINES."""
+
+    hub_min_lines = city.HUB_MIN_LINES
+    try:
+        city.HUB_MIN_LINES = sys.maxsize  # no hubs
+        pairwise = build_city_graph(g1, g2)
+        rng = random.Random(SEED)
+        nodes = rng.sample(sorted(pairwise.nodes, key=str), sources)
+        expected = [nx.single_source_dijkstra_path_length(pairwise, node)
+                    for node in nodes]
+
+        for value in (4, 2):
+            city.HUB_MIN_LINES = value
+            g = build_city_graph(g1, g2)
+            hubs = sum(1 for _, tipus in g.nodes(data="type")
+                       if tipus == "Intercanvi")
+            for node, minutes in zip(nodes, expected):
+                found = nx.single_source_dijkstra_path_length(g, node)
+                assert all(math.isclose(found[other], minutes[other],
+                                        abs_tol=1e-9)
+                           for other in minutes), \
+                    f'Error: the minutes from {node} change with hubs'
+            print(f"hubs: {hubs} hubs with HUB_MIN_LINES={value}, "
+                  f"minutes from {sources} nodes as joining every pair")
+    finally:
+        city.HUB_MIN_LINES = hub_min_lines
+
+
+def check_profiling(g: CityGraph, searches: int = 20,
+                    cutoff: float = 10.0) -> None:
+    """Checks the counters of profiling: the calls of dijkstra_from, the
+    nodes it settles (against the nodes at most cutoff minutes away, found
+    by networkx) and the edges relaxed by each algorithm of shortest_path
+    (against relaxed_edges)."""
+
+    rng = random.Random(SEED)
+    nodes = sorted(g.nodes, key=str)
+    sources = [rng.choice(nodes) for _ in range(searches)]
+    targets = [rng.choice(nodes) for _ in range(searches)]
+
+    profiling.reset()
+    profiling.enable()
+    try:
+        for source in sources:
+            dijkstra_from(g, source, cutoff=cutoff)
+        for algorithm in ALGORITHMS:
+            for source, target in zip(sources, targets):
+                shortest_path(g, source, target, algorithm)
+        report = profiling.report()
+    finally:
+        profiling.disable()
+        profiling.reset()
+
+    settled = sum(len(nx.single_source_dijkstra_path_length(
+                      g, source, cutoff=cutoff, weight="weight"))
+                  for source in sources)
+    counters = report["counters"]
+    assert report["stages"]["city.dijkstra_from"]["calls"] == searches
+    assert counters["city.dijkstra_from.settled"] == settled, \
+        f'Error: {counters["city.dijkstra_from.settled"]} nodes settled ' \
+        f'counted, not {settled}'
+    for algorithm in ALGORITHMS:
+        relaxed = sum(relaxed_edges(g, source, target, algorithm)
+                      for source, target in zip(sources, targets))
+        counted = counters[f"city.shortest_path.relaxed.{algorithm}"]
+        assert counted == relaxed, \
+            f'Error: {counted} edges relaxed by {algorithm}, not {relaxed}'
+    print(f"profiling: {settled} nodes settled and the edges relaxed by "
+          f"{len(ALGORITHMS)} algorithms as counted")
+
+
+def _step(g: CityGraph, u, v) -> tuple[float, int, float]:
+    """Returns the minutes, transfers and walking minutes of the edge u - v
+    (as defined by find_pareto_paths)."""
+
+    attr = g.edges[u, v]
+    transfer = (attr["type"] == "Transbord"
+                and g.nodes[u]["type"] != "Intercanvi")
+    walking = attr["weight"] if attr["type"] == "Carrer" else 0.0
+    return attr["weight"], int(transfer), walking
+
+
+def _covers(a: tuple, b: tuple) -> bool:
+    """Returns whether the criteria a are at most b in each component."""
+
+    return all(x <= y + 1e-9 for x, y in zip(a, b))
+
+
+def _exhaustive_pareto(g: CityGraph, source, target,
+                       bound: float) -> list[tuple[float, int, float]]:
+    """Returns the criteria of the Pareto set of routes from source to
+    target of at most bound minutes, found by a label-correcting search that
+    keeps every label not dominated in its node (no bound from target and
+    no limit of labels)."""
+
+    bags: dict = {source: [(0.0, 0, 0.0)]}
+    queue = collections.deque([(source, (0.0, 0, 0.0))])
+    while queue:
+        u, criteria = queue.popleft()
+        if criteria not in bags[u]:
+            continue  # dominated after it was queued
+        for v in g.adj[u]:
+            new = tuple(c + s for c, s in zip(criteria, _step(g, u, v)))
+            bag = bags.setdefault(v, [])
+            if new[0] > bound + 1e-9 or any(_covers(b, new) for b in bag):
+                continue
+            bags[v] = [b for b in bag if not _covers(new, b)] + [new]
+            queue.append((v, new))
+    return sorted(bags.get(target, []))
+
+
+def check_pareto(g: CityGraph, pairs: int = 20) -> None:
+    """Checks that the routes of find_pareto_paths (without limit of labels)
+    are the Pareto set found by an exhaustive search, and that the criteria
+    of each route are the ones of its edges."""
+
+    rng = random.Random(SEED)
+    cruilles = sorted(attr["coord"] for _, attr in g.nodes(data=True)
+                      if attr["type"] == "Cruilla")
+    routes_found = 0
+    for _ in range(pairs):
+        src, dst = rng.choice(cruilles), rng.choice(cruilles)
+        source, target = nearest_crosswalks(g, [src, dst])
+        routes = find_pareto_paths(None, g, src, dst,
+                                   max_labels=sys.maxsize)
+        routes_found += len(routes)
+        if not routes:
+            continue
+
+        found = []
+        for route in routes:
+            nodes_path, minutes = route.path
+            criteria = (minutes, route.transfers, route.walking)
+            totals = (0.0, 0, 0.0)
+            for u, v in zip(nodes_path, nodes_path[1:]):
+                totals = tuple(t + s for t, s in zip(totals, _step(g, u, v)))
+            assert (nodes_path[0], nodes_path[-1]) == (source, target)
+            assert _covers(totals, criteria) and _covers(criteria, totals), \
+                f'Error: the route has {criteria}, its edges {totals}'
+            found.append(criteria)
+
+        found.sort()
+        expected = _exhaustive_pareto(g, source, target,
+                                      routes[0].path[1] * PARETO_SLACK)
+        assert len(found) == len(expected) and all(
+            _covers(a, b) and _covers(b, a) for a, b in zip(found, expected)
+        ), f'Error: {found} is not the Pareto set {expected}'
+    print(f"pareto: {routes_found} routes of {pairs} queries as an "
+          f"exhaustive search")
+
+
+def _fixture_pages(directory: str = PAGES_DIR) -> list[billboard.Page]:
+    """Returns the pages of directory parsed."""
+
+    pages = []
+    for filename in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, filename), "rb") as file:
+            pages.append(billboard.parse_page(file.read()))
+    return pages
+
+
+def _check_searches(board: billboard.Billboard) -> int:
+    """Checks the searches of board against a scan of its projections.
+    Returns the number of searches checked."""
+
+    projections = board.projections
+    words = sorted({title[i:i + n] for title in board.films_titles
+                    for n in (1, 2, 3, 6) for i in range(0, len(title), 5)})
+    words += ["", "OPPEN", "xyz", "Misión"]
+    times = [(hour, minute) for hour in range(24) for minute in (0, 25)]
+    durations = range(0, 250, 10)
+
+    searches = 0
+    for word in words:
+        expected = [projection for projection in projections
+                    if word.lower() in projection.film.title.lower()]
+        assert board.search_projection_by_word(word) == expected, \
+            f'Error: search_projection_by_word({word!r})'
+        searches += 1
+    for starting_time in times:
+        expected = [projection for projection in projections
+                    if starting_time <= projection.time]
+        assert board.search_projection_by_time(starting_time) == expected, \
+            f'Error: search_projection_by_time({starting_time})'
+        searches += 1
+    for duration in durations:
+        expected = [projection for projection in projections
+                    if duration >= projection.duration]
+        assert board.search_projection_by_duration(duration) == expected, \
+            f'Error: search_projection_by_duration({duration})'
+        searches += 1
+
+    rng = random.Random(SEED)
+    cinemas = sorted({projection.cinema.name for projection in projections})
+    languages = sorted({projection.language for projection in projections})
+    for _ in range(200):
+        word = rng.choice([None] + words)
+        starting_time, ending_time = rng.choice([None] + times), \
+            rng.choice([None] + times)
+        duration = rng.choice([None, *durations])
+        cinema = rng.choice([None] + cinemas)
+        language = rng.choice([None] + languages)
+        expected = [
+            projection for projection in projections
+            if (word is None or word.lower() in projection.film.title.lower())
+            and (starting_time is None or starting_time <= projection.time)
+            and (ending_time is None or projection.time <= ending_time)
+            and (duration is None or projection.duration <= duration)
+            and cinema in (None, projection.cinema.name)
+            and language in (None, projection.language)
+        ]
+        found = board.search_projections(word, starting_time, ending_time,
+                                         duration, cinema, language)
+        assert found == expected, 'Error: search_projections(' \
+            f'{word!r}, {starting_time}, {ending_time}, {duration}, ' \
+            f'{cinema!r}, {language!r})'
+        searches += 1
+    return searches
+
+
+def check_billboard() -> None:
+    """Checks that the indexed searches of a billboard of the fixture pages
+    return the same projections, in the same order, as scanning all of
+    them, before and after adding more projections."""
+
+    pages = _fixture_pages()
+    board = billboard.merge_pages(pages[:-1])
+    searches = _check_searches(board)
+    for projection in billboard.merge_pages(pages[-1:]).projections:
+        board.add_projection(projection)
+    searches += _check_searches(board)
+    print(f"billboard: {searches} searches as a scan")
+
+
+def check_hierarchy(g: CityGraph, pairs: int = PAIRS) -> None:
+    """Checks that the contraction hierarchy finds paths as short as the
+    ones of Dijkstra, and that they are paths of the graph."""
+
+    cg = to_compact(g)
+    ch = build_hierarchy(cg)
+    rng = random.Random(SEED)
+    for _ in range(pairs):
+        source, target = rng.randrange(len(cg)), rng.randrange(len(cg))
+        path, minutes = ch.query(source, target)
+        expected = _dijkstra(cg, source, target)[1]
+        assert math.isclose(minutes, expected, abs_tol=1e-9), \
+            f'Error: hierarchy {minutes} != dijkstra {expected}'
+        if path:
+            assert (path[0], path[-1]) == (source, target)
+            length = sum(
+                min(cg.weights[j] for j in range(cg.offsets[u],
+                                                 cg.offsets[u + 1])
+                    if cg.targets[j] == v)
+                for u, v in zip(path, path[1:])
+            )
+            assert math.isclose(length, minutes, abs_tol=1e-9), \
+                f'Error: the path does not take {minutes} minutes'
+    print(f"hierarchy: {pairs} queries as dijkstra")
+
+
+def main() -> None:
+    """Runs every check."""
+
+    cache.set_cache_dir(tempfile.mkdtemp())
+    osmx_g, buses_g = synthetic_osmnx_graph(20), synthetic_buses_graph(20, 8)
+    city_g = build_city_graph(osmx_g, buses_g)
+
+    check_bus_weights(city_g)
+    check_algorithms(city_g)
+    check_hierarchy(city_g)
+    check_update(osmx_g, buses_g)
+    check_hubs(osmx_g, buses_g)
+    check_stream()
+    check_billboard()
+    check_profiling(city_g)
+    check_pareto(city_g)
+
+
+if __name__ == "__main__":
+    main()
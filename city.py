@@ -1,16 +1,25 @@
+import gc
 import heapq
 import itertools
 import math
 import os
 import pickle
+from dataclasses import dataclass
 from random import randint
 from typing import TypeAlias, TypeVar
 
 import networkx as nx
-import osmnx as ox
+import numpy as np
 from haversine import haversine
 
+import cache
+import profiling
+from billboard import (CINEMAS_LOCATION, Billboard, Projection,
+                       calculate_time)
 from buses import *
+from render import (BBox, CachedStaticMap, add_polylines, cached_render,
+                    graph_points, graph_segments, show_graph)
+from spatial import SpatialIndex, build_spatial_index, haversine_array
 
 
 OsmnxGraph: TypeAlias = nx.MultiDiGraph
@@ -22,8 +31,26 @@ BUS_SPEED = 15  # km/h
 
 BUS_WAIT_TIME = 8.0  # minutes
 
+# stops with at least HUB_MIN_LINES lines are joined through a hub (see
+# add_weights_buses)
+HUB_MIN_LINES = 4
+
+# searches of find_path
+ALGORITHMS: tuple[str, ...] = ("dijkstra", "bidirectional", "astar")
+
+# routes of find_pareto_paths: at most PARETO_SLACK times the minutes of the
+# fastest one, keeping at most PARETO_MAX_LABELS labels in each node
+PARETO_SLACK = 1.5
+PARETO_MAX_LABELS = 4
+
 FILE_OSMNX_NAME = "barcelona.grf"
-FILE_CITY_NAME = "CITY_GRAPH"
+FILE_CITY_NAME = "CITY_GRAPH.pickle"
+FILE_INDEX_NAME = "SPATIAL_INDEX"
+
+# parameters of the download of the streets of Barcelona
+OSMNX_PARAMS: dict[str, str | bool] = {
+    "place": "Barcelona", "network_type": "walk", "simplify": True
+}
 
 """
 COORDINATES SYSTEMS
@@ -33,6 +60,7 @@ BUSES -> 41, 2 UTM
 haversine -> lat - lon
 STATICMAP -> 2, 41 lon - lat
 ox.distance.nearest_nodes -> 2, 41 lon - lat
+SpatialIndex -> 41, 2 lat - lon
 """
 
 
@@ -45,19 +73,24 @@ def delete_geometry(g: OsmnxGraph) -> None:
             del (g[u][v][key]["geometry"])
 
 
+@profiling.timed("city.get_osmnx_graph")
 def get_osmnx_graph() -> OsmnxGraph:
-    """Returns a graph of the streets of Barcelona. If it is in a file
-    in the current directory, it is loaded. Otherwise it is downloaded from
-    internet and saved in FILE_OSMNX_NAME.
+    """Returns a graph of the streets of Barcelona. If it is in the cache,
+    it is loaded. Otherwise it is downloaded from internet and saved in
+    FILE_OSMNX_NAME.
 
-    The graph returned has no geometry attribute nor self loops.
+    The graph returned has no geometry attribute nor self loops. Its
+    attribute "hash" is the hash of the file of the cache.
     """
-    path = os.getcwd() + "\\" + FILE_OSMNX_NAME
-    if os.path.exists(path):
-        return load_graph(FILE_OSMNX_NAME)
+    path = cache.lookup(FILE_OSMNX_NAME, OSMNX_PARAMS)
+    if path is not None:
+        g: OsmnxGraph = load_graph(path)
     else:
-        g: OsmnxGraph = ox.graph_from_place(
-            "Barcelona", network_type="walk", simplify=True
+        import osmnx as ox  # slow to import, only needed to download
+
+        g = ox.graph_from_place(
+            OSMNX_PARAMS["place"], network_type=OSMNX_PARAMS["network_type"],
+            simplify=OSMNX_PARAMS["simplify"]
         )
 
         delete_geometry(g)
@@ -65,49 +98,143 @@ def get_osmnx_graph() -> OsmnxGraph:
         # there were self loops in g
         g.remove_edges_from(nx.selfloop_edges(g))
 
-        save_graph(g, FILE_OSMNX_NAME)
-        return g
+        save_graph(g, FILE_OSMNX_NAME, OSMNX_PARAMS)
 
+    g.graph["hash"] = cache.entry_hash(FILE_OSMNX_NAME)
+    return g
 
-def save_graph(g: OsmnxGraph | CityGraph, filename: str) -> None:
-    """Saves graph g in file filename"""
 
-    pickle_out = open(filename, "wb")
-    pickle.dump(g, pickle_out)
-    pickle_out.close()
+def save_graph(g: OsmnxGraph | CityGraph, filename: str,
+               params: dict) -> str:
+    """Saves graph g in the file filename of the cache, built with params
+    (see cache.store), and returns the hash of the file."""
+
+    return cache.store(
+        filename, params,
+        lambda file: pickle.dump(g, file, pickle.HIGHEST_PROTOCOL)
+    )
 
 
 def load_graph(filename: str) -> OsmnxGraph | CityGraph:
-    """Returns the graph stored in file filename"""
+    """Returns the graph stored in file filename
+
+    The garbage collector is paused meanwhile: the graph is made of many
+    small dicts, and its passes over them take most of the time.
+    """
+
+    assert os.path.exists(filename), f'Error: {filename} does not exist'
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with open(filename, "rb") as pickle_in:
+            return pickle.load(pickle_in)
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def city_params(g1: OsmnxGraph, g2: BusesGraph) -> dict[str, float | str]:
+    """Returns the parameters the city graph is built with: the constants of
+    the weights and the hashes of g1 and g2."""
+
+    return {
+        "WALK_SPEED": WALK_SPEED,
+        "BUS_SPEED": BUS_SPEED,
+        "BUS_WAIT_TIME": BUS_WAIT_TIME,
+        "HUB_MIN_LINES": HUB_MIN_LINES,
+        "osmnx": g1.graph.get("hash") or cache.graph_hash(g1),
+        "buses": cache.graph_hash(g2),
+    }
+
+
+@profiling.timed("city.load_city_graph")
+def load_city_graph(params: dict[str, float | str]) -> CityGraph | None:
+    """Returns the city graph stored in the cache if it was built with
+    params. Otherwise returns None.
+
+    Its attribute "hash" is the hash of the file of the cache.
+    """
 
-    path = os.getcwd() + "\\" + FILE_OSMNX_NAME
-    assert os.path.exists(path), f'Error: {filename} does not exist'
+    path = cache.lookup(FILE_CITY_NAME, params)
+    if path is None:
+        return None
 
-    pickle_in = open(filename, "rb")
-    return pickle.load(pickle_in)
+    city: CityGraph = load_graph(path)
+    city.graph["hash"] = cache.entry_hash(FILE_CITY_NAME)
 
+    path = cache.lookup(FILE_INDEX_NAME, {"city": city.graph["hash"]})
+    if path is not None:
+        city.graph["spatial_index"] = load_graph(path)
 
-def join_stop_crosswalk(city, buses, cruilles) -> None:
+    return city
+
+
+@profiling.timed("city.save_city_graph")
+def save_city_graph(city: CityGraph, params: dict[str, float | str]) -> None:
+    """Saves the city graph and its spatial index in the cache.
+
+    The attribute "hash" of the graph is set to the hash of the file.
+    """
+
+    # what is kept in the graph attributes is not saved with it (the hash
+    # changes and the spatial index has its own file)
+    attributes = dict(city.graph)
+    city.graph.clear()
+    try:
+        digest = save_graph(city, FILE_CITY_NAME, params)
+    finally:
+        city.graph.update(attributes)
+    city.graph["hash"] = digest
+    index = spatial_index(city)
+    cache.store(FILE_INDEX_NAME, {"city": city.graph["hash"]},
+                lambda file: pickle.dump(index, file,
+                                         pickle.HIGHEST_PROTOCOL))
+
+
+def spatial_index(g: CityGraph) -> SpatialIndex:
+    """Returns the spatial index of the crosswalks of g. It is built the
+    first time and kept in the graph, and it is saved in the cache with the
+    graph (see save_city_graph)."""
+
+    if "spatial_index" not in g.graph:
+        profiling.count("city.spatial_index_builds")
+        cruilles = [(node, attr["coord"]) for node, attr in g.nodes(data=True)
+                    if attr["type"] == "Cruilla"]
+        g.graph["spatial_index"] = build_spatial_index(
+            [cruilla[0] for cruilla in cruilles],
+            [cruilla[1] for cruilla in cruilles]
+        )
+
+    return g.graph["spatial_index"]
+
+
+def join_stop_crosswalk(city, buses) -> dict[str, int]:
     """Each stop is joined with the closest crosswalk. The
     type of the edges between them is "Carrer". The weight is also set.
+
+    Returns a dictionary with the crosswalk joined to each stop.
     """
 
     parades = sorted(buses.nodes(data=True))
-    X = [parada[1]["coord"][1] for parada in parades]
-    Y = [parada[1]["coord"][0] for parada in parades]
 
-    # ox.distance.nearest_nodes uses lon-lat, so we swap the coordinates
-    nearest_cruilles = ox.distance.nearest_nodes(cruilles, X, Y,
-                                                 return_dist=False)
-    weights = [haversine(parada[1]["coord"], city.nodes[cruilla]["coord"])
-               / WALK_SPEED * 60
-               for parada, cruilla in zip(parades, nearest_cruilles)]
+    nearest_cruilles = nearest_crosswalks(
+        city, [parada[1]["coord"] for parada in parades]
+    )
+    weights = (haversine_array(
+        np.array([parada[1]["coord"] for parada in parades], dtype=float),
+        np.array([city.nodes[cruilla]["coord"]
+                  for cruilla in nearest_cruilles], dtype=float)
+    ).reshape(-1) / WALK_SPEED * 60).tolist()
 
     city.add_weighted_edges_from(list(
                                       zip([parada[0] for parada in parades],
                                           nearest_cruilles, weights)
                                      ), type="Carrer")
 
+    return {parada[0]: cruilla
+            for parada, cruilla in zip(parades, nearest_cruilles)}
+
 
 def get_weight_buses(a, b, attr):
     """Used to estimate the time taken to go from one bus stop to another.
@@ -144,7 +271,81 @@ def group_substops(city: CityGraph) -> dict[str, list[str]]:
     return parades
 
 
-def add_weights_buses(city: CityGraph) -> None:
+def stops_crosswalks(city: CityGraph) -> dict[str, int]:
+    """Returns a dictionary with the crosswalk joined to each stop.
+
+    From all the edges of a stop, the only one of type "Carrer" is the one
+    that joins it with its closest crosswalk (see join_stop_crosswalk).
+    """
+
+    crosswalks: dict[str, int] = {}
+    for u, v, tipus in city.edges(data="type"):
+        if tipus == "Carrer":
+            if city.nodes[u]["type"] == "Parada":
+                crosswalks[u] = v
+            elif city.nodes[v]["type"] == "Parada":
+                crosswalks[v] = u
+
+    return crosswalks
+
+
+def walking_adjacency(city: CityGraph) -> dict[int, list[tuple[int, float]]]:
+    """Returns the adjacency lists of the crosswalks through the edges of
+    type "Carrer", weighted as in get_weight_buses.
+
+    When the weights of the buses are calculated every edge of type "Bus"
+    still has weight=float('inf'), and a stop is only joined to its closest
+    crosswalk, so no shortest path between crosswalks goes through a stop.
+    """
+
+    adj: dict[int, list[tuple[int, float]]] = {
+        node: [] for node, tipus in city.nodes(data="type")
+        if tipus == "Cruilla"
+    }
+    for u, v, attr in city.edges(data=True):
+        if u in adj and v in adj and attr["type"] == "Carrer":
+            weight = get_weight_buses(u, v, attr)
+            adj[u].append((v, weight))
+            adj[v].append((u, weight))
+
+    return adj
+
+
+def bounded_dijkstra(adj: dict[int, list[tuple[int, float]]], source: int,
+                     targets: set[int]) -> dict[int, float]:
+    """Returns the distance from source to each of the targets. The search
+    stops as soon as all the targets are settled.
+
+    Unreachable targets have distance float('inf').
+    """
+
+    dist: dict[int, float] = {source: 0.0}
+    settled: set[int] = set()
+    pending: set[int] = set(targets)
+    heap: list[tuple[float, int]] = [(0.0, source)]
+
+    while heap and pending:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        pending.discard(u)
+
+        for v, weight in adj[u]:
+            if d + weight < dist.get(v, float("inf")):
+                dist[v] = d + weight
+                heapq.heappush(heap, (d + weight, v))
+
+    profiling.count("city.bounded_dijkstra.settled", len(settled))
+    return {target: dist[target] if target in settled else float("inf")
+            for target in targets}
+
+
+@profiling.timed("city.add_weights_buses")
+def add_weights_buses(city: CityGraph,
+                      crosswalks: dict[str, int] | None = None,
+                      processes: int | None = 1,
+                      edges: list[tuple[str, str]] | None = None) -> None:
     """The attribute weight of edges connecting stops is set.
 
     stop1-lineA and stop1-lineB edge has weight = BUS_WAIT_TIME
@@ -154,50 +355,80 @@ def add_weights_buses(city: CityGraph) -> None:
     although one can travel between them with the route:
     stop1-lineA -> stop1-lineB -> stop2-lineB or
     stop1-lineA -> stop2-lineA -> stop2-lineB
+
+    The edges of type "Bus" are grouped by the crosswalk of their first stop,
+    so only one search is done for each crosswalk. crosswalks is the
+    crosswalk of each stop (it is calculated if it is not given).
+
+    If processes is not 1 the searches are done in a pool of processes
+    (None uses all the cores).
+
+    Only the edges of type "Bus" in edges are weighted (all of them if it is
+    None).
     """
 
+    if crosswalks is None:
+        crosswalks = stops_crosswalks(city)
+
+    # the targets of each crosswalk
+    bus_edges = edges if edges is not None else [
+        (u, v) for u, v, tipus in city.edges(data="type") if tipus == "Bus"
+    ]
+    targets: dict[int, set[int]] = {}
+    for u, v in bus_edges:
+        targets.setdefault(crosswalks[u], set()).add(crosswalks[v])
+
+    adj = walking_adjacency(city)
+    if processes == 1:
+        distances = {cruilla: bounded_dijkstra(adj, cruilla, cruilles)
+                     for cruilla, cruilles in targets.items()}
+    else:
+        from shared import worker_pool, worker_starmap
+
+        with worker_pool(processes, adj) as pool:
+            distances = dict(zip(targets.keys(),
+                                 worker_starmap(pool, bounded_dijkstra,
+                                                targets.items())))
+
     # add weight betwen stops of the same line
-    for edge in city.edges(data=True):
-        if edge[2]["type"] == "Bus":
-            # we get the closest crosswalk to the stop (it is already found)
-            # from all the edges of the stops is the only one of type Carrer
-            cruilla1 = list(
-                            filter(lambda edge_parada:
-                                   edge_parada[2]["type"] == "Carrer",
-                                   city.edges(edge[0], data=True)
-                                   )
-            )[0][1]
-            cruilla2 = list(
-                            filter(lambda edge_parada:
-                                   edge_parada[2]["type"] == "Carrer",
-                                   city.edges(edge[1], data=True),
-                                   )
-            )[0][1]
-
-            city.edges[edge[0], edge[1]]["weight"] = nx.shortest_path_length(
-                city, source=cruilla1, target=cruilla2, weight=get_weight_buses
-            )
+    for u, v in bus_edges:
+        city.edges[u, v]["weight"] = distances[crosswalks[u]][crosswalks[v]]
 
     # edges between substops of the same stop are added (weight=BUS_WAIT_TIME)
     # substops are grouped by stops
     parades: dict[str, list[str]] = group_substops(city)
 
     # an edge with weight = BUS_WAIT_TIME is added between every pair of
-    # substops of the same stop
-    for subparades in parades.values():
-        city.add_edges_from(itertools.combinations(subparades, 2),
-                            weight=BUS_WAIT_TIME, type="Transbord")
-
-
-def build_city_graph(g1: OsmnxGraph, g2: BusesGraph) -> CityGraph:
-    """If the citygraph is stored in FILE_CITY_NAME, it is loaded. Otherwise,
-    g1 and g2 are merged to build a Citygraph and it is saved in FILE_CITY_NAME
+    # substops of the same stop. If there are at least HUB_MIN_LINES
+    # substops (k), this is replaced by a hub (node of type "Intercanvi"
+    # with id the stop) joined to each of them with weight = BUS_WAIT_TIME / 2:
+    # the time between two substops is the same, with k edges instead of
+    # k * (k - 1) / 2
+    for parada, subparades in parades.items():
+        if len(subparades) < HUB_MIN_LINES:
+            city.add_edges_from(itertools.combinations(subparades, 2),
+                                weight=BUS_WAIT_TIME, type="Transbord")
+        else:
+            first = city.nodes[subparades[0]]
+            city.add_node(parada, nom=first["nom"], coord=first["coord"],
+                          type="Intercanvi")
+            city.add_edges_from(((parada, subparada)
+                                 for subparada in subparades),
+                                weight=BUS_WAIT_TIME / 2, type="Transbord")
+
+
+@profiling.timed("city.build_city_graph")
+def build_city_graph(g1: OsmnxGraph, g2: BusesGraph,
+                     processes: int | None = 1) -> CityGraph:
+    """If the citygraph is stored in the cache (built from the same g1, g2
+    and constants), it is loaded. Otherwise, g1 and g2 are merged to build a
+    Citygraph and it is saved in FILE_CITY_NAME
 
     ------------------------
     Graph returned:
     - Types of nodes and edges are added
-        nodes: "Cruilla" or "Parada"
-        edges: "Carrer" or "Bus"
+        nodes: "Cruilla", "Parada" or "Intercanvi" (hub of a stop)
+        edges: "Carrer", "Bus" or "Transbord"
 
     - The nodes coordinates are in lat - lon format (the coordinates
     of nodes from osmnxgraph are swapped)
@@ -205,79 +436,679 @@ def build_city_graph(g1: OsmnxGraph, g2: BusesGraph) -> CityGraph:
     - The edges of type="Carrer" have the attribute name or None
     - Each stop is connected to the closest crosswalk
 
+    processes is the number of processes used to weight the edges of the
+    buses (see add_weights_buses).
     """
 
-    path = os.getcwd() + "\\" + FILE_CITY_NAME
-    if os.path.exists(path):
-        return load_graph(FILE_CITY_NAME)
+    params = city_params(g1, g2)
+    cached = load_city_graph(params)
+    if cached is not None:
+        return cached
+
+    # if only the buses have changed, the graph of the cache is updated
+    previous = cache.entry_params(FILE_CITY_NAME)
+    if previous is not None and {**previous, "buses": params["buses"]} \
+            == cache.json_params(params):
+        city = load_city_graph(previous)
+        if city is not None:
+            update_city_graph(city, g2, processes)
+            save_city_graph(city, params)
+            return city
 
     city: CityGraph = CityGraph()
 
-    # nodes g1:
-    for node in g1.nodes(data=True):
-        city.add_node(node[0], coord=(node[1]["y"], node[1]["x"]),
-                      type="Cruilla")
+    with profiling.stage("city.build_city_graph.streets"):
+        add_streets(city, g1)
 
     # nodes g2:
     city.add_nodes_from(g2.nodes(data=True), type="Parada")
 
-    # edges g1 (weight is set):
-    for edge in g1.edges(data=True):
-
-        city.add_edge(edge[0], edge[1],
-                      name=edge[2].get("name", None),
-                      type="Carrer",
-                      weight=haversine(city.nodes[edge[0]]["coord"],
-                                       city.nodes[edge[1]]["coord"])
-                      / WALK_SPEED * 60
-                      )
-
     # edges g2:
     city.add_edges_from(g2.edges(data=True), type="Bus", weight=float("inf"))
 
-    join_stop_crosswalk(city, g2, g1)
+    with profiling.stage("city.build_city_graph.join_stops"):
+        crosswalks: dict[str, int] = join_stop_crosswalk(city, g2)
 
-    add_weights_buses(city)
+    add_weights_buses(city, crosswalks, processes)
 
-    save_graph(city, FILE_CITY_NAME)
+    save_city_graph(city, params)
 
     return city
 
 
-def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord, dst: Coord) -> Path:
-    """Returns a tuple whose first element is a list of nodes ids from the
-    shortest path from src to dst and the second element are the minutes taken.
+def add_streets(city: CityGraph, g1: OsmnxGraph) -> None:
+    """Adds the crosswalks and the streets of g1 to the city graph."""
+
+    # nodes g1:
+    city.add_nodes_from((node, {"coord": (attr["y"], attr["x"]),
+                                "type": "Cruilla"})
+                        for node, attr in g1.nodes(data=True))
+
+    # edges g1 (weight is set), all the distances are calculated at once:
+    edges = list(g1.edges(data="name"))
+    coords = {node: coord for node, coord in city.nodes(data="coord")}
+    weights = (haversine_array(
+        np.array([coords[u] for u, _, _ in edges], dtype=float),
+        np.array([coords[v] for _, v, _ in edges], dtype=float)
+    ).reshape(-1) / WALK_SPEED * 60).tolist()
+
+    city.add_edges_from(
+        (u, v, {"name": name, "type": "Carrer", "weight": weight})
+        for (u, v, name), weight in zip(edges, weights)
+    )
+
+
+@dataclass
+class CityUpdate:
+    """Changes made to a city graph by update_city_graph."""
+
+    added_stops: list[str]
+    removed_stops: list[str]
+    added_edges: list[tuple[str, str]]  # of type "Bus"
+    removed_edges: list[tuple[str, str]]  # of type "Bus"
+
+    def __bool__(self) -> bool:
+        return bool(self.added_stops or self.removed_stops
+                    or self.added_edges or self.removed_edges)
+
+
+@profiling.timed("city.update_city_graph")
+def update_city_graph(city: CityGraph, g2: BusesGraph,
+                      processes: int | None = 1) -> CityUpdate:
+    """Updates the city graph (built from other buses data) to the buses
+    graph g2, as if it had been built from it.
+
+    Only the stops (and their edges) and the edges of type "Bus" that have
+    changed are removed and added, and only the new edges are weighted. The
+    crosswalks and the streets do not change, so the spatial index is kept.
+    Everything else derived from the graph (heuristic_coords, and the files
+    of the cache built from it) is invalidated, since its hash changes.
     """
 
-    # distance.nearest_nodes uses lon-lat coordinates, so we need to swap them
-    cruilla_src, cruilla_dst = ox.distance.nearest_nodes(
-        ox_g, [src[1], dst[1]], [src[0], dst[0]], return_dist=False
+    # the transfers are added again for every stop (see add_weights_buses)
+    city.remove_edges_from([(u, v) for u, v, tipus
+                            in city.edges(data="type")
+                            if tipus == "Transbord"])
+    city.remove_nodes_from([node for node, tipus in city.nodes(data="type")
+                            if tipus == "Intercanvi"])
+
+    old_stops = {node: attr for node, attr in city.nodes(data=True)
+                 if attr["type"] == "Parada"}
+    new_stops = {node: dict(attr, type="Parada")
+                 for node, attr in g2.nodes(data=True)}
+
+    # a stop whose data has changed is removed and added again
+    removed_stops = sorted(node for node, attr in old_stops.items()
+                           if new_stops.get(node) != attr)
+    added_stops = sorted(node for node, attr in new_stops.items()
+                         if old_stops.get(node) != attr)
+
+    city.remove_nodes_from(removed_stops)
+
+    old_edges = {frozenset((u, v)) for u, v, tipus in city.edges(data="type")
+                 if tipus == "Bus"}
+    new_edges = {frozenset((u, v)) for u, v in g2.edges}
+    removed_edges = [tuple(edge) for edge in old_edges - new_edges]
+    added_edges = [(u, v) for u, v in g2.edges
+                   if frozenset((u, v)) not in old_edges]
+
+    city.remove_edges_from(removed_edges)
+
+    city.add_nodes_from(g2.subgraph(added_stops).nodes(data=True),
+                        type="Parada")
+    city.add_edges_from(
+        [(u, v, g2.edges[u, v]) for u, v in added_edges],
+        type="Bus", weight=float("inf")
     )
 
-    nodes_path: list[str] = nx.shortest_path(
-        g, source=cruilla_src, target=cruilla_dst, weight="weight"
+    crosswalks = stops_crosswalks(city)
+    if added_stops:
+        crosswalks.update(join_stop_crosswalk(city,
+                                              g2.subgraph(added_stops)))
+    add_weights_buses(city, crosswalks, processes, added_edges)
+
+    city.graph.pop("heuristic_coords", None)
+    city.graph.pop("hash", None)
+
+    return CityUpdate(added_stops, removed_stops, added_edges,
+                      removed_edges)
+
+
+@profiling.timed("city.nearest_crosswalks")
+def nearest_crosswalks(g: CityGraph, coords: list[Coord]) -> list[int]:
+    """Returns the closest crosswalk to each of the coordinates, using the
+    spatial index of g."""
+
+    profiling.count("city.nearest_crosswalks.coords", len(coords))
+    return spatial_index(g).nearest(coords)
+
+
+def heuristic_coords(g: CityGraph) -> dict[int | str, Coord]:
+    """Returns the coordinates used by the A* heuristic: the coordinates of
+    each node, or of its crosswalk if it is a stop. They are calculated the
+    first time and kept in the graph.
+
+    The weight of a bus edge is the distance on foot between the crosswalks
+    of its stops at BUS_SPEED, so using the crosswalks of the stops makes the
+    heuristic admissible (a stop can be far from its crosswalk). A hub uses
+    the coordinates of one of its stops.
+    """
+
+    if "heuristic_coords" not in g.graph:
+        coords = dict(g.nodes(data="coord"))
+        for parada, cruilla in stops_crosswalks(g).items():
+            coords[parada] = coords[cruilla]
+        for node, tipus in g.nodes(data="type"):
+            if tipus == "Intercanvi":
+                coords[node] = coords[next(iter(g[node]))]
+        g.graph["heuristic_coords"] = coords
+
+    return g.graph["heuristic_coords"]
+
+
+@profiling.timed("city.shortest_path")
+def shortest_path(g: CityGraph, source, target,
+                  algorithm: str = "bidirectional", weight="weight") -> list:
+    """Returns the list of nodes of the shortest path from source to target.
+
+    algorithm is one of ALGORITHMS:
+    - "dijkstra": searches in every direction from source
+    - "bidirectional": searches from source and from target at the same time
+    (it is what nx.shortest_path does)
+    - "astar": the heuristic is the haversine distance to target at
+    BUS_SPEED, the fastest way to move (see heuristic_coords)
+
+    All of them return a shortest path (with the same minutes).
+    """
+
+    assert algorithm in ALGORITHMS, f'Error: unknown algorithm {algorithm}'
+
+    if profiling.enabled() and not callable(weight):
+        # the edges relaxed are counted (it makes the search slower)
+        relaxed = 0
+        key = weight
+
+        def counting_weight(u, v, attr) -> float:
+            nonlocal relaxed
+            relaxed += 1
+            return attr[key]
+
+        nodes_path = _search(g, source, target, algorithm, counting_weight)
+        profiling.count(f"city.shortest_path.relaxed.{algorithm}", relaxed)
+        return nodes_path
+
+    return _search(g, source, target, algorithm, weight)
+
+
+def _search(g: CityGraph, source, target, algorithm: str, weight) -> list:
+    """shortest_path without instrumentation."""
+
+    if algorithm == "dijkstra":
+        return nx.dijkstra_path(g, source, target, weight=weight)
+
+    if algorithm == "bidirectional":
+        return nx.bidirectional_dijkstra(g, source, target, weight=weight)[1]
+
+    coords = heuristic_coords(g)
+    return nx.astar_path(
+        g, source, target,
+        heuristic=lambda u, v: haversine(coords[u], coords[v])
+        / BUS_SPEED * 60,
+        weight=weight
     )
 
+
+def relaxed_edges(g: CityGraph, source, target,
+                  algorithm: str = "bidirectional") -> int:
+    """Returns the number of edges relaxed by shortest_path, which measures
+    the part of the graph explored by each algorithm.
+
+    note: nodes settled can not be counted, as the bidirectional search of
+    networkx does not tell which end of the edge is the settled one.
+    """
+
+    relaxed = 0
+
+    def weight(u, v, attr) -> float:
+        nonlocal relaxed
+        relaxed += 1
+        return attr["weight"]
+
+    shortest_path(g, source, target, algorithm, weight)
+    return relaxed
+
+
+@profiling.timed("city.find_path")
+def find_path(ox_g: OsmnxGraph, g: CityGraph, src: Coord, dst: Coord,
+              algorithm: str = "bidirectional") -> Path:
+    """Returns a tuple whose first element is a list of nodes ids from the
+    shortest path from src to dst and the second element are the minutes taken.
+
+    algorithm is the search used (see shortest_path).
+
+    note: ox_g is not used anymore, the closest crosswalks are found with the
+    spatial index of g.
+    """
+
+    cruilla_src, cruilla_dst = nearest_crosswalks(g, [src, dst])
+
+    nodes_path: list[str] = shortest_path(g, cruilla_src, cruilla_dst,
+                                          algorithm)
+
     return (nodes_path, nx.path_weight(g, nodes_path, "weight"))
 
 
-def show_city(g: CityGraph) -> None:
-    """Shows the graph g interactively using network.draw"""
+@profiling.timed("city.dijkstra_from")
+def dijkstra_from(g: CityGraph, source, targets=None,
+                  cutoff: float = float("inf"),
+                  k: int | None = None,
+                  deadlines: dict | None = None) -> tuple[dict, dict]:
+    """Dijkstra from source that stops as soon as:
+    - every node of targets is settled (or k of them, if k is given)
+    - the next node is more than cutoff minutes away
 
-    positions = nx.get_node_attributes(g, "coord")
-    nx.draw(g, pos=positions, with_labels=False, node_size=10)
-    plt.show()
+    If deadlines is given, a target only counts for k if it is settled in
+    at most deadlines[target] minutes.
+
+    Returns the minutes to each settled node and the predecessor of each
+    node reached.
+    """
+
+    dist: dict = {}
+    seen: dict = {source: 0.0}
+    pred: dict = {}
+    pending: set | None = None if targets is None else set(targets)
+    found = 0
+
+    # node ids are integers and strings, so the counter breaks the ties
+    counter = itertools.count()
+    heap: list = [(0.0, next(counter), source)]
+
+    while heap and (pending is None or pending):
+        d, _, u = heapq.heappop(heap)
+        if u in dist:
+            continue
+        if d > cutoff:
+            break
+        dist[u] = d
+
+        if pending is not None and u in pending:
+            pending.discard(u)
+            if deadlines is None or d <= deadlines[u]:
+                found += 1
+                if k is not None and found >= k:
+                    break
+
+        for v, attr in g.adj[u].items():
+            if v not in dist and d + attr["weight"] < seen.get(v, math.inf):
+                seen[v] = d + attr["weight"]
+                pred[v] = u
+                heapq.heappush(heap, (d + attr["weight"], next(counter), v))
+
+    profiling.count("city.dijkstra_from.settled", len(dist))
+    return dist, pred
+
+
+def path_from_predecessors(pred: dict, source, target) -> list:
+    """Returns the list of nodes from source to target given the
+    predecessors of a search from source."""
+
+    nodes_path = [target]
+    while nodes_path[-1] != source:
+        nodes_path.append(pred[nodes_path[-1]])
+    nodes_path.reverse()
+    return nodes_path
+
+
+@dataclass
+class BatchPaths:
+    costs: np.ndarray  # minutes from each origin to each destination
+    sources: list  # crosswalk of each origin
+    targets: list  # crosswalk of each destination
+    preds: dict  # predecessors of the search from each crosswalk of sources
+
+    def path(self, i: int, j: int) -> Path:
+        """Returns the path from origin i to destination j, with the same
+        format as find_path. The list of nodes is built when it is asked."""
+
+        assert self.costs[i, j] != math.inf, \
+            f'Error: there is no path between origin {i} and destination {j}'
+
+        return (path_from_predecessors(self.preds[self.sources[i]],
+                                       self.sources[i], self.targets[j]),
+                float(self.costs[i, j]))
+
+
+def _batch_search(g: CityGraph, source, targets: set) -> tuple[dict, dict]:
+    """Returns the minutes from source to each target and the predecessors
+    of the nodes of the paths to them."""
+
+    dist, pred = dijkstra_from(g, source, targets)
+    minutes = {target: dist[target] for target in targets if target in dist}
+
+    # only the predecessors needed to build the paths are kept
+    needed: dict = {}
+    for target in minutes:
+        node = target
+        while node != source and node not in needed:
+            needed[node] = pred[node]
+            node = pred[node]
+
+    return minutes, needed
+
+
+@profiling.timed("city.find_paths_batch")
+def find_paths_batch(g: CityGraph, origins: list[Coord],
+                     destinations: list[Coord],
+                     processes: int | None = 1) -> BatchPaths:
+    """Returns the shortest paths from each origin to each destination.
+
+    All the coordinates are joined to their closest crosswalk at once, and
+    only one search is done for each different crosswalk of the origins (it
+    stops when every destination is reached).
+
+    If processes is not 1 the searches are done in a pool of processes
+    (None uses all the cores).
+    """
+
+    cruilles = nearest_crosswalks(g, list(origins) + list(destinations))
+    sources, targets = cruilles[:len(origins)], cruilles[len(origins):]
+
+    distinct = list(dict.fromkeys(sources))
+    if processes == 1:
+        results = [_batch_search(g, source, set(targets))
+                   for source in distinct]
+    else:
+        from shared import worker_pool, worker_starmap
+
+        with worker_pool(processes, g) as pool:
+            results = worker_starmap(pool, _batch_search,
+                                     [(source, set(targets))
+                                      for source in distinct])
+
+    searches = dict(zip(distinct, results))
+    costs = np.array([[searches[source][0].get(target, math.inf)
+                       for target in targets] for source in sources],
+                     dtype=np.float64).reshape(len(sources), len(targets))
+
+    return BatchPaths(costs, sources, targets,
+                      {source: searches[source][1] for source in distinct})
+
+
+@dataclass
+class Route:
+    path: Path  # nodes and minutes, as in find_path
+    transfers: int  # changes of line at a stop
+    walking: float  # minutes on foot
+
+
+def _dominated(criteria: tuple[float, int, float],
+               bag: list[tuple[float, int, float]]) -> bool:
+    """Returns whether some criteria of bag are at most criteria in each
+    component."""
+
+    return any(b[0] <= criteria[0] and b[1] <= criteria[1]
+               and b[2] <= criteria[2] for b in bag)
+
+
+@profiling.timed("city.find_pareto_paths")
+def find_pareto_paths(ox_g: OsmnxGraph, g: CityGraph, src: Coord,
+                      dst: Coord, slack: float = PARETO_SLACK,
+                      max_labels: int = PARETO_MAX_LABELS) -> list[Route]:
+    """Returns the routes from src to dst that are not worse than any other
+    in minutes, transfers and walking minutes at the same time (the Pareto
+    set), sorted by minutes. Each path can be drawn with plot_path.
+
+    A transfer is a change of line at a stop (the edges "Transbord", where
+    going through a hub counts once), and walking minutes are the minutes on
+    edges "Carrer".
+
+    It is a label-setting search from the crosswalk of src where each label
+    is a route to a node. To keep it fast:
+    - a label is dropped if a label of its node (or a route to dst) is not
+    worse in any criterion
+    - only routes of at most slack times the minutes of the fastest one are
+    searched: the minutes from the nodes to dst are found first (one search
+    from dst until src) and used as a lower bound
+    - at most max_labels labels are kept in each node (the fastest ones)
+
+    note: ox_g is not used, as in find_path.
+    """
+
+    source, target = nearest_crosswalks(g, [src, dst])
+
+    # minutes from each node to target: exact for the nodes settled by the
+    # search from target until source, at least the fastest for the others
+    remaining = dijkstra_from(g, target, {source})[0]
+    if source not in remaining:
+        return []
+    fastest = remaining[source]
+    bound = fastest * slack
+
+    # labels: (node, position of the previous label, criteria)
+    labels: list[tuple] = [(source, -1, (0.0, 0, 0.0))]
+    bags: dict = {}  # criteria of the labels settled in each node
+    counter = itertools.count()
+    heap: list = [(remaining[source], 0, 0.0, next(counter), 0)]
+    arrivals: list[int] = []  # labels settled in target
+    settled = 0
+
+    while heap:
+        estimate, _, _, _, i = heapq.heappop(heap)
+        u, _, criteria = labels[i]
+        bag = bags.setdefault(u, [])
+        if (u != target and len(bag) >= max_labels) \
+                or _dominated(criteria, bag) \
+                or _dominated((estimate, criteria[1], criteria[2]),
+                              bags.get(target, [])):
+            continue
+        bag.append(criteria)
+        settled += 1
+        if u == target:
+            arrivals.append(i)
+            continue
+
+        minutes, transfers, walking = criteria
+        type_u = g.nodes[u]["type"]
+        for v, attr in g.adj[u].items():
+            lower = remaining.get(v, fastest)
+            if minutes + attr["weight"] + lower > bound:
+                continue
+
+            new = (
+                minutes + attr["weight"],
+                # leaving a hub is part of the same transfer
+                transfers + (attr["type"] == "Transbord"
+                             and type_u != "Intercanvi"),
+                walking + (attr["weight"] if attr["type"] == "Carrer"
+                           else 0.0),
+            )
+            # the routes to target are a lower bound of the routes by v
+            if _dominated(new, bags.get(v, [])) or _dominated(
+                    (new[0] + lower, new[1], new[2]), bags.get(target, [])):
+                continue
+            labels.append((v, i, new))
+            heapq.heappush(heap, (new[0] + lower, new[1], new[2],
+                                  next(counter), len(labels) - 1))
+
+    profiling.count("city.find_pareto_paths.labels", settled)
+
+    # the labels are settled in target sorted by minutes
+    routes: list[Route] = []
+    for i in arrivals:
+        criteria = labels[i][2]
+        nodes_path = []
+        while i != -1:
+            nodes_path.append(labels[i][0])
+            i = labels[i][1]
+        nodes_path.reverse()
+        routes.append(Route((nodes_path, criteria[0]), criteria[1],
+                            criteria[2]))
+
+    return routes
+
+
+@dataclass
+class Reachable:
+    source: int  # crosswalk of the origin
+    minutes: dict[str, float]  # minutes to each cinema reached
+    cruilles: dict[str, int]  # crosswalk of each cinema
+    pred: dict  # predecessors of the search from source
+
+    def path(self, cinema: str) -> Path:
+        """Returns the path to cinema, with the same format as find_path."""
+
+        assert cinema in self.minutes, f'Error: {cinema} is not reachable'
+
+        return (path_from_predecessors(self.pred, self.source,
+                                       self.cruilles[cinema]),
+                self.minutes[cinema])
+
+
+@profiling.timed("city.reachable_cinemas")
+def reachable_cinemas(g: CityGraph, origin: Coord,
+                      budget: float = math.inf,
+                      cinemas: dict[str, Coord] = CINEMAS_LOCATION
+                      ) -> Reachable:
+    """Returns the cinemas that can be reached from origin in at most budget
+    minutes, with a single search from its crosswalk (it stops when every
+    cinema is reached or when the next node is further than budget)."""
+
+    cruilles = nearest_crosswalks(g, [origin] + list(cinemas.values()))
+    source = cruilles[0]
+    targets = dict(zip(cinemas.keys(), cruilles[1:]))
+
+    dist, pred = dijkstra_from(g, source, set(targets.values()), budget)
+    return Reachable(source,
+                     {cinema: dist[cruilla]
+                      for cinema, cruilla in targets.items()
+                      if cruilla in dist},
+                     targets, pred)
+
+
+@profiling.timed("city.reachable_projections")
+def reachable_projections(g: CityGraph, billboard: Billboard, origin: Coord,
+                          leaving_time: tuple[int, int],
+                          budget: float = math.inf, **constraints
+                          ) -> list[tuple[Projection, Path]]:
+    """Returns the projections (of every film) that can be reached on time
+    leaving from origin at leaving_time and travelling at most budget
+    minutes, sorted by starting time.
+
+    The projections are read from the time index of the billboard (with the
+    other constraints of Billboard.search_projections) and joined with a
+    single search from origin, that stops at the last projection.
+    """
+
+    projections = billboard.search_projections(starting_time=leaving_time,
+                                               **constraints)
+    if not projections:
+        return []
+
+    # minutes from leaving_time to the start of each projection
+    waits = [calculate_time(leaving_time, projection.time)
+             for projection in projections]
+    reachable = reachable_cinemas(
+        g, origin, min(budget, max(waits)),
+        {name: CINEMAS_LOCATION[name]
+         for name in {projection.cinema.name for projection in projections}}
+    )
+
+    paths: dict[str, Path] = {}
+    valid: list[tuple[int, Projection]] = []
+    for wait, projection in zip(waits, projections):
+        name = projection.cinema.name
+        if reachable.minutes.get(name, math.inf) <= wait:
+            if name not in paths:
+                paths[name] = reachable.path(name)
+            valid.append((wait, projection))
+
+    valid.sort(key=lambda wp: wp[0])
+    return [(projection, paths[projection.cinema.name])
+            for _, projection in valid]
+
+
+@profiling.timed("city.closest_projections")
+def closest_projections(g: CityGraph, billboard: Billboard, origin: Coord,
+                        leaving_time: tuple[int, int], k: int = 1,
+                        budget: float = math.inf, **constraints
+                        ) -> list[tuple[Projection, Path]]:
+    """Returns the next projection of the k cinemas that are reached the
+    earliest from origin leaving at leaving_time, travelling at most budget
+    minutes, sorted by the minutes to get there. Only the cinemas where a
+    projection can still be reached count (the projections are filtered
+    with the constraints of Billboard.search_projections, e.g. word).
+
+    The search from origin stops as soon as k of those cinemas are reached.
+    """
+
+    projections = billboard.search_projections(starting_time=leaving_time,
+                                               **constraints)
+
+    # minutes from leaving_time to the start of each projection, by cinema
+    waits: dict[str, list[tuple[int, Projection]]] = {}
+    for projection in projections:
+        waits.setdefault(projection.cinema.name, []).append(
+            (calculate_time(leaving_time, projection.time), projection)
+        )
+    if not waits:
+        return []
+    for cinema_waits in waits.values():
+        cinema_waits.sort(key=lambda wp: wp[0])
+
+    names = list(waits.keys())
+    cruilles = nearest_crosswalks(
+        g, [origin] + [CINEMAS_LOCATION[name] for name in names]
+    )
+    source, targets = cruilles[0], dict(zip(names, cruilles[1:]))
+
+    # a cinema is useful if it is reached before its last projection
+    deadlines: dict[int, float] = {}
+    for name, cruilla in targets.items():
+        deadlines[cruilla] = max(deadlines.get(cruilla, -math.inf),
+                                 waits[name][-1][0])
+
+    dist, pred = dijkstra_from(g, source, deadlines.keys(),
+                               min(budget, max(deadlines.values())), k,
+                               deadlines)
+
+    found: list[tuple[float, int, Projection]] = []
+    for name, cruilla in targets.items():
+        if cruilla not in dist:
+            continue
+        # the first projection that starts after arriving
+        following = next((wp for wp in waits[name]
+                          if wp[0] >= dist[cruilla]), None)
+        if following is not None:
+            found.append((dist[cruilla], following[0], following[1]))
+
+    found.sort(key=lambda f: (f[0], f[1]))
+    return [(projection,
+             (path_from_predecessors(pred, source,
+                                     targets[projection.cinema.name]),
+              minutes))
+            for minutes, _, projection in found[:k]]
+
+
+def show_city(g: CityGraph, bbox: BBox | None = None) -> None:
+    """Shows the graph g (the part inside bbox, all by default)
+    interactively, with a level of detail that follows the zoom"""
+
+    show_graph(graph_segments(g), graph_points(g),
+               {"Carrer": "orange", "Bus": "green", "Transbord": "green",
+                "Cruilla": "blue", "Parada": "red", "Intercanvi": "red"},
+               bbox)
 
 
 def plot_city(g: CityGraph, filename: str) -> None:
     """Saves the graph g as an image with the city map in the
     background in the file filename"""
 
-    map = StaticMap(300, 300)
+    map = CachedStaticMap()
 
     # draw nodes
     for node in g.nodes(data=True):
-        if node[1]["type"] == "Parada":
+        if node[1]["type"] in ("Parada", "Intercanvi"):
             color = "red"
 
         elif node[1]["type"] == "Cruilla":
@@ -287,18 +1118,14 @@ def plot_city(g: CityGraph, filename: str) -> None:
         map.add_marker(CircleMarker([node[1]["coord"][1], node[1]["coord"][0]],
                                     color, 3)
                        )
-    # draw edges
-    for edge in g.edges(data=True):
-        if edge[2]["type"] == "Carrer":
-            color = "orange"
-
-        elif edge[2]["type"] == "Bus":
-            color = "green"
-
-        # we swap the components (staticmap works with lon-lat coordinates
-        coord_1 = (g.nodes[edge[0]]["coord"][1], g.nodes[edge[0]]["coord"][0])
-        coord_2 = (g.nodes[edge[1]]["coord"][1], g.nodes[edge[1]]["coord"][0])
-        map.add_line(Line([coord_1, coord_2], color, 2))
+    # draw edges (streets are orange, buses and transfers green), joined in
+    # polylines of each color
+    segments: dict[str, list[tuple[Coord, Coord]]] = {"orange": [],
+                                                      "green": []}
+    for u, v, tipus in g.edges(data="type"):
+        color = "orange" if tipus == "Carrer" else "green"
+        segments[color].append((g.nodes[u]["coord"], g.nodes[v]["coord"]))
+    add_polylines(map, segments)
 
     image = map.render()
     image.save(filename)
@@ -319,45 +1146,63 @@ def get_colors_from_path(
     }
 
 
+@profiling.timed("city.plot_path")
 def plot_path(g: CityGraph, p: Path, filename: str, *args) -> None:
     '''Saves the path p as an image with the city map in the
     background in the file filename.
 
     The sections of the path that are on foot are blue.
     Each bus line is in a random color.
+
+    The image is kept in the cache, so drawing the same path again only
+    copies it (with the colors of the first time).
     '''
 
-    map = StaticMap(300, 300)
+    # the hubs are not drawn (they are where their stops are)
+    nodes = [g.nodes[node] for node in p[0]
+             if g.nodes[node]["type"] != "Intercanvi"]
 
-    colors_linies: dict[str, tuple[int, int, int]] = get_colors_from_path(g, p)
+    def draw() -> StaticMap:
+        map = CachedStaticMap()
 
-    # draw nodes
-    for i, id_node in enumerate(p[0]):
-        node = g.nodes[id_node]  # dict with attributes
-        if node["type"] == "Parada":
-            color = "red"
+        colors_linies: dict[str, tuple[int, int, int]] = \
+            get_colors_from_path(g, p)
 
-        elif node["type"] == "Cruilla":
-            color = "blue"
+        segments: dict[str | tuple[int, int, int],
+                       list[tuple[Coord, Coord]]] = {}
+
+        # draw nodes
+        for i, node in enumerate(nodes):  # dicts with attributes
+            if node["type"] == "Parada":
+                color = "red"
 
-        map.add_marker(CircleMarker((node["coord"][1], node["coord"][0]),
-                                    color, 3))
+            elif node["type"] == "Cruilla":
+                color = "blue"
 
-        if i != 0:  # draw edges
-            prev_node = g.nodes[p[0][i - 1]]
+            map.add_marker(CircleMarker((node["coord"][1], node["coord"][0]),
+                                        color, 3))
 
-            coord_1 = (node["coord"][1], node["coord"][0])
-            coord_2 = (prev_node["coord"][1], prev_node["coord"][0])
+            if i != 0:  # draw edges
+                prev_node = nodes[i - 1]
 
-            # if one of the nodes is a crosswalk the user has to walk
-            if node["type"] == "Cruilla" or prev_node["type"] == "Cruilla":
-                color = "blue"
-            else:
-                color = colors_linies[node["linia"]]
+                # if one of the nodes is a crosswalk the user has to walk
+                if node["type"] == "Cruilla" or \
+                        prev_node["type"] == "Cruilla":
+                    color = "blue"
+                else:
+                    color = colors_linies[node["linia"]]
+
+                segments.setdefault(color, []).append(
+                    (prev_node["coord"], node["coord"])
+                )
+
+        # consecutive sections of the same color are a single line
+        add_polylines(map, segments)
+        return map
 
-            map.add_line(Line([coord_1, coord_2], color, 2))
+    key = [(node["coord"], node["type"], node.get("linia"))
+           for node in nodes]
     try:
-        image = map.render()
-        image.save(filename)
+        cached_render(key, filename, draw)
     except Exception:
         print("Could not render or save the image")
@@ -0,0 +1,357 @@
+import heapq
+import json
+import os
+from dataclasses import dataclass, field
+from typing import BinaryIO, Sequence
+
+import numpy as np
+from haversine import haversine
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
+
+from city import BUS_SPEED, CityGraph, Coord, Path
+from spatial import SpatialIndex, build_spatial_index
+
+"""
+COMPACT CITY GRAPH
+
+The nodes are remapped to integers 0..n-1 (in the order of the city graph)
+and the edges are stored in CSR format: the neighbours of node i are
+targets[offsets[i]:offsets[i + 1]]. Each undirected edge is stored twice.
+
+Types of nodes and edges and the bus lines are small integers:
+- node_type: position in NODE_TYPES
+- edge_type: position in EDGE_TYPES
+- node_linia, edge_linia: position in linies (-1 if it has no line)
+- edge_name: position in names (-1 if the edge has no attribute name)
+- node_nom: position in noms (-1 if the node has no attribute nom)
+"""
+
+NODE_TYPES: tuple[str, ...] = ("Cruilla", "Parada", "Intercanvi")
+EDGE_TYPES: tuple[str, ...] = ("Carrer", "Bus", "Transbord")
+
+
+@dataclass
+class CompactGraph:
+    nodes: Sequence  # node id of each position
+    lat: np.ndarray
+    lon: np.ndarray
+    node_type: np.ndarray
+    node_linia: np.ndarray
+    node_nom: np.ndarray
+    offsets: np.ndarray
+    targets: np.ndarray
+    weights: np.ndarray
+    edge_type: np.ndarray
+    edge_linia: np.ndarray
+    edge_name: np.ndarray
+    linies: list[str]
+    noms: list[str]
+    names: list  # names of the streets (str, list of str or None)
+    _index: dict | None = field(init=False, repr=False, default=None)
+    _csr: csr_matrix | None = field(init=False, repr=False, default=None)
+    _anchors: tuple[np.ndarray, np.ndarray] | None = field(
+        init=False, repr=False, default=None
+    )
+    _spatial_index: SpatialIndex | None = field(init=False, repr=False,
+                                                default=None)
+
+    @property
+    def index(self) -> dict:
+        """Position of each node id (it is built once)."""
+
+        if self._index is None:
+            self._index = {node: i for i, node in enumerate(self.nodes)}
+        return self._index
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def csr(self) -> csr_matrix:
+        """Returns the weights as a scipy sparse matrix (it is built once)."""
+
+        if self._csr is None:
+            # zero weights are kept as explicit entries, so they are edges
+            self._csr = csr_matrix((self.weights, self.targets, self.offsets),
+                                   shape=(len(self), len(self)))
+        return self._csr
+
+    def spatial_index(self) -> SpatialIndex:
+        """Returns the spatial index of the crosswalks (it is built once).
+
+        note: the index returns positions of cg, not node ids.
+        """
+
+        if self._spatial_index is None:
+            cruilles = np.flatnonzero(
+                self.node_type == NODE_TYPES.index("Cruilla")
+            )
+            self._spatial_index = build_spatial_index(
+                cruilles,
+                np.column_stack([self.lat[cruilles], self.lon[cruilles]])
+            )
+        return self._spatial_index
+
+    def anchors(self) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the latitude and longitude used by the A* heuristic: the
+        coordinates of the node, or of its crosswalk if it is a stop, or of
+        its first stop if it is a hub (they are calculated once)."""
+
+        if self._anchors is not None:
+            return self._anchors
+
+        lat, lon = self.lat.copy(), self.lon.copy()
+        stops = np.flatnonzero(self.node_type == NODE_TYPES.index("Parada"))
+        carrer = EDGE_TYPES.index("Carrer")
+        for i in stops:
+            a, b = self.offsets[i], self.offsets[i + 1]
+            for j in range(a, b):
+                if self.edge_type[j] == carrer:
+                    lat[i] = self.lat[self.targets[j]]
+                    lon[i] = self.lon[self.targets[j]]
+        # a hub uses the coordinates of its first stop
+        for i in np.flatnonzero(self.node_type
+                                == NODE_TYPES.index("Intercanvi")):
+            j = self.targets[self.offsets[i]]
+            lat[i], lon[i] = lat[j], lon[j]
+        self._anchors = (lat, lon)
+        return self._anchors
+
+
+# missing attributes are encoded as -1
+_MISSING = object()
+
+
+def _codes(values: list, table: list) -> np.ndarray:
+    """Returns the position of each value in table. New values are appended
+    to table."""
+
+    positions: dict[str, int] = {}
+    codes = np.full(len(values), -1, dtype=np.int32)
+    for i, value in enumerate(values):
+        if value is _MISSING:
+            continue
+        key = json.dumps(value)
+        if key not in positions:
+            positions[key] = len(table)
+            table.append(value)
+        codes[i] = positions[key]
+    return codes
+
+
+def to_compact(g: CityGraph) -> CompactGraph:
+    """Returns the compact representation of the city graph g."""
+
+    nodes = list(g.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    n = len(nodes)
+
+    coords = np.array([g.nodes[node]["coord"] for node in nodes],
+                      dtype=np.float64).reshape(n, 2)
+    node_type = np.array([NODE_TYPES.index(g.nodes[node]["type"])
+                          for node in nodes], dtype=np.int8)
+    linies: list[str] = []
+    node_linia = _codes([g.nodes[node].get("linia", _MISSING)
+                         for node in nodes], linies).astype(np.int16)
+    noms: list[str] = []
+    node_nom = _codes([g.nodes[node].get("nom", _MISSING) for node in nodes],
+                      noms)
+
+    edges = list(g.edges(data=True))
+    u = np.array([index[edge[0]] for edge in edges], dtype=np.int32)
+    v = np.array([index[edge[1]] for edge in edges], dtype=np.int32)
+    weights = np.array([edge[2]["weight"] for edge in edges],
+                       dtype=np.float64)
+    edge_type = np.array([EDGE_TYPES.index(edge[2]["type"])
+                          for edge in edges], dtype=np.int8)
+    edge_linia = _codes([edge[2].get("linia", _MISSING) for edge in edges],
+                        linies).astype(np.int16)
+    names: list = []
+    edge_name = _codes([edge[2].get("name", _MISSING) for edge in edges],
+                       names)
+
+    # each edge is stored in both directions, sorted by its source
+    sources = np.concatenate([u, v])
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(sources, minlength=n), out=offsets[1:])
+
+    def both(a: np.ndarray) -> np.ndarray:
+        return np.concatenate([a, a])[order]
+
+    return CompactGraph(
+        nodes, coords[:, 0].copy(), coords[:, 1].copy(), node_type,
+        node_linia, node_nom, offsets, np.concatenate([v, u])[order],
+        both(weights), both(edge_type), both(edge_linia), both(edge_name),
+        linies, noms, names
+    )
+
+
+def to_city_graph(cg: CompactGraph) -> CityGraph:
+    """Returns the city graph (networkx) represented by cg."""
+
+    g: CityGraph = CityGraph()
+
+    # the arrays are converted to lists, which are much faster to iterate
+    linies = cg.linies + [None]  # position -1 is None
+    noms = cg.noms + [None]
+
+    nodes_attr = []
+    for node, lat, lon, tipus, nom, linia in zip(
+            cg.nodes, cg.lat.tolist(), cg.lon.tolist(),
+            cg.node_type.tolist(), cg.node_nom.tolist(),
+            cg.node_linia.tolist()):
+        attr = {"coord": (lat, lon), "type": NODE_TYPES[tipus]}
+        if nom != -1:
+            attr["nom"] = noms[nom]
+        if linia != -1:
+            attr["linia"] = linies[linia]
+        nodes_attr.append((node, attr))
+    g.add_nodes_from(nodes_attr)
+
+    sources = np.repeat(np.arange(len(cg), dtype=np.int32),
+                        np.diff(cg.offsets))
+    js = np.flatnonzero(sources < cg.targets)
+    names = cg.names + [None]
+
+    edges_attr = []
+    for u, v, weight, tipus, name, linia in zip(
+            sources[js].tolist(), cg.targets[js].tolist(),
+            cg.weights[js].tolist(), cg.edge_type[js].tolist(),
+            cg.edge_name[js].tolist(), cg.edge_linia[js].tolist()):
+        attr = {"type": EDGE_TYPES[tipus], "weight": weight}
+        if name != -1:
+            attr["name"] = names[name]
+        if linia != -1:
+            attr["linia"] = linies[linia]
+        edges_attr.append((cg.nodes[u], cg.nodes[v], attr))
+    g.add_edges_from(edges_attr)
+
+    return g
+
+
+# arrays of CompactGraph stored in the files (the rest are tables)
+ARRAYS: tuple[str, ...] = (
+    "lat", "lon", "node_type", "node_linia", "node_nom", "offsets",
+    "targets", "weights", "edge_type", "edge_linia", "edge_name"
+)
+
+
+def save_compact(cg: CompactGraph, file: BinaryIO) -> None:
+    """Writes cg in file as uncompressed NumPy arrays (.npz). The node ids and
+    the tables are stored as JSON (node ids are integers or strings)."""
+
+    tables = json.dumps({"nodes": cg.nodes, "linies": cg.linies,
+                         "noms": cg.noms, "names": cg.names})
+    np.savez(file, tables=np.frombuffer(tables.encode(), dtype=np.uint8),
+             **{name: getattr(cg, name) for name in ARRAYS})
+
+
+def load_compact(filename: str) -> CompactGraph:
+    """Returns the compact graph stored in file filename"""
+
+    assert os.path.exists(filename), f'Error: {filename} does not exist'
+
+    with np.load(filename) as data:
+        tables = json.loads(data["tables"].tobytes())
+        return CompactGraph(tables["nodes"],
+                            *[data[name] for name in ARRAYS],
+                            tables["linies"], tables["noms"], tables["names"])
+
+
+def _dijkstra(cg: CompactGraph, source: int, target: int
+              ) -> tuple[list[int], float]:
+    """Shortest path between two positions using the scipy (C) Dijkstra."""
+
+    dist, pred = dijkstra(cg.csr(), directed=True, indices=source,
+                          return_predecessors=True)
+    if dist[target] == np.inf:
+        return ([], float("inf"))
+
+    path = [target]
+    while path[-1] != source:
+        path.append(int(pred[path[-1]]))
+    path.reverse()
+    return (path, float(dist[target]))
+
+
+def _astar(cg: CompactGraph, source: int, target: int
+           ) -> tuple[list[int], float]:
+    """Shortest path between two positions using A*.
+
+    The heuristic is the haversine distance between the anchors of the nodes
+    (see CompactGraph.anchors) at BUS_SPEED, which is the fastest speed. It
+    is admissible because the weight of a bus edge is at least the distance
+    between the crosswalks of its stops at BUS_SPEED.
+    """
+
+    lat, lon = cg.anchors()
+    goal = (lat[target], lon[target])
+
+    def h(i: int) -> float:
+        return haversine((lat[i], lon[i]), goal) / BUS_SPEED * 60
+
+    dist: dict[int, float] = {source: 0.0}
+    pred: dict[int, int] = {}
+    settled: set[int] = set()
+    heap: list[tuple[float, float, int]] = [(h(source), 0.0, source)]
+
+    while heap:
+        _, d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u == target:
+            break
+
+        a, b = cg.offsets[u], cg.offsets[u + 1]
+        for v, weight in zip(cg.targets[a:b].tolist(),
+                             cg.weights[a:b].tolist()):
+            if d + weight < dist.get(v, float("inf")):
+                dist[v] = d + weight
+                pred[v] = u
+                heapq.heappush(heap, (d + weight + h(v), d + weight, v))
+
+    if target not in settled:
+        return ([], float("inf"))
+
+    path = [target]
+    while path[-1] != source:
+        path.append(pred[path[-1]])
+    path.reverse()
+    return (path, dist[target])
+
+
+def shortest_path(cg: CompactGraph, source, target,
+                  algorithm: str = "dijkstra") -> Path:
+    """Returns the shortest path between the nodes source and target (ids of
+    the city graph) with the same format as city.find_path.
+
+    algorithm is "dijkstra" or "astar".
+    """
+
+    return _shortest_path(cg, cg.index[source], cg.index[target], algorithm)
+
+
+def _shortest_path(cg: CompactGraph, source: int, target: int,
+                   algorithm: str) -> Path:
+    """shortest_path between two positions of cg."""
+
+    assert algorithm in ("dijkstra", "astar"), \
+        f'Error: unknown algorithm {algorithm}'
+
+    search = _dijkstra if algorithm == "dijkstra" else _astar
+    path, minutes = search(cg, source, target)
+    assert path, f'Error: there is no path between {cg.nodes[source]} and ' \
+        f'{cg.nodes[target]}'
+
+    return ([cg.nodes[i] for i in path], minutes)
+
+
+def find_path_compact(cg: CompactGraph, src: Coord, dst: Coord,
+                      algorithm: str = "dijkstra") -> Path:
+    """Returns the shortest path from src to dst as city.find_path does, but
+    the search is done on the compact graph cg."""
+
+    cruilla_src, cruilla_dst = cg.spatial_index().nearest([src, dst])
+    return _shortest_path(cg, cruilla_src, cruilla_dst, algorithm)
@@ -1,3 +1,9 @@
+import os
+import sys
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
 from rich import emoji
 from rich.console import Console
 from rich.markdown import Markdown
@@ -6,15 +12,101 @@ from rich.prompt import Prompt
 from rich.style import Style
 from rich.table import Table
 
-from buses import *
 from billboard import *
-from city import *
 
-import matplotlib.pyplot as plt
-import matplotlib.image as mpimg
+import profiling
+
+# the graphs are only imported (networkx, numpy, staticmap and PIL are slow
+# to import) by the threads that load them and the options that use them
+if TYPE_CHECKING:
+    from buses import BusesGraph, Coord
+    from city import CityGraph, OsmnxGraph, Path
+    from fields import CinemaFields
 
 console = Console()
 
+# start of the demo (set by main), to report the time until the first menu
+# and route
+START: float = 0.0
+
+# seconds since START until the first menu and the first route are shown
+TIMINGS: dict[str, float] = dict()
+
+
+def record_timing(name: str) -> None:
+    """Records the seconds since START the first time it is called with
+    name."""
+
+    if name not in TIMINGS:
+        TIMINGS[name] = time.perf_counter() - START
+
+
+class Datasets:
+    """Data of the demo. It is loaded in the background from the start (each
+    dataset at the same time as the others, unless it needs them), and each
+    option of the menu only waits for the datasets it uses."""
+
+    def __init__(self) -> None:
+        """Starts loading every dataset."""
+
+        self.executor = ThreadPoolExecutor(max_workers=5)
+        self._billboard: Future = self.executor.submit(get_billboard)
+        self._buses: Future = self.executor.submit(self._load_buses)
+        self._osmnx: Future = self.executor.submit(self._load_osmnx)
+        self._city: Future = self.executor.submit(self._load_city)
+        self._fields: Future = self.executor.submit(self._load_fields)
+
+    def _load_buses(self) -> "BusesGraph":
+        from buses import get_buses_graph
+
+        return get_buses_graph()
+
+    def _load_osmnx(self) -> "OsmnxGraph":
+        from city import get_osmnx_graph
+
+        return get_osmnx_graph()
+
+    def _load_city(self) -> "CityGraph":
+        from city import build_city_graph
+
+        return build_city_graph(self._osmnx.result(), self._buses.result())
+
+    def _load_fields(self) -> "CinemaFields":
+        from fields import get_cinema_fields
+
+        return get_cinema_fields(self._city.result())
+
+    def _wait(self, future: Future, name: str):
+        """Returns the result of future, showing that name is being loaded
+        if it has not finished yet."""
+
+        if not future.done():
+            with console.status(f"Loading the {name}..."):
+                return future.result()
+        return future.result()
+
+    def billboard(self) -> Billboard:
+        """Returns the billboard (the newest one, if it has been scraped
+        again in the background)."""
+
+        billboard = refreshed_billboard()
+        if billboard is not None:
+            self._billboard = Future()
+            self._billboard.set_result(billboard)
+        return self._wait(self._billboard, "billboard")
+
+    def buses_graph(self) -> "BusesGraph":
+        return self._wait(self._buses, "buses graph")
+
+    def osmnx_graph(self) -> "OsmnxGraph":
+        return self._wait(self._osmnx, "streets graph")
+
+    def city_graph(self) -> "CityGraph":
+        return self._wait(self._city, "city graph")
+
+    def fields(self) -> "CinemaFields":
+        return self._wait(self._fields, "distances to the cinemas")
+
 
 # Function to draw the menu
 def draw_menu():
@@ -98,15 +190,13 @@ def search_billboard(billboard: Billboard) -> None:
     show_projections(projections)
 
 
-def show_film_titles(
-    billboard: Billboard, osmx_g: OsmnxGraph, city_g: CityGraph
-) -> None:
+def show_film_titles(data: Datasets) -> None:
     """Show all film titles from the films that are available."""
 
-    for title in billboard.films_titles:
+    for title in data.billboard().films_titles:
         console.print(title.capitalize())
     Prompt.ask("\nPress enter to continue...")
-    search_closest_cinema(billboard, osmx_g, city_g)
+    search_closest_cinema(data)
 
 
 def get_valid_duration() -> int:
@@ -123,6 +213,16 @@ def get_valid_duration() -> int:
         return get_valid_duration()
 
 
+def get_valid_budget() -> int:
+    """Returns the maximum minutes to get to the cinema given by the user."""
+
+    try:
+        return int(Prompt.ask("How many minutes can you spend to get there?"))
+    except Exception as error:
+        console.print("An error ocurred: ", type(error).__name__)
+        return get_valid_budget()
+
+
 def get_valid_film_title(billboard: Billboard) -> str | None:
     """Returns the title given by the user, in case it's from a film
     that exists.
@@ -138,7 +238,7 @@ def get_valid_film_title(billboard: Billboard) -> str | None:
     return film
 
 
-def get_valid_coordinates() -> Coord:
+def get_valid_coordinates() -> "Coord":
     """Asks the user their current coordinates and, if well introduced, they
     are returned. Otherwise the user is asked again"""
 
@@ -194,11 +294,16 @@ def get_valid_option(valid_opt_l: int) -> int:
 
 
 def get_valid_projections(
-        billboard: Billboard, osmx_g: OsmnxGraph,
-        city_g: CityGraph) -> list[tuple[Projection, Path]] | None:
+        data: Datasets) -> list[tuple[Projection, "Path"]] | None:
     """Returns a list of all the projections of a given film that you
-    can arrive given a starting time"""
+    can arrive given a starting time.
+
+    The minutes to each cinema are read from the distance fields, so no
+    search is done. They are only waited for once the user has answered."""
+
+    from city import nearest_crosswalks
 
+    billboard = data.billboard()
     film = get_valid_film_title(billboard)
     if film is None:
         return None
@@ -211,18 +316,21 @@ def get_valid_projections(
 
         projections = billboard.search_projection_by_time(leaving_time)
 
-        valid_projections: list[tuple[Projection, Path]] = list()
+        city_g, fields = data.city_graph(), data.fields()
+        cruilla: int = nearest_crosswalks(city_g, [starting_coord])[0]
+        minutes: dict[str, float] = fields.time_to_cinemas(cruilla)
+
+        valid_projections: list[tuple[Projection, "Path"]] = list()
 
         for projection in projections:
             if projection.film.title.lower() != film:
                 continue
 
-            path = find_path(
-                osmx_g, city_g, starting_coord,
-                CINEMAS_LOCATION[projection.cinema.name]
-            )
-            if path[1] <= calculate_time(leaving_time, projection.time):
-                valid_projections.append((projection, path))
+            name = projection.cinema.name
+            if minutes[name] <= calculate_time(leaving_time, projection.time):
+                valid_projections.append(
+                    (projection, fields.path_to_cinema(cruilla, name))
+                )
 
         return valid_projections
 
@@ -231,7 +339,8 @@ def show_find_closest_cinema_menu() -> None:
     """Shows the menu from 5th option (choose a cinema)."""
 
     console.clear()
-    options = ["1 Show films available", "2 Choose film", "3 Exit"]
+    options = ["1 Show films available", "2 Choose film",
+               "3 Show everything I can still make", "4 Exit"]
     console.print(
         Panel(
             "\n".join(options),
@@ -243,7 +352,7 @@ def show_find_closest_cinema_menu() -> None:
 
 
 def show_projections_path_info(
-    valid_projections: list[tuple[Projection, Path]]
+    valid_projections: list[tuple[Projection, "Path"]]
 ) -> None:
     """Shows in a table the possible projections given the user constraints and
     the time to get there"""
@@ -251,6 +360,7 @@ def show_projections_path_info(
     table = Table(show_header=True, header_style="bold magenta")
     table.add_column("Num")
     table.add_column("Cinema", justify="left")
+    table.add_column("Film")
     table.add_column("Projection time")
     table.add_column("Time to get there")
 
@@ -258,6 +368,7 @@ def show_projections_path_info(
         table.add_row(
             str(i + 1),
             projection.cinema.name,
+            projection.film.title,
             "starts at {0}:{1}".format(projection.time[0], projection.time[1]),
             "{0} minutes".format(str(round(path[1], 1))),
         )
@@ -266,27 +377,28 @@ def show_projections_path_info(
     console.print(table)
 
 
-def search_closest_cinema(
-    billboard: Billboard, osmx_g: OsmnxGraph, city_g: CityGraph
-) -> None:
+def search_closest_cinema(data: Datasets) -> None:
     """Driver code of the funcionality about finding the closest cinema
-    from a given position, film and schedule."""
+    from a given position, film and schedule. Each option only waits for
+    the data it uses."""
+
+    from city import plot_path, reachable_projections
 
     show_find_closest_cinema_menu()
 
     key = Prompt.ask("Select the option that you want")
 
     if key == "1":
-        show_film_titles(billboard, osmx_g, city_g)
+        show_film_titles(data)
 
     elif key == "2":
         valid_projections: list[
             tuple[Projection, Path]
-        ] | None = get_valid_projections(billboard, osmx_g, city_g)
+        ] | None = get_valid_projections(data)
 
         # Wrong title
         if valid_projections is None:
-            search_closest_cinema(billboard, osmx_g, city_g)
+            search_closest_cinema(data)
 
         # No matching projections
         elif len(valid_projections) == 0:
@@ -294,7 +406,7 @@ def search_closest_cinema(
                 """Sorry, there are no projections available
                 given these constraints"""
             )
-            search_closest_cinema(billboard, osmx_g, city_g)
+            search_closest_cinema(data)
 
         else:
             valid_projections.sort(key=lambda p: p[1][1])
@@ -303,34 +415,61 @@ def search_closest_cinema(
 
             num_projection = get_valid_option(len(valid_projections))
 
-            plot_path(city_g, valid_projections[num_projection - 1][1],
-                      "path.png")
+            plot_path(data.city_graph(),
+                      valid_projections[num_projection - 1][1], "path.png")
+            record_timing("first route")
+
+            import matplotlib.image as mpimg  # slow to import
+            import matplotlib.pyplot as plt
 
             path_img = mpimg.imread('path.png')
             plt.imshow(path_img)
             plt.show()
 
     elif key == "3":
+        starting_coord: Coord = get_valid_coordinates()
+        leaving_time: tuple[int, int] = get_valid_time(
+            "At which time do you want to leave?"
+        )
+        budget: int = get_valid_budget()
+
+        # every film at once, with a single search from the origin
+        reachable = reachable_projections(data.city_graph(), data.billboard(),
+                                          starting_coord, leaving_time, budget)
+        if len(reachable) == 0:
+            Prompt.ask("Sorry, there are no projections available given "
+                       "these constraints")
+        else:
+            reachable.sort(key=lambda p: p[1][1])
+            show_projections_path_info(reachable)
+            Prompt.ask("\nPress enter to continue...")
+        search_closest_cinema(data)
+
+    elif key == "4":
         draw_menu()
 
     else:
-        search_closest_cinema(billboard, osmx_g, city_g)
+        search_closest_cinema(data)
 
 
-def handle_input(key: str, billboard: Billboard, buses_g: BusesGraph,
-                 osmx_g: OsmnxGraph, city_g: CityGraph) -> None:
-    """Function that handles user input."""
+def handle_input(key: str, data: Datasets) -> None:
+    """Function that handles user input. It only waits for the data that the
+    option needs."""
 
     if key == "1":
-        show_projections(billboard.projections)
+        show_projections(data.billboard().projections)
     elif key == "2":
-        search_billboard(billboard)
+        search_billboard(data.billboard())
     elif key == "3":
-        show_buses(buses_g)
+        from buses import show_buses
+
+        show_buses(data.buses_graph())
     elif key == "4":
-        show_city(city_g)
+        from city import show_city
+
+        show_city(data.city_graph())
     elif key == "5":
-        search_closest_cinema(billboard, osmx_g, city_g)
+        search_closest_cinema(data)
 
     Prompt.ask("\nPress enter to return to the main page")
 
@@ -338,13 +477,14 @@ def handle_input(key: str, billboard: Billboard, buses_g: BusesGraph,
 def main() -> None:
     """Driver Code."""
 
-    billboard: Billboard = read_billboard()
-    buses_g: BusesGraph = get_buses_graph()
-    osmx_g: OsmnxGraph = get_osmnx_graph()
-    city_g: CityGraph = build_city_graph(osmx_g, buses_g)
+    global START
+    START = time.perf_counter()
+
+    data = Datasets()
 
     while True:
         draw_menu()
+        record_timing("first menu")
         key = Prompt.ask("Select a valid option")
         if key == "6":
             console.print(
@@ -354,9 +494,21 @@ def main() -> None:
                     expand=False,
                 ),
             )
+            console.print(", ".join(f"{name}: {seconds:.2f} s"
+                                    for name, seconds in TIMINGS.items()),
+                          style="dim")
+            if profiling.enabled():
+                console.print(profiling.report_table())
+                if os.environ.get(profiling.ENV_VAR):
+                    profiling.save_report(os.environ[profiling.ENV_VAR])
             return
-        handle_input(key, billboard, buses_g, osmx_g, city_g)
+        handle_input(key, data)
 
 
 if __name__ == "__main__":
     main()
+    # the datasets that are still loading (and the pages or tiles being
+    # downloaded by them) are not waited for: the files of the cache are
+    # written atomically, so they are never left half written
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,122 @@
+import os
+from dataclasses import dataclass
+from typing import BinaryIO
+
+import networkx as nx
+import numpy as np
+
+import cache
+from billboard import CINEMAS_LOCATION
+from city import CityGraph, Path, nearest_crosswalks
+
+FILE_FIELDS_NAME = "CINEMA_FIELDS.npz"
+
+"""
+DISTANCE FIELDS
+
+The city graph is undirected, so the minutes from any node to a cinema are
+the minutes from the cinema to that node. For each cinema one search is done
+offline and two arrays are stored (indexed by the position of the node in
+the city graph):
+- dist: minutes between the node and the cinema (inf if unreachable)
+- pred: position of the next node on the way to the cinema (-1 if none)
+"""
+
+
+@dataclass
+class CinemaFields:
+    nodes: list  # node id of each position
+    index: dict  # position of each node id
+    cinemas: list[str]
+    dist: np.ndarray  # shape (cinemas, nodes)
+    pred: np.ndarray  # shape (cinemas, nodes)
+
+    def time_to_cinemas(self, node) -> dict[str, float]:
+        """Returns the minutes taken from node to each cinema."""
+
+        i = self.index[node]
+        return {cinema: float(minutes)
+                for cinema, minutes in zip(self.cinemas, self.dist[:, i])}
+
+    def path_to_cinema(self, node, cinema: str) -> Path:
+        """Returns the shortest path from node to cinema, with the same format
+        as city.find_path."""
+
+        c = self.cinemas.index(cinema)
+        i = self.index[node]
+        minutes = float(self.dist[c, i])
+        assert minutes != float("inf"), f"Error: {cinema} is unreachable"
+
+        nodes_path = [node]
+        while self.pred[c, i] != -1:
+            i = self.pred[c, i]
+            nodes_path.append(self.nodes[i])
+
+        return (nodes_path, minutes)
+
+
+def build_cinema_fields(g: CityGraph,
+                        cinemas: dict[str, tuple[float, float]]
+                        = CINEMAS_LOCATION) -> CinemaFields:
+    """Returns the distance fields of the cinemas (one search for each)."""
+
+    nodes = list(g.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    names = list(cinemas.keys())
+    cruilles = nearest_crosswalks(g, list(cinemas.values()))
+
+    dist = np.full((len(names), len(nodes)), np.inf)
+    pred = np.full((len(names), len(nodes)), -1, dtype=np.int32)
+
+    for c, cruilla in enumerate(cruilles):
+        preds, minutes = nx.dijkstra_predecessor_and_distance(
+            g, cruilla, weight="weight"
+        )
+        for node, m in minutes.items():
+            dist[c, index[node]] = m
+        for node, previous in preds.items():
+            if previous:
+                pred[c, index[node]] = index[previous[0]]
+
+    return CinemaFields(nodes, index, names, dist, pred)
+
+
+def save_cinema_fields(fields: CinemaFields, file: BinaryIO) -> None:
+    """Writes the distance fields in file as NumPy arrays (.npz)."""
+
+    # node ids are stored as strings (crosswalks are integers)
+    np.savez(file, nodes=np.array([str(node) for node in fields.nodes]),
+             cinemas=np.array(fields.cinemas),
+             dist=fields.dist, pred=fields.pred)
+
+
+def load_cinema_fields(g: CityGraph, filename: str) -> CinemaFields:
+    """Returns the distance fields stored in file filename. The node ids are
+    recovered from the city graph g they were built from."""
+
+    assert os.path.exists(filename), f'Error: {filename} does not exist'
+
+    with np.load(filename) as data:
+        ids = {str(node): node for node in g.nodes}
+        nodes = [ids[node] for node in data["nodes"]]
+        return CinemaFields(nodes, {node: i for i, node in enumerate(nodes)},
+                            [str(cinema) for cinema in data["cinemas"]],
+                            data["dist"], data["pred"])
+
+
+def get_cinema_fields(g: CityGraph) -> CinemaFields:
+    """Returns the distance fields of the cinemas. If they are in the cache
+    (built from the same city graph and cinemas), they are loaded. Otherwise
+    they are built and saved in FILE_FIELDS_NAME."""
+
+    params = {"city": g.graph.get("hash") or cache.graph_hash(g),
+              "cinemas": cache.data_hash(CINEMAS_LOCATION)}
+
+    path = cache.lookup(FILE_FIELDS_NAME, params)
+    if path is not None:
+        return load_cinema_fields(g, path)
+
+    fields = build_cinema_fields(g)
+    cache.store(FILE_FIELDS_NAME, params,
+                lambda file: save_cinema_fields(fields, file))
+    return fields
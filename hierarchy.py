@@ -0,0 +1,376 @@
+import heapq
+import json
+import math
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO
+
+import numpy as np
+
+import cache
+from city import CityGraph, Coord, Path, nearest_crosswalks
+from compact import CompactGraph, to_compact
+
+FILE_HIERARCHY_NAME = "HIERARCHY.npz"
+
+# maximum number of nodes settled by a witness search
+WITNESS_LIMIT = 50
+
+"""
+CONTRACTION HIERARCHY
+
+The nodes are contracted one by one (in the order given by their rank). When
+a node v is contracted, a shortcut u - w (whose middle node is v) is added
+between two of its neighbours if the path u - v - w may be the only shortest
+path between them (there is no witness path without v that is as short).
+
+The graph is undirected, so a query is a bidirectional Dijkstra where both
+searches only go from a node to nodes of higher rank (the upward graph).
+The shortcuts of the path found are unpacked recursively into the nodes of
+the city graph.
+
+The upward graph is stored in CSR format (see compact.py): the edges from
+node i to nodes of higher rank are up_targets[up_offsets[i]:up_offsets[i+1]],
+and up_middle is the middle node of each shortcut (-1 for original edges).
+"""
+
+
+@dataclass
+class ContractionHierarchy:
+    nodes: list  # node id of each position (as in CompactGraph)
+    rank: np.ndarray
+    up_offsets: np.ndarray
+    up_targets: np.ndarray
+    up_weights: np.ndarray
+    up_middle: np.ndarray
+    preprocessing_time: float = 0.0  # seconds
+    _up: list | None = field(init=False, repr=False, default=None)
+    _index: dict | None = field(init=False, repr=False, default=None)
+    _middle: dict | None = field(init=False, repr=False, default=None)
+    _local: threading.local = field(init=False, repr=False,
+                                    default_factory=threading.local)
+
+    def __getstate__(self) -> dict:
+        # the scratch lists of each thread are not pickled
+        state = dict(self.__dict__)
+        del state["_local"]
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state, _local=threading.local())
+
+    @property
+    def index(self) -> dict:
+        """Position of each node id (it is built once)."""
+
+        if self._index is None:
+            self._index = {node: i for i, node in enumerate(self.nodes)}
+        return self._index
+
+    def shortcuts(self) -> int:
+        """Returns the number of shortcuts."""
+
+        return int(np.count_nonzero(self.up_middle != -1))
+
+    def nbytes(self) -> int:
+        """Returns the size of the arrays of the hierarchy in bytes."""
+
+        return sum(a.nbytes for a in (self.rank, self.up_offsets,
+                                      self.up_targets, self.up_weights,
+                                      self.up_middle))
+
+    def upward(self) -> list[list[tuple[int, float]]]:
+        """Returns the upward graph as adjacency lists, which are much faster
+        to iterate than the arrays (they are built once)."""
+
+        if self._up is None:
+            targets, weights = self.up_targets.tolist(), \
+                self.up_weights.tolist()
+            offsets = self.up_offsets.tolist()
+            self._up = [list(zip(targets[a:b], weights[a:b]))
+                        for a, b in zip(offsets[:-1], offsets[1:])]
+        return self._up
+
+    def middle(self, u: int, w: int) -> int:
+        """Returns the middle node of the edge u - w of the upward graph (-1
+        if it is an original edge). The shortcuts are indexed the first
+        time."""
+
+        if self._middle is None:
+            sources = np.repeat(np.arange(len(self.nodes), dtype=np.int32),
+                                np.diff(self.up_offsets))
+            js = np.flatnonzero(self.up_middle != -1)
+            self._middle = {
+                (min(a, b), max(a, b)): m
+                for a, b, m in zip(sources[js].tolist(),
+                                   self.up_targets[js].tolist(),
+                                   self.up_middle[js].tolist())
+            }
+        return self._middle.get((min(u, w), max(u, w)), -1)
+
+    def _scratch(self) -> tuple[list, list]:
+        """Returns the distances and predecessors of both searches of query,
+        lists indexed by position (one pair for each thread). They are
+        allocated once and only the entries used are reset after each
+        query, which is much faster than dicts."""
+
+        scratch = getattr(self._local, "scratch", None)
+        if scratch is None:
+            n = len(self.nodes)
+            scratch = ([[math.inf] * n, [math.inf] * n],
+                       [[-1] * n, [-1] * n])
+            self._local.scratch = scratch
+        return scratch
+
+    def query(self, source: int, target: int) -> tuple[list[int], float]:
+        """Returns the shortest path (positions) between source and target
+        and its minutes. The path is empty if there is none.
+
+        Both searches stall on demand: a node is not expanded if it is
+        reached faster from a node of higher rank (its distance is not the
+        shortest one, so no shortest path goes on from it).
+        """
+
+        up = self.upward()
+        inf = math.inf
+        dist, pred = self._scratch()
+        dist[0][source] = 0.0
+        dist[1][target] = 0.0
+        touched = [source, target]
+        heaps: tuple[list, list] = ([(0.0, source)], [(0.0, target)])
+        best, meeting = inf, -1
+
+        try:
+            while heaps[0] or heaps[1]:
+                # the search with the closest node goes on
+                side = 0 if not heaps[1] or (
+                    heaps[0] and heaps[0][0][0] <= heaps[1][0][0]
+                ) else 1
+                heap, own, other = heaps[side], dist[side], dist[1 - side]
+                d, u = heapq.heappop(heap)
+                if d >= best:
+                    # nodes left in this search can not improve best
+                    heap.clear()
+                    continue
+                if d > own[u]:
+                    continue  # already settled with a shorter distance
+
+                if d + other[u] < best:
+                    best, meeting = d + other[u], u
+
+                edges = up[u]
+                for v, weight in edges:
+                    if own[v] + weight < d:
+                        break  # stalled
+                else:
+                    for v, weight in edges:
+                        if d + weight < own[v]:
+                            if own[v] == inf and other[v] == inf:
+                                touched.append(v)
+                            own[v] = d + weight
+                            pred[side][v] = u
+                            heapq.heappush(heap, (d + weight, v))
+
+            forward = backward = []
+            if meeting != -1:
+                forward = [meeting]
+                while forward[-1] != source:
+                    forward.append(pred[0][forward[-1]])
+                forward.reverse()
+                backward = [meeting]
+                while backward[-1] != target:
+                    backward.append(pred[1][backward[-1]])
+        finally:
+            for v in touched:
+                dist[0][v] = dist[1][v] = inf
+
+        if meeting == -1:
+            return ([], inf)
+
+        return (self.unpack(forward + backward[1:]), best)
+
+    def unpack(self, path: list[int]) -> list[int]:
+        """Returns the path with every shortcut replaced by the nodes it
+        represents."""
+
+        nodes = [path[0]]
+        stack = [(u, w) for u, w in reversed(list(zip(path, path[1:])))]
+        while stack:
+            u, w = stack.pop()
+            m = self.middle(u, w)
+            if m == -1:
+                nodes.append(w)
+            else:
+                stack.append((m, w))
+                stack.append((u, m))
+        return nodes
+
+
+def _witness(adj: list[dict[int, float]], source: int, excluded: int,
+             limit: float) -> dict[int, float]:
+    """Returns the distances from source found by a Dijkstra that does not go
+    through excluded, that stops at distance limit or after settling
+    WITNESS_LIMIT nodes."""
+
+    dist = {source: 0.0}
+    heap = [(0.0, source)]
+    settled = 0
+    while heap and settled < WITNESS_LIMIT:
+        d, u = heapq.heappop(heap)
+        if d > dist[u]:
+            continue
+        if d > limit:
+            break
+        settled += 1
+        for v, weight in adj[u].items():
+            if v != excluded and d + weight < dist.get(v, float("inf")):
+                dist[v] = d + weight
+                heapq.heappush(heap, (d + weight, v))
+    return dist
+
+
+def _shortcuts(adj: list[dict[int, float]],
+               v: int) -> list[tuple[int, int, float]]:
+    """Returns the shortcuts needed to contract v."""
+
+    shortcuts = []
+    neighbours = list(adj[v].items())
+    for i, (u, wu) in enumerate(neighbours):
+        others = neighbours[i + 1:]
+        if not others:
+            continue
+        dist = _witness(adj, u, v, wu + max(ww for _, ww in others))
+        for w, ww in others:
+            if dist.get(w, float("inf")) > wu + ww:
+                shortcuts.append((u, w, wu + ww))
+    return shortcuts
+
+
+def build_hierarchy(cg: CompactGraph) -> ContractionHierarchy:
+    """Returns the contraction hierarchy of the compact graph cg.
+
+    The nodes are contracted in order of edge difference (twice the
+    shortcuts added minus the edges removed) plus the number of contracted
+    neighbours, which is updated lazily. The shortcuts computed for the
+    priority of the node contracted are reused.
+    """
+
+    start = time.perf_counter()
+    n = len(cg)
+
+    # remaining graph (edges with infinite weight can not be used)
+    adj: list[dict[int, float]] = [{} for _ in range(n)]
+    offsets = cg.offsets.tolist()
+    targets, weights = cg.targets.tolist(), cg.weights.tolist()
+    for u in range(n):
+        for j in range(offsets[u], offsets[u + 1]):
+            v, weight = targets[j], weights[j]
+            if weight != float("inf") and u != v:
+                adj[u][v] = min(weight, adj[u].get(v, float("inf")))
+
+    # middle node of the shortcuts of the remaining graph
+    middle: dict[tuple[int, int], int] = {}
+    contracted_neighbours = [0] * n
+
+    def priority(v: int, shortcuts: list) -> int:
+        return (2 * len(shortcuts) - len(adj[v])
+                + contracted_neighbours[v])
+
+    heap = [(priority(v, _shortcuts(adj, v)), v) for v in range(n)]
+    heapq.heapify(heap)
+
+    rank = np.empty(n, dtype=np.int32)
+    up: list[dict[int, tuple[float, int]]] = [{} for _ in range(n)]
+
+    for order in range(n):
+        while True:
+            _, v = heapq.heappop(heap)
+            # lazy update: v is contracted only if it is still the best
+            shortcuts = _shortcuts(adj, v)
+            p = priority(v, shortcuts)
+            if not heap or p <= heap[0][0]:
+                break
+            heapq.heappush(heap, (p, v))
+
+        for u, w, weight in shortcuts:
+            if weight < adj[u].get(w, float("inf")):
+                adj[u][w] = adj[w][u] = weight
+                middle[min(u, w), max(u, w)] = v
+
+        # the remaining edges of v go to nodes of higher rank
+        for u, weight in adj[v].items():
+            up[v][u] = (weight, middle.get((min(u, v), max(u, v)), -1))
+            del adj[u][v]
+            contracted_neighbours[u] += 1
+        adj[v] = {}
+
+        rank[v] = order
+
+    up_offsets = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum([len(edges) for edges in up], out=up_offsets[1:])
+    up_targets = np.array([u for edges in up for u in edges], dtype=np.int32)
+    up_weights = np.array([e[0] for edges in up for e in edges.values()],
+                          dtype=np.float64)
+    up_middle = np.array([e[1] for edges in up for e in edges.values()],
+                         dtype=np.int32)
+
+    return ContractionHierarchy(list(cg.nodes), rank, up_offsets, up_targets,
+                                up_weights, up_middle,
+                                time.perf_counter() - start)
+
+
+def save_hierarchy(ch: ContractionHierarchy, file: BinaryIO) -> None:
+    """Writes the hierarchy in file as NumPy arrays (.npz)."""
+
+    tables = json.dumps({"nodes": ch.nodes,
+                         "preprocessing_time": ch.preprocessing_time})
+    np.savez(file, tables=np.frombuffer(tables.encode(), dtype=np.uint8),
+             rank=ch.rank, up_offsets=ch.up_offsets,
+             up_targets=ch.up_targets, up_weights=ch.up_weights,
+             up_middle=ch.up_middle)
+
+
+def load_hierarchy(filename: str) -> ContractionHierarchy:
+    """Returns the hierarchy stored in file filename"""
+
+    assert os.path.exists(filename), f'Error: {filename} does not exist'
+
+    with np.load(filename) as data:
+        tables = json.loads(data["tables"].tobytes())
+        return ContractionHierarchy(
+            tables["nodes"], data["rank"], data["up_offsets"],
+            data["up_targets"], data["up_weights"], data["up_middle"],
+            tables["preprocessing_time"]
+        )
+
+
+def get_hierarchy(g: CityGraph) -> ContractionHierarchy:
+    """Returns the contraction hierarchy of the city graph g. If it is in the
+    cache (built from the same graph), it is loaded. Otherwise it is built
+    and saved in FILE_HIERARCHY_NAME."""
+
+    params = {"city": g.graph.get("hash") or cache.graph_hash(g),
+              "WITNESS_LIMIT": WITNESS_LIMIT}
+
+    path = cache.lookup(FILE_HIERARCHY_NAME, params)
+    if path is not None:
+        return load_hierarchy(path)
+
+    ch = build_hierarchy(to_compact(g))
+    cache.store(FILE_HIERARCHY_NAME, params,
+                lambda file: save_hierarchy(ch, file))
+    return ch
+
+
+def find_path_hierarchy(g: CityGraph, ch: ContractionHierarchy, src: Coord,
+                        dst: Coord) -> Path:
+    """Returns the shortest path from src to dst as city.find_path does, but
+    the search is done on the contraction hierarchy ch of g."""
+
+    cruilla_src, cruilla_dst = nearest_crosswalks(g, [src, dst])
+    path, minutes = ch.query(ch.index[cruilla_src], ch.index[cruilla_dst])
+    assert path, f'Error: there is no path between {src} and {dst}'
+
+    return ([ch.nodes[i] for i in path], minutes)
@@ -0,0 +1,197 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from dataclasses import asdict, dataclass
+from typing import Callable, ContextManager, Iterator, TypeVar
+
+"""
+PROFILING
+
+Opt-in instrumentation of the pipeline (billboard, buses and city). It is
+enabled with enable() or with the environment variable CINEBUS_PROFILE (its
+value is the JSON file where demo.py saves the report).
+
+What is recorded:
+- stages: calls and wall time of the functions decorated with @timed and
+  of the blocks in `with stage(name)` (nested stages are included in the
+  time of their parents)
+- counters: numbers added with count(name, n), e.g. nodes settled or edges
+  relaxed by the searches
+- caches: hits and misses recorded with cache_hit(name, hit)
+
+When it is disabled, a decorated function only checks a flag before being
+called, and stage returns a context manager that does nothing.
+"""
+
+F = TypeVar("F", bound=Callable)
+
+ENV_VAR = "CINEBUS_PROFILE"
+
+_enabled: bool = bool(os.environ.get(ENV_VAR))
+_lock = threading.Lock()
+
+
+@dataclass
+class Stage:
+    calls: int = 0
+    seconds: float = 0.0
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+_stages: dict[str, Stage] = {}
+_counters: dict[str, int] = {}
+_caches: dict[str, CacheStats] = {}
+
+
+def enable() -> None:
+    """Starts recording."""
+
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Stops recording (what has been recorded is kept)."""
+
+    global _enabled
+    _enabled = False
+
+
+def enabled() -> bool:
+    """Returns whether it is recording."""
+
+    return _enabled
+
+
+def reset() -> None:
+    """Removes everything recorded."""
+
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        _caches.clear()
+
+
+def _record(name: str, seconds: float) -> None:
+    """Adds a call of seconds to the stage name."""
+
+    with _lock:
+        stage = _stages.setdefault(name, Stage())
+        stage.calls += 1
+        stage.seconds += seconds
+
+
+@contextmanager
+def _stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start)
+
+
+def stage(name: str) -> ContextManager[None]:
+    """Returns a context manager that records the wall time of its block in
+    the stage name."""
+
+    return _stage(name) if _enabled else nullcontext()
+
+
+def timed(name: str) -> Callable[[F], F]:
+    """Decorator that records the calls and the wall time of the function in
+    the stage name."""
+
+    def decorator(f: F) -> F:
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return f(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                _record(name, time.perf_counter() - start)
+
+        return wrapper  # type: ignore
+
+    return decorator
+
+
+def count(name: str, n: int = 1) -> None:
+    """Adds n to the counter name."""
+
+    if _enabled:
+        with _lock:
+            _counters[name] = _counters.get(name, 0) + n
+
+
+def cache_hit(name: str, hit: bool) -> None:
+    """Records a hit (or a miss) of the cache name."""
+
+    if _enabled:
+        with _lock:
+            stats = _caches.setdefault(name, CacheStats())
+            if hit:
+                stats.hits += 1
+            else:
+                stats.misses += 1
+
+
+def report() -> dict:
+    """Returns everything recorded (it can be written as JSON)."""
+
+    with _lock:
+        return {
+            "stages": {name: asdict(stage)
+                       for name, stage in sorted(_stages.items())},
+            "counters": dict(sorted(_counters.items())),
+            "caches": {name: dict(asdict(stats), hit_rate=stats.hit_rate)
+                       for name, stats in sorted(_caches.items())},
+        }
+
+
+def save_report(filename: str) -> None:
+    """Writes the report in file filename as JSON."""
+
+    with open(filename, "w") as file:
+        json.dump(report(), file, indent=4)
+
+
+def report_table():
+    """Returns the report as a rich table."""
+
+    from rich.table import Table
+
+    data = report()
+    table = Table(title="Profile", show_header=True,
+                  header_style="bold magenta")
+    table.add_column("Name", justify="left")
+    table.add_column("Calls", justify="right")
+    table.add_column("Total", justify="right")
+    table.add_column("Per call", justify="right")
+
+    for name, stage in data["stages"].items():
+        table.add_row(name, str(stage["calls"]),
+                      f"{stage['seconds'] * 1000:.1f} ms",
+                      f"{stage['seconds'] / stage['calls'] * 1000:.2f} ms")
+    for name, value in data["counters"].items():
+        table.add_row(name, str(value), "", "")
+    for name, stats in data["caches"].items():
+        table.add_row(f"{name} (cache)",
+                      f"{stats['hits']}/{stats['hits'] + stats['misses']}",
+                      f"{stats['hit_rate']:.0%} hits", "")
+
+    return table
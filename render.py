@@ -0,0 +1,363 @@
+import hashlib
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, Iterable, TypeAlias
+
+import networkx as nx
+import numpy as np
+import requests
+from PIL import Image
+from staticmap import Line, StaticMap
+from staticmap.staticmap import _lat_to_y, _lon_to_x
+
+import cache
+import profiling
+
+"""
+RENDERING
+
+The maps are drawn with staticmap, but the tiles are read from a cache in
+disk (TILES_DIR in the cache directory), so each tile is only downloaded
+once and the maps can be drawn without connection (missing tiles are left
+blank). seed_tiles downloads all the tiles of a bounding box beforehand.
+
+The images of the routes are also kept in the cache (ROUTES_DIR), by the
+hash of what is drawn.
+
+The graphs are shown with matplotlib: the edges of each type are a single
+line (with breaks between the segments, so it is a single path instead of a
+path per edge) and the nodes of each type a single scatter, both rasterized.
+Only what is inside the visible bounding box is drawn, with a level of
+detail: the ends are snapped to a grid of RESOLUTION cells along the longest
+side of the box and the repeated segments and points are dropped, so the
+number of artists does not depend on the size of the graph. The level of
+detail is computed again each time the view is zoomed or moved.
+
+Coordinates are in lat - lon format, except in staticmap and in the arrays
+shown with matplotlib (lon - lat, so x is the longitude).
+"""
+
+TILE_URL = "http://a.tile.komoot.de/komoot-2/{z}/{x}/{y}.png"
+TILE_SIZE = 256
+TIMEOUT = 10  # seconds
+
+TILES_DIR = "tiles"
+ROUTES_DIR = "routes"
+
+MAP_SIZE = (300, 300)
+
+RESOLUTION = 800  # cells of the level of detail along the longest side
+
+# (south, west, north, east)
+BBox: TypeAlias = tuple[float, float, float, float]
+BARCELONA_BBOX = (41.32, 2.05, 41.47, 2.23)
+SEED_ZOOMS = range(11, 17)
+
+_session = requests.Session()
+_blank_tile: bytes | None = None
+
+
+def tile_path(url: str) -> str:
+    """Returns the path of the file of the tile url in the cache."""
+
+    directory = cache.cache_path(TILES_DIR)
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory,
+                        hashlib.sha1(url.encode()).hexdigest() + ".png")
+
+
+def blank_tile() -> bytes:
+    """Returns a white tile (PNG), used when a tile can not be downloaded."""
+
+    global _blank_tile
+    if _blank_tile is None:
+        buffer = BytesIO()
+        Image.new("RGBA", (TILE_SIZE, TILE_SIZE), "#fff").save(buffer, "PNG")
+        _blank_tile = buffer.getvalue()
+    return _blank_tile
+
+
+def fetch_tile(url: str) -> tuple[bytes, bool]:
+    """Returns the content of the tile url and whether it is a real tile
+    (it is blank if it is not in the cache and it can not be downloaded)."""
+
+    path = tile_path(url)
+    hit = os.path.exists(path)
+    profiling.cache_hit("tiles", hit)
+    if hit:
+        with open(path, "rb") as file:
+            return file.read(), True
+
+    try:
+        response = _session.get(url, timeout=TIMEOUT)
+    except requests.RequestException:
+        return blank_tile(), False
+    if response.status_code != 200:
+        return blank_tile(), False
+
+    cache.atomic_write(path, lambda file: file.write(response.content))
+    return response.content, True
+
+
+class CachedStaticMap(StaticMap):
+    """StaticMap that reads the tiles from the cache of tiles. The zoom is
+    at most the last of SEED_ZOOMS."""
+
+    def __init__(self, width: int = MAP_SIZE[0],
+                 height: int = MAP_SIZE[1]) -> None:
+        super().__init__(width, height, url_template=TILE_URL,
+                         tile_size=TILE_SIZE)
+
+    def get(self, url: str, **kwargs) -> tuple[int, bytes]:
+        return 200, fetch_tile(url)[0]
+
+    def _calculate_zoom(self) -> int:
+        # short routes would be drawn at zoom 17, whose tiles are not seeded
+        # (see seed_tiles), so they would be blank without connection
+        return min(super()._calculate_zoom(), SEED_ZOOMS[-1])
+
+
+def tile_urls(bbox: BBox,
+              zooms: Iterable[int]) -> list[str]:
+    """Returns the urls of the tiles that cover bbox at each zoom."""
+
+    south, west, north, east = bbox
+    urls = []
+    for zoom in zooms:
+        x_min, x_max = int(_lon_to_x(west, zoom)), int(_lon_to_x(east, zoom))
+        y_min, y_max = int(_lat_to_y(north, zoom)), int(_lat_to_y(south, zoom))
+        urls += [TILE_URL.format(z=zoom, x=x, y=y)
+                 for x in range(x_min, x_max + 1)
+                 for y in range(y_min, y_max + 1)]
+    return urls
+
+
+def seed_tiles(bbox: BBox = BARCELONA_BBOX,
+               zooms: Iterable[int] = SEED_ZOOMS,
+               workers: int = 8) -> int:
+    """Downloads the tiles of bbox at each zoom that are not in the cache.
+    Returns the number of tiles that could not be downloaded."""
+
+    urls = [url for url in tile_urls(bbox, zooms)
+            if not os.path.exists(tile_path(url))]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fetch_tile, urls))
+    return sum(1 for _, real in results if not real)
+
+
+def polylines(segments: Iterable[tuple[tuple, tuple]]) -> list[list[tuple]]:
+    """Returns the segments (pairs of points) joined in the fewest
+    polylines that are easy to find: a polyline goes on through every
+    point where only two segments meet."""
+
+    adj: dict[tuple, list[tuple]] = {}
+    for a, b in segments:
+        if a != b:
+            adj.setdefault(a, []).append(b)
+            adj.setdefault(b, []).append(a)
+
+    used: set[frozenset] = set()
+
+    def walk(start: tuple, after: tuple) -> list[tuple]:
+        line = [start, after]
+        used.add(frozenset((start, after)))
+        while len(adj[line[-1]]) == 2:
+            following = next((p for p in adj[line[-1]]
+                              if frozenset((line[-1], p)) not in used), None)
+            if following is None:
+                break
+            used.add(frozenset((line[-1], following)))
+            line.append(following)
+        return line
+
+    lines: list[list[tuple]] = []
+    # first from the ends and the crossings, then the cycles left
+    for degree_two in (False, True):
+        for point, neighbours in adj.items():
+            if (len(neighbours) == 2) != degree_two:
+                continue
+            for neighbour in neighbours:
+                if frozenset((point, neighbour)) not in used:
+                    lines.append(walk(point, neighbour))
+
+    return lines
+
+
+def add_polylines(map: StaticMap,
+                  segments: dict[str | tuple, list[tuple[tuple, tuple]]],
+                  width: int = 2) -> None:
+    """Adds to map the segments (pairs of lat - lon points) of each color,
+    joined in polylines."""
+
+    for color, color_segments in segments.items():
+        for line in polylines(color_segments):
+            map.add_line(Line([(lon, lat) for lat, lon in line], color, width))
+
+
+def cached_render(key: object, filename: str,
+                  draw: Callable[[], StaticMap]) -> None:
+    """Saves in filename the image of the map returned by draw. The image
+    is kept in the cache by the hash of key, so draw is only called the
+    first time."""
+
+    directory = cache.cache_path(ROUTES_DIR)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, cache.data_hash(key) + ".png")
+
+    hit = os.path.exists(path)
+    profiling.cache_hit("routes", hit)
+    if not hit:
+        image = draw().render()
+        cache.atomic_write(path, lambda file: image.save(file, "PNG"))
+
+    shutil.copyfile(path, filename)
+
+
+def graph_segments(g: nx.Graph, key: str = "type",
+                   default: str | None = None) -> dict[str, np.ndarray]:
+    """Returns the edges of g grouped by their attribute key, as arrays of
+    shape (m, 2, 2) with the lon - lat coordinates of their ends."""
+
+    index = {node: i for i, node in enumerate(g)}
+    coords = np.array([coord for _, coord in g.nodes(data="coord")],
+                      dtype=float)[:, ::-1]
+
+    groups: dict[str, list[int]] = {}  # indices of the ends of the edges
+    for u, v, value in g.edges(data=key, default=default):
+        groups.setdefault(value, []).extend((index[u], index[v]))
+    return {value: coords[ends].reshape(-1, 2, 2)
+            for value, ends in groups.items()}
+
+
+def graph_points(g: nx.Graph, key: str = "type",
+                 default: str | None = None) -> dict[str, np.ndarray]:
+    """Returns the nodes of g grouped by their attribute key, as arrays of
+    shape (n, 2) with their lon - lat coordinates."""
+
+    groups: dict[str, list[tuple]] = {}
+    for _, attr in g.nodes(data=True):
+        groups.setdefault(attr.get(key, default), []).append(attr["coord"])
+    return {value: np.array(points, dtype=float)[:, ::-1]
+            for value, points in groups.items()}
+
+
+def _inside(points: np.ndarray, bbox: BBox) -> np.ndarray:
+    """Returns which points (lon - lat, in the last axis) are inside bbox."""
+
+    south, west, north, east = bbox
+    return ((points[..., 0] >= west) & (points[..., 0] <= east)
+            & (points[..., 1] >= south) & (points[..., 1] <= north))
+
+
+def _overlaps(segments: np.ndarray, bbox: BBox) -> np.ndarray:
+    """Returns which segments (ends lon - lat) have a bounding box that
+    overlaps bbox. It keeps the segments that cross bbox with both ends
+    outside of it (and a few more near its corners, which is harmless)."""
+
+    south, west, north, east = bbox
+    low, high = segments.min(axis=1), segments.max(axis=1)
+    return ((low[:, 0] <= east) & (high[:, 0] >= west)
+            & (low[:, 1] <= north) & (high[:, 1] >= south))
+
+
+def _cell(bbox: BBox, resolution: int) -> float:
+    """Returns the size of the cells of the level of detail of bbox."""
+
+    south, west, north, east = bbox
+    return max(east - west, north - south, 1e-9) / resolution
+
+
+def segments_detail(segments: np.ndarray, bbox: BBox,
+                    resolution: int = RESOLUTION) -> np.ndarray:
+    """Returns the segments that overlap bbox, with their ends snapped to
+    the grid of the level of detail and without the repeated ones (or the
+    ones that become a point)."""
+
+    segments = segments[_overlaps(segments, bbox)]
+    cell = _cell(bbox, resolution)
+    snapped = np.round(segments / cell)
+    snapped = snapped[(snapped[:, 0] != snapped[:, 1]).any(axis=1)]
+
+    # the ends of each segment in the same order, so (a, b) repeats (b, a)
+    a, b = snapped[:, 0], snapped[:, 1]
+    swap = (a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] > b[:, 1]))
+    snapped[swap] = snapped[swap][:, ::-1]
+
+    unique = np.unique(snapped.reshape(-1, 4), axis=0)
+    return unique.reshape(-1, 2, 2) * cell
+
+
+def points_detail(points: np.ndarray, bbox: BBox,
+                  resolution: int = RESOLUTION) -> np.ndarray:
+    """Returns the points inside bbox snapped to the grid of the level of
+    detail, without the repeated ones."""
+
+    cell = _cell(bbox, resolution)
+    snapped = np.round(points[_inside(points, bbox)] / cell)
+    return np.unique(snapped, axis=0) * cell
+
+
+def _broken_line(segments: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the x and y of a line that draws the segments, with NaN
+    between them (matplotlib does not join the points around a NaN)."""
+
+    points = np.full((len(segments), 3, 2), np.nan)
+    points[:, :2] = segments
+    return points[:, :, 0].ravel(), points[:, :, 1].ravel()
+
+
+def full_bbox(arrays: Iterable[np.ndarray]) -> BBox:
+    """Returns the bounding box of the lon - lat coordinates in arrays."""
+
+    coords = np.concatenate([array.reshape(-1, 2) for array in arrays])
+    (west, south), (east, north) = coords.min(axis=0), coords.max(axis=0)
+    return south, west, north, east
+
+
+def show_graph(segments: dict[str, np.ndarray],
+               points: dict[str, np.ndarray],
+               colors: dict[str, str], bbox: BBox | None = None,
+               resolution: int = RESOLUTION) -> None:
+    """Shows interactively the segments and the points of each type (from
+    graph_segments and graph_points) in their colors, inside bbox (the whole
+    graph by default) and with the level of detail of the view."""
+
+    import matplotlib.pyplot as plt  # slow to import, only needed here
+
+    fig, ax = plt.subplots()
+
+    lines = {value: ax.plot([], [], color=colors.get(value, "gray"),
+                            linewidth=0.5, rasterized=True)[0]
+             for value in segments}
+    dots = {value: ax.scatter([], [], s=2, c=colors.get(value, "gray"),
+                              rasterized=True, zorder=2)
+            for value in points}
+
+    def update(bbox: BBox) -> None:
+        for value, line in lines.items():
+            line.set_data(*_broken_line(
+                segments_detail(segments[value], bbox, resolution)))
+        for value, scatter in dots.items():
+            scatter.set_offsets(points_detail(points[value], bbox, resolution))
+
+    if bbox is None:
+        bbox = full_bbox([*segments.values(), *points.values()])
+    south, west, north, east = bbox
+    update(bbox)
+
+    ax.set_xlim(west, east)
+    ax.set_ylim(south, north)
+    # a degree of longitude is shorter than a degree of latitude
+    ax.set_aspect(1 / math.cos(math.radians((south + north) / 2)))
+
+    def on_limits(ax) -> None:
+        (west, east), (south, north) = ax.get_xlim(), ax.get_ylim()
+        update((south, west, north, east))
+
+    ax.callbacks.connect("xlim_changed", on_limits)
+    ax.callbacks.connect("ylim_changed", on_limits)
+
+    plt.show()
@@ -0,0 +1,209 @@
+import json
+import multiprocessing
+import multiprocessing.pool
+import struct
+from typing import BinaryIO, Callable, Iterable, Sequence
+
+import numpy as np
+
+import cache
+from city import CityGraph, Coord, Path
+from compact import ARRAYS, CompactGraph, find_path_compact, to_compact
+
+"""
+SHARED CITY GRAPH
+
+The compact city graph is exported to a single file that is opened with
+np.memmap, so every process that opens it shares the same pages of memory
+(read-only) instead of having its own copy of the graph.
+
+Format of the file:
+- MAGIC (8 bytes) and the length of the header (8 bytes, little endian)
+- header (JSON): dtype, shape and offset of each array and the tables
+- the arrays, each one aligned to ALIGNMENT bytes (offsets are relative to
+  the first multiple of ALIGNMENT after the header)
+
+The node ids are stored in the array node_ids: crosswalks are their id
+(positive) and stops are -(k + 1), where k is their position in the table
+stops.
+"""
+
+MAGIC = b"CINEBUS1"
+ALIGNMENT = 64
+
+FILE_SHARED_NAME = "CITY_GRAPH.mmap"
+
+
+class NodeIds(Sequence):
+    """Node ids of a shared graph, read from the array node_ids."""
+
+    def __init__(self, node_ids: np.ndarray, stops: list[str]) -> None:
+        self.node_ids = node_ids
+        self.stops = stops
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+
+        node = int(self.node_ids[i])
+        return node if node >= 0 else self.stops[-node - 1]
+
+
+def export_shared(cg: CompactGraph, filename: str) -> None:
+    """Writes the compact graph cg in file filename (see the format above)."""
+
+    cache.atomic_write(filename, lambda file: write_shared(cg, file))
+
+
+def get_shared_file(g: CityGraph) -> str:
+    """Returns the path of the shared file of the city graph g. If it is not
+    in the cache (exported from the same graph), it is exported."""
+
+    params = {"city": g.graph.get("hash") or cache.graph_hash(g)}
+
+    path = cache.lookup(FILE_SHARED_NAME, params)
+    if path is None:
+        cg = to_compact(g)
+        cache.store(FILE_SHARED_NAME, params,
+                    lambda file: write_shared(cg, file))
+        path = cache.cache_path(FILE_SHARED_NAME)
+
+    return path
+
+
+def write_shared(cg: CompactGraph, file: BinaryIO) -> None:
+    """Writes the compact graph cg in file (see the format above)."""
+
+    stops: list[str] = []
+    node_ids = np.empty(len(cg), dtype=np.int64)
+    for i, node in enumerate(cg.nodes):
+        if isinstance(node, str):
+            stops.append(node)
+            node_ids[i] = -len(stops)
+        else:
+            node_ids[i] = node
+
+    arrays = {"node_ids": node_ids}
+    arrays.update({name: getattr(cg, name) for name in ARRAYS})
+
+    # offsets are relative to the end of the header
+    layout: dict[str, list] = {}
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = [array.dtype.str, list(array.shape), offset]
+        offset = _align(offset + array.nbytes)
+
+    header = json.dumps({
+        "arrays": layout,
+        "tables": {"stops": stops, "linies": cg.linies, "noms": cg.noms,
+                   "names": cg.names}
+    }).encode()
+    start = _align(len(MAGIC) + 8 + len(header))
+
+    file.write(MAGIC + struct.pack("<Q", len(header)) + header)
+    for name, array in arrays.items():
+        file.seek(start + layout[name][2])
+        file.write(np.ascontiguousarray(array).tobytes())
+    file.truncate(start + offset)
+
+
+def _align(offset: int) -> int:
+    """Returns the first multiple of ALIGNMENT that is >= offset."""
+
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def open_shared(filename: str) -> CompactGraph:
+    """Returns the compact graph stored in file filename. Its arrays are
+    read-only views of the file mapped in memory."""
+
+    buffer = np.memmap(filename, dtype=np.uint8, mode="r")
+    assert bytes(buffer[:len(MAGIC)]) == MAGIC, \
+        f'Error: {filename} is not a shared graph'
+
+    length = struct.unpack("<Q", bytes(buffer[len(MAGIC):len(MAGIC) + 8]))[0]
+    header = json.loads(bytes(buffer[len(MAGIC) + 8:
+                                     len(MAGIC) + 8 + length]))
+    start = _align(len(MAGIC) + 8 + length)
+
+    arrays: dict[str, np.ndarray] = {}
+    for name, (dtype, shape, offset) in header["arrays"].items():
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        arrays[name] = buffer[start + offset:start + offset + size] \
+            .view(dtype).reshape(shape)
+
+    tables = header["tables"]
+    return CompactGraph(NodeIds(arrays["node_ids"], tables["stops"]),
+                        *[arrays[name] for name in ARRAYS],
+                        tables["linies"], tables["noms"], tables["names"])
+
+
+# state of each process of a pool started by worker_pool
+_worker_state = None
+
+
+def _init_worker(state, setup: Callable | None) -> None:
+    """Sets the state of a process of the pool."""
+
+    global _worker_state
+    _worker_state = state if setup is None else setup(state)
+
+
+def _call_worker(function: Callable, *args):
+    """function(state, *args) with the state of the process."""
+
+    return function(_worker_state, *args)
+
+
+def worker_pool(processes: int | None, state,
+                setup: Callable | None = None) -> multiprocessing.pool.Pool:
+    """Returns a pool of processes (None uses all the cores) where each
+    process keeps state, or setup(state) if setup is given (it is called
+    once in each process). The tasks are run with worker_starmap."""
+
+    return multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(state, setup))
+
+
+def worker_starmap(pool: multiprocessing.pool.Pool, function: Callable,
+                   iterable: Iterable[tuple]) -> list:
+    """Returns [function(state, *args) for args in iterable], run in the
+    processes of pool (started by worker_pool). function must be a function
+    of a module, so it can be sent to the processes."""
+
+    return pool.starmap(_call_worker,
+                        [(function, *args) for args in iterable])
+
+
+class RoutingPool:
+    """Pool of processes that answer find_path queries over a shared graph
+    file (see export_shared). All of them map the same file, so adding
+    processes barely increases the memory used."""
+
+    def __init__(self, filename: str, processes: int | None = None) -> None:
+        """Starts processes (None uses all the cores) that open filename."""
+
+        self.pool = worker_pool(processes, filename, open_shared)
+
+    def find_paths(self, queries: list[tuple[Coord, Coord]],
+                   algorithm: str = "dijkstra") -> list[Path]:
+        """Returns the shortest path of each query (src, dst), with the same
+        format as city.find_path."""
+
+        return worker_starmap(self.pool, find_path_compact,
+                              [(src, dst, algorithm) for src, dst in queries])
+
+    def close(self) -> None:
+        """Stops the processes of the pool."""
+
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self) -> "RoutingPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
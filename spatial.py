@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from sklearn.neighbors import BallTree
+
+from buses import Coord
+
+EARTH_RADIUS = 6371.0088  # km (the same as haversine)
+
+
+@dataclass
+class SpatialIndex:
+    """Index of the coordinates (lat - lon) of some nodes to find the closest
+    ones to any coordinate. The tree is built once, so each query only costs
+    a search in it."""
+
+    nodes: np.ndarray  # node id of each position
+    tree: "BallTree"
+
+    def nearest(self, coords: list[Coord]) -> list:
+        """Returns the closest node to each of the coordinates."""
+
+        return self.k_nearest(coords, 1)[0][:, 0].tolist()
+
+    def k_nearest(self, coords: list[Coord],
+                  k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the k closest nodes to each of the coordinates (sorted by
+        distance) and their distances in km. Both arrays have shape
+        (len(coords), k)."""
+
+        dist, pos = self.tree.query(_radians(coords), k=k)
+        return self.nodes[pos], dist * EARTH_RADIUS
+
+    def within(self, coords: list[Coord], radius: float) -> list[np.ndarray]:
+        """Returns, for each of the coordinates, the nodes that are at most
+        radius km away."""
+
+        positions = self.tree.query_radius(_radians(coords),
+                                           r=radius / EARTH_RADIUS)
+        return [self.nodes[pos] for pos in positions]
+
+
+def haversine_array(coords1: np.ndarray, coords2: np.ndarray) -> np.ndarray:
+    """Returns the distance in km between each pair of coordinates (lat -
+    lon) of the arrays coords1 and coords2, with shape (n, 2). It is the
+    same formula as haversine."""
+
+    lat1, lon1 = np.radians(coords1).T
+    lat2, lon2 = np.radians(coords2).T
+    d = (np.sin((lat2 - lat1) * 0.5) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) * 0.5) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(d))
+
+
+def _radians(coords: list[Coord]) -> np.ndarray:
+    """Returns the coordinates in radians, as BallTree needs them with the
+    haversine metric."""
+
+    return np.radians(np.asarray(coords, dtype=np.float64).reshape(-1, 2))
+
+
+def build_spatial_index(nodes: list, coords: list[Coord]) -> SpatialIndex:
+    """Returns the spatial index of the nodes, given their coordinates in
+    lat - lon format."""
+
+    from sklearn.neighbors import BallTree  # slow to import
+
+    return SpatialIndex(np.asarray(nodes),
+                        BallTree(_radians(coords), metric="haversine"))